@@ -0,0 +1,483 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import struct
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+
+import numpy as np
+from sqlalchemy import text
+
+from benchmarks.synthetic_data import (
+    LOCATION_COLUMNS, FakeEmbeddings, clustered_vectors, exact_top_k, kb_chunks, kb_queries, location_documents,
+    location_queries, query_vectors,
+)
+from retrievers.GeoIndex import GeoIndex
+from retrievers.PGVectorRetriever import PGVectorMMRRetriever
+from retrievers.TableColumnRetriever import TableColumnRetriever, normalize_rows, top_k_indices
+
+DEFAULT_SCALES = [1000, 10000, 100000, 1000000]
+RETRIEVERS = ["table_column", "pg_vector_mmr", "context_deciding"]
+
+# The same seeds at every scale, so two runs of the suite are directly comparable
+LOCATION_SEED = 1
+KB_SEED = 2
+QUERY_SEED = 3
+
+CandidateRow = namedtuple("CandidateRow", ["document", "cmetadata", "embedding"])
+
+def encode_vector(vector):
+    '''
+    pgvector's binary send format (int16 dim, int16 unused, dim big-endian float4s), what vector_send() returns
+    '''
+    return struct.pack(">hh", len(vector), 0) + vector.astype(">f4").tobytes()
+
+class InMemoryMMRRetriever(PGVectorMMRRetriever):
+    """
+    PGVectorMMRRetriever with the pgvector query replaced by an exact search over an in-memory matrix. The
+    candidates are handed to rerank in vector_send()'s binary format, so decoding and MMR run as in production.
+    """
+
+    engine: Any = None
+    collection_id: str = "in-memory"
+    embedding_matrix: Any
+    chunks: Any
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        query_vector = self.embeddings_model.embed_query(query)
+
+        candidates = top_k_indices(self.embedding_matrix, [query_vector], self.fetch_k)[0]
+        rows = [CandidateRow(self.chunks[i][1], self.chunks[i][2], encode_vector(self.embedding_matrix[i])) for i in candidates]
+
+        return self.rerank(query_vector, rows)
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+def latency_summary(seconds):
+    milliseconds = 1000 * np.asarray(seconds)
+    return {
+        "p50": float(np.percentile(milliseconds, 50)),
+        "p99": float(np.percentile(milliseconds, 99)),
+        "mean": float(milliseconds.mean()),
+        "max": float(milliseconds.max()),
+    }
+
+def recall_at_k(retrieved_ids, truth, k):
+    '''
+    Mean fraction of each query's exact top-k that the retriever returned
+    '''
+    recalls = [len(set(ids) & set(int(i) for i in expected[:k])) / k for ids, expected in zip(retrieved_ids, truth)]
+    return float(np.mean(recalls))
+
+def run_queries(retriever, queries, document_id, warmup):
+    '''
+    Time retriever.invoke for every query after a few untimed warmup calls. Returns the latencies and the ids of
+    the documents each query returned.
+    '''
+    for query in queries[:warmup]:
+        retriever.invoke(query)
+
+    latencies = []
+    retrieved_ids = []
+    for query in queries:
+        start_time = time.perf_counter()
+        documents = retriever.invoke(query)
+        latencies.append(time.perf_counter() - start_time)
+
+        retrieved_ids.append([document_id(doc) for doc in documents if document_id(doc) is not None])
+
+    return latencies, retrieved_ids
+
+def kb_document_id(doc):
+    return doc.metadata.get("chunk")
+
+@contextlib.contextmanager
+def simulated_llm_calls(judge_latency, external_latency, sufficient_rate):
+    '''
+    Replace ContextDecidingRetriever's gpt-4o judge and external context calls with sleeps of the given latency.
+    The judge's verdict is derived from the query, so every run takes the same branches.
+    '''
+    import retrievers.ContextDecidingRetriever as context_deciding
+
+    def judge_context(query, context_docs, timeout=None):
+        time.sleep(judge_latency)
+        digest = hashlib.blake2b(query.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") / 2 ** 64 < sufficient_rate
+
+    def fetch_external_context(conversation_id, query, timeout=None):
+        time.sleep(external_latency)
+        return f"External context for {query}"
+
+    originals = (context_deciding.judge_context, context_deciding.fetch_external_context)
+    context_deciding.judge_context, context_deciding.fetch_external_context = judge_context, fetch_external_context
+    try:
+        yield
+    finally:
+        context_deciding.judge_context, context_deciding.fetch_external_context = originals
+
+def bench_table_column(rows, settings):
+    documents = location_documents(rows, LOCATION_SEED)
+    vectors = clustered_vectors(rows, settings["dims"], LOCATION_SEED)
+
+    city_position = LOCATION_COLUMNS.index("city")
+    cities = np.array([doc.page_content.split("##")[city_position] for doc in documents])
+
+    # Queries that name a city are drawn near a row in that city, the others near any row
+    rng = np.random.default_rng(QUERY_SEED)
+    location_query_list = location_queries(settings["queries"], QUERY_SEED)
+    anchors = [rng.choice(np.flatnonzero(cities == city)) if city else rng.integers(rows) for _, city in location_query_list]
+
+    query_texts = [query for query, _ in location_query_list]
+    queries = query_vectors(vectors, anchors, QUERY_SEED)
+    embeddings = FakeEmbeddings(settings["dims"], dict(zip(query_texts, queries)))
+
+    rss_before = current_rss_mb()
+    start_time = time.perf_counter()
+
+    # The in-memory half of build_table_column_retriever; the Postgres load itself is measured by load_table_embeddings' log line
+    embedding_matrix = normalize_rows(vectors, copy=False)
+    geo_index = GeoIndex.from_documents(documents, LOCATION_COLUMNS)
+    retriever = TableColumnRetriever(documents=documents, embedding_matrix=embedding_matrix, k=settings["location_k"], openai_embeddings=embeddings, geo_index=geo_index)
+
+    build_seconds = time.perf_counter() - start_time
+    retriever_rss = current_rss_mb() - rss_before
+
+    # Ground truth is the exact top-k over every row, or over the named city's rows when the query names one
+    truth = exact_top_k(embedding_matrix, queries, settings["location_k"])
+    for j, (_, city) in enumerate(location_query_list):
+        if city:
+            city_rows = np.flatnonzero(cities == city)
+            truth[j] = city_rows[top_k_indices(embedding_matrix[city_rows], queries[j:j + 1], settings["location_k"])[0]]
+
+    latencies, retrieved_ids = run_queries(retriever, query_texts, lambda doc: int(json.loads(doc.page_content)["id"]), settings["warmup"])
+
+    return {
+        "k": settings["location_k"],
+        "build_seconds": build_seconds,
+        "retriever_rss_mb": retriever_rss,
+        "latency_ms": latency_summary(latencies),
+        "recall_at_k": recall_at_k(retrieved_ids, truth, settings["location_k"]),
+        "spatial_query_fraction": sum(bool(city) for _, city in location_query_list) / len(location_query_list),
+    }
+
+def kb_corpus(rows, settings):
+    chunks = kb_chunks(rows, KB_SEED)
+    vectors = clustered_vectors(rows, settings["dims"], KB_SEED)
+
+    query_texts = kb_queries(settings["queries"], QUERY_SEED)
+    anchors = np.random.default_rng(QUERY_SEED).integers(0, rows, settings["queries"])
+    queries = query_vectors(vectors, anchors, QUERY_SEED)
+    embeddings = FakeEmbeddings(settings["dims"], dict(zip(query_texts, queries)))
+
+    return chunks, vectors, query_texts, queries, embeddings
+
+def in_memory_mmr_retriever(chunks, embedding_matrix, embeddings, settings):
+    return InMemoryMMRRetriever(
+        embedding_matrix=embedding_matrix,
+        chunks=chunks,
+        embeddings_model=embeddings,
+        k=settings["kb_k"],
+        fetch_k=settings["fetch_k"],
+        lambda_mult=settings["lambda_mult"],
+    )
+
+def load_benchmark_collection(engine, collection_name, chunks, vectors, batch_size=10000):
+    '''
+    Replace the named collection with the synthetic chunks (COPY, batch_size rows at a time) and build its ANN index.
+    Returns the collection id and the load and index build times.
+    '''
+    from vector_index import ensure_collection_ann_index
+
+    drop_benchmark_collection(engine, collection_name)
+
+    start_time = time.perf_counter()
+    with engine.begin() as conn:
+        collection_id = conn.execute(text("""
+        INSERT INTO langchain_pg_collection (uuid, name, cmetadata) VALUES (gen_random_uuid(), :name, '{"benchmark": true}')
+        RETURNING uuid::text
+        """), {"name": collection_name}).scalar()
+
+    raw_connection = engine.raw_connection()
+    try:
+        with raw_connection.cursor() as cursor:
+            for start in range(0, len(chunks), batch_size):
+                buffer = io.StringIO()
+                for (chunk_id, document, metadata), vector in zip(chunks[start:start + batch_size], vectors[start:start + batch_size]):
+                    embedding = "[" + ",".join(f"{x:.6g}" for x in vector) + "]"
+                    buffer.write(f"{chunk_id}\t{collection_id}\t{embedding}\t{document}\t{json.dumps(metadata)}\n")
+                buffer.seek(0)
+
+                cursor.copy_expert("COPY langchain_pg_embedding (id, collection_id, embedding, document, cmetadata) FROM STDIN", buffer)
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+    load_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with engine.begin() as conn:
+        index_name = ensure_collection_ann_index(conn, collection_id)
+        conn.execute(text("ANALYZE langchain_pg_embedding"))
+        index_mb = conn.execute(text("SELECT pg_relation_size(CAST(:index_name AS regclass))"), {"index_name": index_name}).scalar() / 2 ** 20
+    build_seconds = time.perf_counter() - start_time
+
+    return collection_id, load_seconds, build_seconds, index_mb
+
+def drop_benchmark_collection(engine, collection_name):
+    from vector_index import drop_collection_ann_index
+
+    with engine.begin() as conn:
+        collection_id = conn.execute(text("SELECT uuid::text FROM langchain_pg_collection WHERE name = :name"), {"name": collection_name}).scalar()
+        if collection_id is not None:
+            drop_collection_ann_index(conn, collection_id)
+            # Embeddings go with it (ON DELETE CASCADE)
+            conn.execute(text("DELETE FROM langchain_pg_collection WHERE uuid = CAST(:collection_id AS UUID)"), {"collection_id": collection_id})
+
+def bench_pg_vector_mmr(rows, settings):
+    chunks, vectors, query_texts, queries, embeddings = kb_corpus(rows, settings)
+    truth = exact_top_k(normalize_rows(vectors), queries, settings["kb_k"])
+
+    result = {"k": settings["kb_k"], "fetch_k": settings["fetch_k"], "lambda_mult": settings["lambda_mult"]}
+
+    if settings["database_uri"]:
+        # The real build_pg_vector_retriever path: ANN candidates from pgvector, then the NumPy MMR
+        from connection_pool import shared_engine
+        from retrievers.PGVectorRetriever import build_pg_vector_retriever
+
+        engine = shared_engine(settings["database_uri"])
+        collection_name = f"benchmark-{rows}-{settings['dims']}"
+
+        collection_id, load_seconds, build_seconds, index_mb = load_benchmark_collection(engine, collection_name, chunks, vectors)
+        try:
+            rss_before = current_rss_mb()
+            retriever = build_pg_vector_retriever(
+                collection_name, embeddings, settings["database_uri"], ef_search=settings["ef_search"],
+                k=settings["kb_k"], fetch_k=settings["fetch_k"], lambda_mult=settings["lambda_mult"],
+            )
+            latencies, retrieved_ids = run_queries(retriever, query_texts, kb_document_id, settings["warmup"])
+
+            result.update(mode="postgres", load_seconds=load_seconds, build_seconds=build_seconds, index_mb=index_mb, retriever_rss_mb=current_rss_mb() - rss_before)
+        finally:
+            if not settings["keep_collections"]:
+                drop_benchmark_collection(engine, collection_name)
+    else:
+        rss_before = current_rss_mb()
+        start_time = time.perf_counter()
+        retriever = in_memory_mmr_retriever(chunks, normalize_rows(vectors, copy=False), embeddings, settings)
+        build_seconds = time.perf_counter() - start_time
+        retriever_rss = current_rss_mb() - rss_before
+
+        latencies, retrieved_ids = run_queries(retriever, query_texts, kb_document_id, settings["warmup"])
+
+        result.update(mode="in-memory", build_seconds=build_seconds, retriever_rss_mb=retriever_rss)
+
+    # MMR trades some relevance for diversity, so recall@k against exact search is expected to be below 1
+    result.update(latency_ms=latency_summary(latencies), recall_at_k=recall_at_k(retrieved_ids, truth, settings["kb_k"]), rerank=retriever.stats.as_dict())
+    return result
+
+def bench_context_deciding(rows, settings):
+    from retrievers.ContextDecidingRetriever import ContextDecidingRetriever
+
+    chunks, vectors, query_texts, queries, embeddings = kb_corpus(rows, settings)
+
+    rss_before = current_rss_mb()
+    start_time = time.perf_counter()
+    base_retriever = in_memory_mmr_retriever(chunks, normalize_rows(vectors, copy=False), embeddings, settings)
+    retriever = ContextDecidingRetriever(base_retriever=base_retriever, allow_external=True, conversation_id="benchmark")
+    build_seconds = time.perf_counter() - start_time
+    retriever_rss = current_rss_mb() - rss_before
+
+    truth = exact_top_k(base_retriever.embedding_matrix, queries, settings["kb_k"])
+
+    with simulated_llm_calls(settings["judge_latency_ms"] / 1000, settings["external_latency_ms"] / 1000, settings["sufficient_rate"]):
+        latencies, retrieved_ids = run_queries(retriever, query_texts, kb_document_id, settings["warmup"])
+
+    return {
+        "k": settings["kb_k"],
+        "mode": "simulated-llm",
+        "judge_latency_ms": settings["judge_latency_ms"],
+        "external_latency_ms": settings["external_latency_ms"],
+        "sufficient_rate": settings["sufficient_rate"],
+        "build_seconds": build_seconds,
+        "retriever_rss_mb": retriever_rss,
+        "latency_ms": latency_summary(latencies),
+        # The appended external context document has no chunk id, so this is the recall of the KB documents alone
+        "recall_at_k": recall_at_k(retrieved_ids, truth, settings["kb_k"]),
+    }
+
+BENCHMARKS = {
+    "table_column": bench_table_column,
+    "pg_vector_mmr": bench_pg_vector_mmr,
+    "context_deciding": bench_context_deciding,
+}
+
+def run_case(retriever_name, rows, settings):
+    '''
+    Run one benchmark and report it along with the process's peak memory. Called in a fresh process per case.
+    '''
+    start_time = time.perf_counter()
+    result = BENCHMARKS[retriever_name](rows, settings)
+
+    return {
+        "retriever": retriever_name,
+        "rows": rows,
+        "dims": settings["dims"],
+        "queries": settings["queries"],
+        **result,
+        "peak_rss_mb": peak_rss_mb(),
+        "total_seconds": time.perf_counter() - start_time,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare_to_baseline(results, baseline_path, max_latency_regression, max_recall_drop):
+    '''
+    Regressions of p99 latency or recall@k against a previous report, for the cases present in both
+    '''
+    with open(baseline_path) as f:
+        baseline = {(r["retriever"], r["rows"], r["dims"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["retriever"], result["rows"], result["dims"]))
+        if previous is None or "error" in result or "error" in previous:
+            continue
+
+        case = f"{result['retriever']} @ {result['rows']} rows"
+        if result["latency_ms"]["p99"] > previous["latency_ms"]["p99"] * (1 + max_latency_regression):
+            regressions.append(f"{case}: p99 {previous['latency_ms']['p99']:.2f}ms -> {result['latency_ms']['p99']:.2f}ms")
+        if result["recall_at_k"] < previous["recall_at_k"] - max_recall_drop:
+            regressions.append(f"{case}: recall@{result['k']} {previous['recall_at_k']:.3f} -> {result['recall_at_k']:.3f}")
+
+    return regressions
+
+def main():
+    from dotenv import load_dotenv
+
+    from vector_index import EMBEDDING_DIMENSIONS
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Benchmark the retrieval hot paths on synthetic corpora")
+    parser.add_argument("--scales", default=",".join(str(s) for s in DEFAULT_SCALES), help="Comma separated corpus sizes")
+    parser.add_argument("--retrievers", default=",".join(RETRIEVERS), help=f"Comma separated subset of {', '.join(RETRIEVERS)}")
+    parser.add_argument("--dims", type=int, help="Embedding dimensions (default 256 in memory, EMBEDDING_DIMENSIONS against Postgres)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--location-k", type=int, default=5)
+    parser.add_argument("--kb-k", type=int, default=10)
+    parser.add_argument("--fetch-k", type=int, default=int(os.getenv("MMR_FETCH_K", 50)))
+    parser.add_argument("--lambda-mult", type=float, default=float(os.getenv("MMR_LAMBDA", 0.5)))
+    parser.add_argument("--judge-latency-ms", type=float, default=800.0)
+    parser.add_argument("--external-latency-ms", type=float, default=1500.0)
+    parser.add_argument("--sufficient-rate", type=float, default=0.7, help="Fraction of queries the simulated judge finds sufficient")
+    parser.add_argument("--database-uri", default=os.getenv("BENCHMARK_DATABASE_URI"),
+                        help="Benchmark pg_vector_mmr against pgvector in this database (temporary collections) instead of in memory")
+    parser.add_argument("--ef-search", type=int, default=os.getenv("ANN_EF_SEARCH"))
+    parser.add_argument("--keep-collections", action="store_true")
+    parser.add_argument("--in-process", action="store_true", help="Run every case in this process (peak memory is then cumulative)")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "reports", f"retrieval-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    parser.add_argument("--baseline", help="Previous report to compare against; exits non-zero on regressions")
+    parser.add_argument("--max-latency-regression", type=float, default=0.25, help="Allowed relative p99 increase")
+    parser.add_argument("--max-recall-drop", type=float, default=0.01)
+    args = parser.parse_args()
+
+    if args.database_uri and args.dims and args.dims != EMBEDDING_DIMENSIONS:
+        parser.error(f"langchain_pg_embedding stores vector({EMBEDDING_DIMENSIONS}), so --dims must match against Postgres")
+
+    settings = {
+        "dims": args.dims or (EMBEDDING_DIMENSIONS if args.database_uri else 256),
+        "queries": args.queries,
+        "warmup": args.warmup,
+        "location_k": args.location_k,
+        "kb_k": args.kb_k,
+        "fetch_k": args.fetch_k,
+        "lambda_mult": args.lambda_mult,
+        "judge_latency_ms": args.judge_latency_ms,
+        "external_latency_ms": args.external_latency_ms,
+        "sufficient_rate": args.sufficient_rate,
+        "database_uri": args.database_uri,
+        "ef_search": args.ef_search,
+        "keep_collections": args.keep_collections,
+    }
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    retrievers = [name.strip() for name in args.retrievers.split(",")]
+    unknown = set(retrievers) - set(RETRIEVERS)
+    if unknown:
+        parser.error(f"Unknown retrievers: {', '.join(sorted(unknown))}")
+
+    results = []
+    for rows in scales:
+        for retriever_name in retrievers:
+            print(f"==> {retriever_name} @ {rows} rows, {settings['dims']} dims", flush=True)
+
+            try:
+                if args.in_process:
+                    result = run_case(retriever_name, rows, settings)
+                else:
+                    # A fresh interpreter per case, so peak memory belongs to that case alone
+                    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                        result = executor.submit(run_case, retriever_name, rows, settings).result()
+            except Exception as e:
+                print(f"{retriever_name} @ {rows} rows failed: {e}", flush=True)
+                result = {"retriever": retriever_name, "rows": rows, "dims": settings["dims"], "error": str(e)}
+            else:
+                print(
+                    f"build {result['build_seconds']:.2f}s, p50 {result['latency_ms']['p50']:.2f}ms, p99 {result['latency_ms']['p99']:.2f}ms, "
+                    f"recall@{result['k']} {result['recall_at_k']:.3f}, peak RSS {result['peak_rss_mb']:.0f}MB",
+                    flush=True,
+                )
+
+            results.append(result)
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {**settings, "database_uri": bool(settings["database_uri"])},
+        "results": results,
+    }
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    failed = any("error" in result for result in results)
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.max_latency_regression, args.max_recall_drop)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        failed = failed or bool(regressions)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
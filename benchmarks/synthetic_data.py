@@ -0,0 +1,151 @@
+import hashlib
+import uuid
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from retrievers.TableColumnRetriever import top_k_indices
+
+# Column order of the location rows loaded by build_table_column_retriever
+LOCATION_COLUMNS = ["id", "name", "address", "city", "state", "country", "zip_code", "latitude", "longitude", "description", "phone", "sunday_hours", "monday_hours",
+                    "tuesday_hours", "wednesday_hours", "thursday_hours", "friday_hours", "saturday_hours", "rating", "address_link", "website", "resource_type", "county"]
+
+# (city, county, latitude, longitude) the synthetic locations are scattered around
+CITIES = [
+    ("Houston", "Harris", 29.7604, -95.3698),
+    ("Dallas", "Dallas", 32.7767, -96.7970),
+    ("Austin", "Travis", 30.2672, -97.7431),
+    ("San Antonio", "Bexar", 29.4241, -98.4936),
+    ("Fort Worth", "Tarrant", 32.7555, -97.3308),
+    ("El Paso", "El Paso", 31.7619, -106.4850),
+    ("Bryan", "Brazos", 30.6744, -96.3700),
+    ("Lubbock", "Lubbock", 33.5779, -101.8552),
+    ("Laredo", "Webb", 27.5306, -99.4803),
+    ("Corpus Christi", "Nueces", 27.8006, -97.3964),
+    ("Amarillo", "Potter", 35.2220, -101.8313),
+    ("Waco", "McLennan", 31.5493, -97.1467),
+]
+
+RESOURCE_TYPES = ["clinic", "food bank", "lactation support", "WIC office", "counseling", "shelter", "pediatrics", "parenting class"]
+TOPICS = ["breastfeeding", "postpartum depression", "prenatal care", "safe sleep", "car seats", "vaccines", "nutrition", "developmental milestones"]
+
+NAMESPACE = uuid.UUID("0e7a2b35-3f4c-4d8e-8a51-6c4f3b2d1a90")
+
+def clustered_vectors(n, dims, seed, chunk_size=50000):
+    '''
+    n deterministic float32 vectors grouped around sqrt(n) random centers, so nearest-neighbour structure looks like
+    real embeddings (dense topical clusters) rather than uniform noise. Generated chunk by chunk into one matrix so
+    peak memory stays close to the size of the result.
+    '''
+    cluster_count = max(16, int(np.sqrt(n)))
+    centers = np.random.default_rng(seed).standard_normal((cluster_count, dims), dtype=np.float32)
+
+    vectors = np.empty((n, dims), dtype=np.float32)
+    for chunk_index, start in enumerate(range(0, n, chunk_size)):
+        rng = np.random.default_rng([seed, chunk_index])
+        end = min(start + chunk_size, n)
+
+        clusters = rng.integers(0, cluster_count, end - start)
+        vectors[start:end] = centers[clusters]
+        vectors[start:end] += 0.6 * rng.standard_normal((end - start, dims), dtype=np.float32)
+
+    return vectors
+
+def query_vectors(corpus_vectors, anchors, seed, noise=0.8):
+    '''
+    Queries drawn near the given anchor rows, so every query has a meaningful neighbourhood to recall
+    '''
+    rng = np.random.default_rng(seed)
+    return corpus_vectors[anchors] + noise * rng.standard_normal((len(anchors), corpus_vectors.shape[1]), dtype=np.float32)
+
+def location_documents(n, seed):
+    '''
+    n "##" delimited location rows in the layout build_table_column_retriever produces
+    '''
+    rng = np.random.default_rng(seed)
+    cities = rng.integers(0, len(CITIES), n)
+    offsets = rng.normal(0.0, 0.15, (n, 2))
+    resource_types = rng.integers(0, len(RESOURCE_TYPES), n)
+    ratings = rng.uniform(1.0, 5.0, n)
+
+    documents = []
+    for i in range(n):
+        city, county, latitude, longitude = CITIES[cities[i]]
+        resource_type = RESOURCE_TYPES[resource_types[i]]
+        hours = ["9:00 AM - 5:00 PM"] * 7
+
+        values = [
+            str(i), f"{city} {resource_type} {i}", f"{100 + i % 9900} Main St", city, "TX", "USA", f"7{i % 10000:04d}",
+            f"{latitude + offsets[i, 0]:.6f}", f"{longitude + offsets[i, 1]:.6f}", f"A {resource_type} serving families in {county} County",
+            f"(555) {i % 1000:03d}-{i % 10000:04d}", *hours, f"{ratings[i]:.1f}", "", f"https://example.org/{i}", resource_type, county,
+        ]
+        documents.append(Document(page_content="##".join(values)))
+
+    return documents
+
+def kb_chunks(n, seed):
+    '''
+    n knowledge base chunks as (id, document, cmetadata) tuples, the columns PGVectorMMRRetriever reads
+    '''
+    rng = np.random.default_rng(seed)
+    topics = rng.integers(0, len(TOPICS), n)
+
+    return [
+        (str(uuid.uuid5(NAMESPACE, f"{seed}:{i}")), f"Chunk {i} of the {TOPICS[topics[i]]} guide. " * 4, {"source": f"{TOPICS[topics[i]]}.txt", "chunk": i})
+        for i in range(n)
+    ]
+
+def location_queries(count, seed):
+    '''
+    (query text, named city or None) for the location retriever. Half of the queries name a city, which routes them
+    through the spatial index.
+    '''
+    rng = np.random.default_rng(seed)
+
+    queries = []
+    for j in range(count):
+        resource_type = RESOURCE_TYPES[rng.integers(len(RESOURCE_TYPES))]
+        if j % 2 == 0:
+            city = CITIES[rng.integers(len(CITIES))][0]
+            queries.append((f"{resource_type} in {city} #{j}", city))
+        else:
+            queries.append((f"{resource_type} near me #{j}", None))
+    return queries
+
+def kb_queries(count, seed):
+    rng = np.random.default_rng(seed)
+    return [f"What should I know about {TOPICS[rng.integers(len(TOPICS))]}? #{j}" for j in range(count)]
+
+class FakeEmbeddings(Embeddings):
+    '''
+    Deterministic stand-in for OpenAIEmbeddings. Texts registered up front (the benchmark queries) map to their
+    prepared vectors; any other text gets a vector seeded from its hash, so the same text always embeds the same way.
+    '''
+
+    def __init__(self, dims, known_vectors: Dict[str, np.ndarray] = None):
+        self.dims = dims
+        self.known_vectors = known_vectors or {}
+
+    def _embed(self, text):
+        vector = self.known_vectors.get(text)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dims, dtype=np.float32)
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+def exact_top_k(normalized_matrix, queries, k, query_chunk_size=64):
+    '''
+    Ground truth: exact cosine top-k row indices for each query, best first, computed in query chunks to bound memory
+    '''
+    return np.concatenate([
+        top_k_indices(normalized_matrix, queries[start:start + query_chunk_size], k)
+        for start in range(0, len(queries), query_chunk_size)
+    ])
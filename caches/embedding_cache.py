@@ -0,0 +1,380 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from sqlalchemy import text
+
+from connection_pool import shared_engine
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(query):
+    '''
+    Normalize text before keying the cache so trivial variations ("Dental services in Bryan " vs "dental services in bryan")
+    share one entry. Casing, repeated whitespace and trailing punctuation do not change what we want to embed.
+    '''
+    return re.sub(r"\s+", " ", query).strip().rstrip("?.!").strip().casefold()
+
+def cache_key(model_name, query):
+    return hashlib.sha256(f"{model_name}\x00{normalize_text(query)}".encode("utf-8")).hexdigest()
+
+def document_cache_key(model_name, document):
+    '''
+    Documents are keyed on their exact text: casing and punctuation are part of what a stored chunk says
+    '''
+    return hashlib.sha256(f"{model_name}\x00document\x00{document}".encode("utf-8")).hexdigest()
+
+class PostgresEmbeddingStore:
+    '''
+    Persistent cache tier backed by an embedding_cache table so cached vectors survive restarts and are shared by every worker
+    '''
+
+    def __init__(self, connection_uri, table_name="embedding_cache"):
+        self.engine = shared_engine(connection_uri)
+        self.table_name = table_name
+
+        with self.engine.begin() as conn:
+            conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                embedding BYTEA NOT NULL,
+                created_at DOUBLE PRECISION NOT NULL
+            );
+            """))
+
+    def get(self, key, ttl_seconds):
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text(f"SELECT embedding, created_at FROM {self.table_name} WHERE cache_key = :key"),
+                {"key": key},
+            ).first()
+
+        if row is None or (ttl_seconds and time.time() - row.created_at > ttl_seconds):
+            return None
+
+        return np.frombuffer(row.embedding, dtype=np.float32).tolist()
+
+    def get_many(self, keys, ttl_seconds):
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(f"SELECT cache_key, embedding, created_at FROM {self.table_name} WHERE cache_key = ANY(:keys)"),
+                {"keys": list(keys)},
+            ).fetchall()
+
+        now = time.time()
+        return {
+            row.cache_key: np.frombuffer(row.embedding, dtype=np.float32).tolist()
+            for row in rows
+            if not ttl_seconds or now - row.created_at <= ttl_seconds
+        }
+
+    def set(self, key, model_name, vector):
+        with self.engine.begin() as conn:
+            conn.execute(text(f"""
+            INSERT INTO {self.table_name} (cache_key, model, embedding, created_at)
+            VALUES (:key, :model, :embedding, :created_at)
+            ON CONFLICT (cache_key) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = EXCLUDED.created_at;
+            """), {"key": key, "model": model_name, "embedding": np.asarray(vector, dtype=np.float32).tobytes(), "created_at": time.time()})
+
+    def set_many(self, items, model_name):
+        '''
+        Upsert (key, vector) pairs in one transaction with a single executemany
+        '''
+        now = time.time()
+        rows = [{"key": key, "model": model_name, "embedding": np.asarray(vector, dtype=np.float32).tobytes(), "created_at": now} for key, vector in items]
+        if not rows:
+            return
+
+        with self.engine.begin() as conn:
+            conn.execute(text(f"""
+            INSERT INTO {self.table_name} (cache_key, model, embedding, created_at)
+            VALUES (:key, :model, :embedding, :created_at)
+            ON CONFLICT (cache_key) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = EXCLUDED.created_at;
+            """), rows)
+
+class FileEmbeddingStore:
+    '''
+    Persistent cache tier backed by a local SQLite file, useful for the preprocessing scripts and local development
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.conn:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """)
+
+    def get(self, key, ttl_seconds):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT embedding, created_at FROM embedding_cache WHERE cache_key = ?", (key,)
+            ).fetchone()
+
+        if row is None or (ttl_seconds and time.time() - row[1] > ttl_seconds):
+            return None
+
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def get_many(self, keys, ttl_seconds, chunk_size=500):
+        keys = list(keys)
+        rows = []
+
+        # Chunked to stay under SQLite's bound parameter limit
+        with self.lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                rows.extend(self.conn.execute(
+                    f"SELECT cache_key, embedding, created_at FROM embedding_cache WHERE cache_key IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall())
+
+        now = time.time()
+        return {
+            key: np.frombuffer(embedding, dtype=np.float32).tolist()
+            for key, embedding, created_at in rows
+            if not ttl_seconds or now - created_at <= ttl_seconds
+        }
+
+    def set(self, key, model_name, vector):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO embedding_cache (cache_key, model, embedding, created_at) VALUES (?, ?, ?, ?)",
+                (key, model_name, np.asarray(vector, dtype=np.float32).tobytes(), time.time()),
+            )
+
+    def set_many(self, items, model_name):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (cache_key, model, embedding, created_at) VALUES (?, ?, ?, ?)",
+                [(key, model_name, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items],
+            )
+
+class EmbeddingCache:
+    '''
+    In-process LRU with a TTL, optionally backed by a persistent store (PostgresEmbeddingStore or FileEmbeddingStore).
+    Lookups check memory first, then the persistent tier, and promote persistent hits into memory.
+    '''
+
+    def __init__(self, max_entries=10000, ttl_seconds=7 * 24 * 60 * 60, persistent_store=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.persistent_store = persistent_store
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                vector, created_at = entry
+                if not self.ttl_seconds or now - created_at <= self.ttl_seconds:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return vector
+
+                del self.entries[key]
+
+        if self.persistent_store is not None:
+            try:
+                vector = self.persistent_store.get(key, self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"Embedding cache persistent lookup failed: {e}")
+                vector = None
+
+            if vector is not None:
+                self._set_local(key, vector, now)
+                with self.lock:
+                    self.persistent_hits += 1
+                return vector
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def get_many(self, keys):
+        '''
+        key -> vector for the keys found in memory or, with a single batched query, in the persistent tier
+        '''
+        now = time.time()
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+
+                vector, created_at = entry
+                if not self.ttl_seconds or now - created_at <= self.ttl_seconds:
+                    self.entries.move_to_end(key)
+                    found[key] = vector
+                else:
+                    del self.entries[key]
+
+            self.hits += len(found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+
+        if missing and self.persistent_store is not None:
+            try:
+                stored = self.persistent_store.get_many(missing, self.ttl_seconds)
+            except Exception as e:
+                logger.warning(f"Embedding cache persistent lookup failed: {e}")
+                stored = {}
+
+            for key, vector in stored.items():
+                self._set_local(key, vector, now)
+            found.update(stored)
+
+            with self.lock:
+                self.persistent_hits += len(stored)
+
+        with self.lock:
+            self.misses += sum(1 for key in missing if key not in found)
+
+        return found
+
+    def set(self, key, model_name, vector):
+        self._set_local(key, vector, time.time())
+
+        if self.persistent_store is not None:
+            try:
+                self.persistent_store.set(key, model_name, vector)
+            except Exception as e:
+                logger.warning(f"Embedding cache persistent write failed: {e}")
+
+    def set_many(self, items, model_name):
+        '''
+        Store several (key, vector) pairs, writing them to the persistent tier in one batch
+        '''
+        items = list(items)
+        now = time.time()
+        for key, vector in items:
+            self._set_local(key, vector, now)
+
+        if items and self.persistent_store is not None:
+            try:
+                self.persistent_store.set_many(items, model_name)
+            except Exception as e:
+                logger.warning(f"Embedding cache persistent write failed: {e}")
+
+    def _set_local(self, key, vector, created_at):
+        with self.lock:
+            self.entries[key] = (vector, created_at)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Drop-in Embeddings wrapper that answers repeat queries from an EmbeddingCache instead of calling the provider again.
+    Keys combine the text and the underlying model name, so switching models never returns stale vectors. Query keys
+    use the normalized text, document keys the exact text.
+    '''
+
+    def __init__(self, embeddings_model, cache):
+        self.embeddings_model = embeddings_model
+        self.cache = cache
+        self.model_name = getattr(embeddings_model, "model", None) or type(embeddings_model).__name__
+
+    def embed_query(self, query: str) -> List[float]:
+        key = cache_key(self.model_name, query)
+
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings_model.embed_query(query)
+            self.cache.set(key, self.model_name, vector)
+
+        return vector
+
+    async def aembed_query(self, query: str) -> List[float]:
+        key = cache_key(self.model_name, query)
+
+        # The persistent tier is a blocking database or file read, kept off the event loop
+        vector = await asyncio.to_thread(self.cache.get, key)
+        if vector is None:
+            vector = await self.embeddings_model.aembed_query(query)
+            await asyncio.to_thread(self.cache.set, key, self.model_name, vector)
+
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [document_cache_key(self.model_name, t) for t in texts]
+        cached = self.cache.get_many(keys)
+        vectors = [cached.get(key) for key in keys]
+
+        # Only send the (deduplicated) misses to the provider, in one batched request
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], i)
+
+        if missing:
+            embedded = self.embeddings_model.embed_documents([texts[i] for i in missing.values()])
+            self.cache.set_many(zip(missing, embedded), self.model_name)
+
+            embedded_by_key = dict(zip(missing, embedded))
+            vectors = [vector if vector is not None else embedded_by_key[key] for key, vector in zip(keys, vectors)]
+
+        return vectors
+
+def build_cached_embeddings(embeddings_model, connection_uri=None):
+    '''
+    Wrap an embeddings model with the cache configured through the environment:
+      EMBEDDING_CACHE_SIZE   max in-process entries (default 10000)
+      EMBEDDING_CACHE_TTL    seconds before an entry expires (default 7 days, 0 disables expiry)
+      EMBEDDING_CACHE_BACKEND  "postgres", "file" or "none" (default) for the persistent tier
+      EMBEDDING_CACHE_PATH   SQLite file used by the "file" backend
+    '''
+    backend = os.getenv("EMBEDDING_CACHE_BACKEND", "none").lower()
+
+    persistent_store = None
+    if backend == "postgres" and connection_uri:
+        persistent_store = PostgresEmbeddingStore(connection_uri)
+    elif backend == "file":
+        persistent_store = FileEmbeddingStore(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3"))
+
+    cache = EmbeddingCache(
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", 10000)),
+        ttl_seconds=int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 60 * 60)),
+        persistent_store=persistent_store,
+    )
+
+    return CachedEmbeddings(embeddings_model, cache)
@@ -0,0 +1,83 @@
+import logging
+import threading
+import time
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+class LocationJSONCache:
+    '''
+    Pre-serialized location JSON keyed by location id.
+
+    version_fn returns the current version of the location table (bumped by a trigger on every write, see
+    init_db.ensure_table_version_triggers). It is polled at most every check_interval seconds, and the cache is
+    cleared whenever the version moves. If the version cannot be read the cache is bypassed.
+    '''
+
+    def __init__(self, version_fn, check_interval=5, max_entries=50000):
+        self.version_fn = version_fn
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.version = None
+        self.last_check = 0.0
+
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        '''
+        Returns False when the table version is unknown and the cache must not be used
+        '''
+        if time.time() - self.last_check < self.check_interval:
+            return self.version is not None
+
+        try:
+            version = self.version_fn()
+        except Exception as e:
+            logger.warning(f"Could not read location table version, bypassing location cache: {e}")
+            version = None
+
+        with self.lock:
+            self.last_check = time.time()
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+        return version is not None
+
+    def get_many(self, ids):
+        with self.lock:
+            found = {id: self.entries[id] for id in ids if id in self.entries}
+            self.hits += len(found)
+            self.misses += len(set(ids)) - len(found)
+            return found
+
+    def set_many(self, serialized):
+        with self.lock:
+            if len(self.entries) + len(serialized) > self.max_entries:
+                self.entries.clear()
+            self.entries.update(serialized)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "version": self.version}
+
+def serialize_location(location):
+    return orjson.dumps({
+        'id': location.id,
+        'address': location.address + ", " + location.city + ", " + location.state + " " + str(int(location.zip_code)),
+        'addressLink': location.address_link,
+        'description': location.description,
+        'latitude': float(location.latitude),
+        'longitude': float(location.longitude),
+        'website': location.website,
+        'name': location.name,
+        'phone': location.phone,
+        'hoursOfOperation': [{"sunday": location.sunday_hours}, {"monday": location.monday_hours}, {"tuesday": location.tuesday_hours}, {"wednesday": location.wednesday_hours}, {"thursday": location.thursday_hours}, {"friday": location.friday_hours}, {"saturday": location.saturday_hours}],
+        'rating': float(location.rating) if (location.rating and location.rating.isalnum()) else None,
+        'isSaved': False
+    })
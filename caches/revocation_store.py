@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+class BloomFilter:
+    '''
+    Fixed-size bloom filter over strings. No false negatives, roughly false_positive_rate false positives at capacity.
+    '''
+
+    def __init__(self, capacity, false_positive_rate=0.001):
+        self.capacity = max(capacity, 1)
+        self.bit_count = max(int(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2), 64)
+        self.hash_count = max(int(round(self.bit_count / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+class RevocationStore:
+    '''
+    Revoked JWT ids shared by every worker through the revoked_token table, each kept only until the token itself
+    expires.
+
+    Every process keeps a bloom filter of the live revoked ids, so the common case (a token that was never revoked)
+    is answered locally without I/O. Only bloom filter hits are confirmed against Postgres. The filter picks up
+    revocations from other workers with an incremental sync at most every sync_interval seconds, and is rebuilt from
+    the live rows (dropping expired ones, which are also deleted) every rebuild_interval seconds or when it fills up,
+    so memory stays proportional to the number of live revoked tokens.
+
+    engine_fn returns the engine to use; it is resolved lazily so the store can be created before the app is configured.
+    '''
+
+    def __init__(self, engine_fn, sync_interval=2.0, rebuild_interval=300.0, min_capacity=1024, false_positive_rate=0.001):
+        self.engine_fn = engine_fn
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.min_capacity = min_capacity
+        self.false_positive_rate = false_positive_rate
+
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.synced_through = 0.0
+        self.last_sync = 0.0
+        self.last_rebuild = 0.0
+
+        self.local_negatives = 0
+        self.confirmations = 0
+        self.false_positives = 0
+
+    def add(self, jti, expires_at):
+        '''
+        Revoke a token until expires_at (epoch seconds, e.g. the token's exp claim)
+        '''
+        with self.engine_fn().begin() as conn:
+            conn.execute(text("""
+            INSERT INTO revoked_token (jti, expires_at, revoked_at) VALUES (:jti, :expires_at, :revoked_at)
+            ON CONFLICT (jti) DO UPDATE SET expires_at = GREATEST(revoked_token.expires_at, EXCLUDED.expires_at)
+            """), {"jti": jti, "expires_at": expires_at, "revoked_at": time.time()})
+
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(jti)
+
+    def __contains__(self, jti):
+        self._sync()
+
+        with self.lock:
+            bloom = self.bloom
+
+        if bloom is not None and jti not in bloom:
+            with self.lock:
+                self.local_negatives += 1
+            return False
+
+        try:
+            with self.engine_fn().connect() as conn:
+                revoked = conn.execute(
+                    text("SELECT 1 FROM revoked_token WHERE jti = :jti AND expires_at > :now"), {"jti": jti, "now": time.time()}
+                ).first() is not None
+        except Exception as e:
+            # Fail closed: a token we cannot clear is treated as revoked
+            logger.warning(f"Could not check token revocation, rejecting token: {e}")
+            return True
+
+        with self.lock:
+            self.confirmations += 1
+            self.false_positives += int(not revoked)
+
+        return revoked
+
+    def _sync(self):
+        now = time.time()
+        if now - self.last_sync < self.sync_interval:
+            return
+
+        with self.lock:
+            rebuild = self.bloom is None or now - self.last_rebuild >= self.rebuild_interval or self.bloom.count >= self.bloom.capacity
+            synced_through = self.synced_through
+            # Claim this sync so concurrent lookups keep using the current filter instead of syncing too
+            self.last_sync = now
+
+        try:
+            if rebuild:
+                self._rebuild(now)
+                return
+
+            # A second of overlap covers rows committed out of order by other workers
+            with self.engine_fn().connect() as conn:
+                rows = conn.execute(text("""
+                SELECT jti, revoked_at FROM revoked_token WHERE revoked_at > :since AND expires_at > :now
+                """), {"since": synced_through - 1.0, "now": now}).fetchall()
+
+            with self.lock:
+                for row in rows:
+                    self.bloom.add(row.jti)
+                    self.synced_through = max(self.synced_through, row.revoked_at)
+        except Exception as e:
+            logger.warning(f"Token revocation sync failed, keeping the current filter: {e}")
+
+    def _rebuild(self, now):
+        with self.engine_fn().begin() as conn:
+            conn.execute(text("DELETE FROM revoked_token WHERE expires_at <= :now"), {"now": now})
+            rows = conn.execute(text("SELECT jti, revoked_at FROM revoked_token")).fetchall()
+
+        # Leave room to keep adding revocations until the next scheduled rebuild
+        bloom = BloomFilter(max(len(rows) * 2, self.min_capacity), self.false_positive_rate)
+        for row in rows:
+            bloom.add(row.jti)
+
+        with self.lock:
+            self.bloom = bloom
+            self.synced_through = max((row.revoked_at for row in rows), default=now)
+            self.last_rebuild = now
+
+    def stats(self):
+        with self.lock:
+            return {
+                "bloom_entries": self.bloom.count if self.bloom else 0,
+                "bloom_bytes": len(self.bloom.bits) if self.bloom else 0,
+                "local_negatives": self.local_negatives,
+                "confirmations": self.confirmations,
+                "false_positives": self.false_positives,
+            }
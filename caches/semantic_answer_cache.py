@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import text
+
+from connection_pool import shared_engine
+
+logger = logging.getLogger(__name__)
+
+_UNCHECKED = object()
+
+class SemanticAnswerCache:
+    '''
+    Caches final answers keyed on the embedding of the summarized query produced by determine_search_type.
+
+    A lookup hits when a cached entry for the same route, allow_external flag, named places and user location (rounded
+    to location_decimals) is within max_distance (cosine distance) of the new query. Entries expire after ttl_seconds, the least recently used entries are evicted past max_entries,
+    and the whole cache is dropped whenever fingerprint_fn (e.g. the active pgvector collection) returns a new value.
+    '''
+
+    def __init__(self, max_entries=1000, ttl_seconds=60 * 60, max_distance=0.05, fingerprint_fn=None, fingerprint_check_interval=30, location_decimals=2):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.location_decimals = location_decimals
+        self.fingerprint_fn = fingerprint_fn
+        self.fingerprint_check_interval = fingerprint_check_interval
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.next_id = 0
+
+        # (route, allow_external, location) -> (entry ids, normalized matrix), rebuilt lazily after writes
+        self.partitions = {}
+
+        self.fingerprint = _UNCHECKED
+        self.last_fingerprint_check = 0.0
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query_vector, route, allow_external, location=None, places=None):
+        self._check_fingerprint()
+
+        query = _normalize(query_vector)
+        partition_key = self._partition_key(route, allow_external, location, places)
+
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+
+            entry_ids, matrix = self._partition(partition_key)
+            if len(entry_ids):
+                similarities = matrix @ query
+                best = int(np.argmax(similarities))
+
+                if 1.0 - similarities[best] <= self.max_distance:
+                    entry_id = entry_ids[best]
+                    entry = self.entries[entry_id]
+
+                    # _expire only clears the least recently used end, so a recently hit entry can still be stale
+                    if self.ttl_seconds and now - entry["created_at"] > self.ttl_seconds:
+                        del self.entries[entry_id]
+                        self.partitions.pop(partition_key, None)
+                    else:
+                        self.entries.move_to_end(entry_id)
+                        self.hits += 1
+                        return entry["value"]
+
+            self.misses += 1
+            return None
+
+    def store(self, query_vector, route, allow_external, value, location=None, places=None):
+        partition_key = self._partition_key(route, allow_external, location, places)
+
+        with self.lock:
+            self.entries[self.next_id] = {
+                "partition": partition_key,
+                "vector": _normalize(query_vector),
+                "value": value,
+                "created_at": time.time(),
+            }
+            self.next_id += 1
+
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.partitions.pop(evicted["partition"], None)
+
+            self.partitions.pop(partition_key, None)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.partitions.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
+
+    def _partition_key(self, route, allow_external, location, places):
+        '''
+        location is the (latitude, longitude) the answer was narrowed to, or None. Two decimals is roughly 1 km.
+        places are the place names resolved from the query, so "WIC office in Bryan" never answers "WIC office in Waco".
+        '''
+        if location is not None:
+            location = (round(location[0], self.location_decimals), round(location[1], self.location_decimals))
+        return (route, bool(allow_external), location, tuple(sorted(places or ())))
+
+    def _partition(self, partition_key):
+        partition = self.partitions.get(partition_key)
+        if partition is None:
+            entry_ids = [entry_id for entry_id, entry in self.entries.items() if entry["partition"] == partition_key]
+            matrix = np.stack([self.entries[entry_id]["vector"] for entry_id in entry_ids]) if entry_ids else None
+            partition = self.partitions[partition_key] = (entry_ids, matrix)
+
+        return partition
+
+    def _expire(self, now):
+        if not self.ttl_seconds:
+            return
+
+        # Entries are in least recently used order, so stop at the first live one instead of scanning them all
+        while self.entries:
+            entry_id, entry = next(iter(self.entries.items()))
+            if now - entry["created_at"] <= self.ttl_seconds:
+                break
+
+            del self.entries[entry_id]
+            self.partitions.pop(entry["partition"], None)
+
+    def _check_fingerprint(self):
+        if self.fingerprint_fn is None or time.time() - self.last_fingerprint_check < self.fingerprint_check_interval:
+            return
+
+        self.last_fingerprint_check = time.time()
+
+        try:
+            fingerprint = self.fingerprint_fn()
+        except Exception as e:
+            logger.warning(f"Answer cache fingerprint check failed: {e}")
+            return
+
+        if fingerprint != self.fingerprint:
+            if self.fingerprint is not _UNCHECKED:
+                logger.info("Active collection changed, invalidating answer cache")
+                self.invalidate()
+            self.fingerprint = fingerprint
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def build_semantic_answer_cache(connection_uri, collection_name):
+    '''
+    Build the answer cache configured through the environment:
+      ANSWER_CACHE_SIZE          max cached answers (default 1000)
+      ANSWER_CACHE_TTL           seconds before an answer expires (default 1 hour)
+      ANSWER_CACHE_MAX_DISTANCE  max cosine distance for a hit (default 0.05)
+      ANSWER_CACHE_LOCATION_DECIMALS  decimals user coordinates are rounded to in the cache key (default 2)
+
+    The cache is invalidated whenever the row for collection_name in langchain_pg_collection changes (a new uuid from a
+    re-index or updated cmetadata from an incremental load).
+    '''
+    engine = shared_engine(connection_uri)
+
+    def collection_fingerprint():
+        with engine.connect() as conn:
+            row = conn.execute(
+                text("SELECT uuid::text, cmetadata::text FROM langchain_pg_collection WHERE name = :name"),
+                {"name": collection_name},
+            ).first()
+
+        return tuple(row) if row else None
+
+    return SemanticAnswerCache(
+        max_entries=int(os.getenv("ANSWER_CACHE_SIZE", 1000)),
+        ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL", 60 * 60)),
+        max_distance=float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", 0.05)),
+        fingerprint_fn=collection_fingerprint,
+        location_decimals=int(os.getenv("ANSWER_CACHE_LOCATION_DECIMALS", 2)),
+    )
@@ -1,59 +1,301 @@
+import os
+import threading
+import time
+
 from langchain_core.retrievers import BaseRetriever
 from langchain.memory import ConversationBufferMemory
-from langchain_community.chat_message_histories import SQLChatMessageHistory
-from langchain.chains import ConversationalRetrievalChain
+from langchain.chains import ConversationalRetrievalChain, LLMChain
+from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+from langchain.chains.question_answering import load_qa_chain
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
 from retrievers.ContextDecidingRetriever import ContextDecidingRetriever
+from history.conversation_history import WindowedChatMessageHistory
+from observability import LLMUsageCallbackHandler
+
+# ---------------- Stream handler ----------------
+class StreamMetrics:
+    '''
+    Process-wide streaming counters: socket emits per answer and handler CPU time per streamed token
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.answers = 0
+        self.tokens = 0
+        self.emits = 0
+        self.deferred_frames = 0
+        self.ack_fallbacks = 0
+        self.cpu_seconds = 0.0
+
+    def record_answer(self, tokens, emits, deferred_frames, ack_fallback, cpu_seconds):
+        with self.lock:
+            self.answers += 1
+            self.tokens += tokens
+            self.emits += emits
+            self.deferred_frames += deferred_frames
+            self.ack_fallbacks += int(ack_fallback)
+            self.cpu_seconds += cpu_seconds
+
+    def stats(self):
+        with self.lock:
+            return {
+                "answers": self.answers,
+                "tokens": self.tokens,
+                "emits": self.emits,
+                "emits_per_answer": self.emits / self.answers if self.answers else 0.0,
+                "tokens_per_emit": self.tokens / self.emits if self.emits else 0.0,
+                "cpu_us_per_token": 1e6 * self.cpu_seconds / self.tokens if self.tokens else 0.0,
+                "deferred_frames": self.deferred_frames,
+                "ack_fallbacks": self.ack_fallbacks,
+            }
+
+stream_metrics = StreamMetrics()
 
-# ---------------- Stream handler (unchanged) ----------------
 class StreamCallbackHandler(StreamingStdOutCallbackHandler):
-    def __init__(self, socketio_instance=None, *args, **kwargs):
+    '''
+    Streams answer tokens to a single client (its Socket.IO sid or a room), never to every connected client.
+
+    Tokens are coalesced into one stream_data frame per flush_interval seconds or flush_chars characters.
+    When the target is a sid, each frame asks the client for an ack; while max_unacked frames are outstanding new
+    tokens keep accumulating into the next frame instead of queueing more emits for a slow client. A client that
+    never acks (older frontends, room targets) drops the handler back to plain time/size coalescing after ack_timeout.
+    Without a target nothing is streamed; the full answer is still returned in the HTTP response.
+    '''
+
+    def __init__(self, socketio_instance=None, to=None, flush_interval=0.05, flush_chars=64, echo=False,
+                 max_unacked=4, ack_timeout=2.0, metrics=stream_metrics, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.socketio = socketio_instance
+        # Async runs would otherwise call this sync handler from an executor, which can reorder tokens
+        self.run_inline = True
+        self.socketio = socketio_instance if to else None
+        self.to = to
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self.echo = echo
+        self.max_unacked = max_unacked
+        self.ack_timeout = ack_timeout
+        self.metrics = metrics
 
-    def on_chain_start(self, serialized, prompts, **kwargs) -> None:
-        if self.socketio:
-            self.socketio.emit('stream_start')
+        self.buffer = []
+        self.buffered_chars = 0
+        self.last_flush = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.unacked = 0
+        self.last_ack = None
+        self.first_unacked_at = None
+        self.use_acks = max_unacked > 0
+
+        self.tokens = 0
+        self.emits = 0
+        self.deferred_frames = 0
+        self.ack_fallback = False
+        self.cpu_seconds = 0.0
+
+    # The handler is passed through the run config, so it sees every nested chain; only the outermost one marks the stream
+    def on_chain_start(self, serialized, prompts, *, parent_run_id=None, **kwargs) -> None:
+        if self.socketio and parent_run_id is None:
+            self.emit('stream_start')
 
     def on_llm_new_token(self, token, **kwargs) -> None:
-        print(token, end='', flush=True)
+        start_cpu = time.thread_time()
+
+        if self.echo:
+            print(token, end='', flush=True)
+
+        self.tokens += 1
         if self.socketio:
-            self.socketio.emit('stream_data', token)
+            self.buffer.append(token)
+            self.buffered_chars += len(token)
+
+            if self.buffered_chars >= self.flush_chars or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+        self.cpu_seconds += time.thread_time() - start_cpu
+
+    def on_chain_end(self, response, *, parent_run_id=None, **kwargs) -> None:
+        if parent_run_id is None:
+            self.finish()
+
+    def on_chain_error(self, error, *, parent_run_id=None, **kwargs) -> None:
+        if parent_run_id is None:
+            self.finish()
+
+    def flush(self, force=False):
+        if not self.buffer:
+            return
+
+        if not force and not self.ready_for_frame():
+            # Slow client: keep growing the pending frame rather than queueing another emit
+            self.deferred_frames += 1
+            return
+
+        frame = "".join(self.buffer)
+        self.buffer.clear()
+        self.buffered_chars = 0
+        self.last_flush = time.monotonic()
+
+        if self.use_acks:
+            with self.lock:
+                if self.unacked == 0:
+                    self.first_unacked_at = self.last_flush
+                self.unacked += 1
+            self.emit('stream_data', frame, callback=self.on_ack)
+        else:
+            self.emit('stream_data', frame)
+
+    def ready_for_frame(self):
+        if not self.use_acks:
+            return True
+
+        with self.lock:
+            if self.unacked < self.max_unacked:
+                return True
+
+            # No ack since the oldest outstanding frame was sent: the client does not ack, stop waiting for it
+            waited = time.monotonic() - (self.last_ack or self.first_unacked_at)
+            if waited >= self.ack_timeout:
+                self.use_acks = False
+                self.ack_fallback = True
+                return True
+
+        return False
+
+    def on_ack(self, *args):
+        with self.lock:
+            self.unacked = max(self.unacked - 1, 0)
+            self.last_ack = time.monotonic()
+
+    def finish(self):
+        start_cpu = time.thread_time()
 
-    def on_chain_end(self, response, **kwargs) -> None:
         if self.socketio:
-            self.socketio.emit('stream_end')
+            self.flush(force=True)
+            self.emit('stream_end')
 
+        if self.echo:
+            print(flush=True)
 
-def build_conversational_retrieval_chain_with_memory( llm, retriever: BaseRetriever, conversation_id, connection_string, socket=None, allow_external: bool = False ):
+        self.cpu_seconds += time.thread_time() - start_cpu
+        self.metrics.record_answer(self.tokens, self.emits, self.deferred_frames, self.ack_fallback, self.cpu_seconds)
+
+    def emit(self, event, *args, **kwargs):
+        self.emits += 1
+        self.socketio.emit(event, *args, to=self.to, **kwargs)
+
+
+class ConversationalRetrievalChainFactory:
     """
-    Build a standard ConversationalRetrievalChain, but pass a retriever that
-    decides (and augments) context before the chain composes the answer.
+    Builds the immutable parts of the RAG chain once (streaming LLM, combine-docs chain, question generator)
+    and binds only the per-request state in invoke(): the conversation window, the socket target for streamed
+    tokens and allow_external.
+
+    The shared LLM is never mutated; streaming callbacks are passed through the run config of each invocation.
     """
-    memory = ConversationBufferMemory(
-        chat_memory=SQLChatMessageHistory(
-            session_id=conversation_id, connection_string=connection_string),
-        return_messages=True,
-        memory_key="chat_history",
-        output_key="answer",
-    )
-
-    if socket:
-        llm.streaming = True
-        llm.callbacks = [StreamCallbackHandler(socket)]
-
-    deciding_retriever = ContextDecidingRetriever(
-        base_retriever=retriever,
-        conversation_id=conversation_id,
-        allow_external=allow_external,
-        socket=socket,
-    )
-
-    return ConversationalRetrievalChain.from_llm(
-        llm=llm,
-        memory=memory,
-        retriever=deciding_retriever,
-        condense_question_llm=llm,
-        return_source_documents=True,
-    )
+
+    def __init__(self, llm, retriever: BaseRetriever, history_store, socket=None):
+        self.retriever = retriever
+        self.history_store = history_store
+        self.socket = socket
+
+        # Copy instead of setting llm.streaming on the caller's shared instance
+        self.llm = llm.model_copy(update={"streaming": True}) if socket else llm
+
+        # The tags name the stage LLMUsageCallbackHandler times and attributes token usage to
+        self.combine_docs_chain = load_qa_chain(self.llm, chain_type="stuff", tags=["generation"])
+        self.question_generator = LLMChain(llm=self.llm, prompt=CONDENSE_QUESTION_PROMPT, tags=["condense"])
+
+        # STREAM_FLUSH_MS / STREAM_FLUSH_CHARS set the frame coalescing, STREAM_MAX_UNACKED the ack window (0 disables acks)
+        self.stream_settings = {
+            "flush_interval": float(os.getenv("STREAM_FLUSH_MS", 50)) / 1000,
+            "flush_chars": int(os.getenv("STREAM_FLUSH_CHARS", 64)),
+            "echo": os.getenv("STREAM_ECHO", "false") == "true",
+            "max_unacked": int(os.getenv("STREAM_MAX_UNACKED", 4)),
+            "ack_timeout": float(os.getenv("STREAM_ACK_TIMEOUT", 2.0)),
+        }
+
+        self.stats_lock = threading.Lock()
+        self.builds = 0
+        self.build_seconds = 0.0
+
+    def build(self, window, allow_external: bool = False, retriever: BaseRetriever = None):
+        """
+        Build a standard ConversationalRetrievalChain, but pass a retriever that
+        decides (and augments) context before the chain composes the answer.
+        """
+        start_time = time.perf_counter()
+
+        # The window was read once for this request; the memory only writes the new turn back to message_store
+        memory = ConversationBufferMemory(
+            chat_memory=WindowedChatMessageHistory(self.history_store, window),
+            return_messages=True,
+            memory_key="chat_history",
+            output_key="answer",
+        )
+
+        deciding_retriever = ContextDecidingRetriever(
+            base_retriever=retriever or self.retriever,
+            conversation_id=window.session_id,
+            allow_external=allow_external,
+            socket=self.socket,
+        )
+
+        chain = ConversationalRetrievalChain(
+            retriever=deciding_retriever,
+            combine_docs_chain=self.combine_docs_chain,
+            question_generator=self.question_generator,
+            memory=memory,
+            return_source_documents=True,
+        )
+
+        with self.stats_lock:
+            self.builds += 1
+            self.build_seconds += time.perf_counter() - start_time
+
+        return chain
+
+    def invoke(self, conversation_id, question, allow_external: bool = False, socket_target=None, window=None, retriever: BaseRetriever = None):
+        """
+        retriever optionally replaces the factory's retriever for this request, e.g. a copy bound to the user's location
+        """
+        if window is None:
+            window = self.history_store.load(conversation_id)
+
+        chain = self.build(window, allow_external, retriever)
+
+        callbacks = [LLMUsageCallbackHandler()]
+        if self.socket:
+            callbacks.append(StreamCallbackHandler(self.socket, to=socket_target, **self.stream_settings))
+
+        response = chain.invoke(question, config={"callbacks": callbacks})
+
+        self.history_store.schedule_summary(window)
+
+        return response
+
+    async def ainvoke(self, conversation_id, question, allow_external: bool = False, socket_target=None, window=None, retriever: BaseRetriever = None):
+        """
+        invoke() for the async request pipeline: the LLM calls go through the async OpenAI client
+        """
+        if window is None:
+            window = await self.history_store.aload(conversation_id)
+
+        chain = self.build(window, allow_external, retriever)
+
+        callbacks = [LLMUsageCallbackHandler()]
+        if self.socket:
+            callbacks.append(StreamCallbackHandler(self.socket, to=socket_target, **self.stream_settings))
+
+        response = await chain.ainvoke(question, config={"callbacks": callbacks})
+
+        self.history_store.schedule_summary(window)
+
+        return response
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "builds": self.builds,
+                "average_build_seconds": self.build_seconds / self.builds if self.builds else 0.0,
+            }
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Pool settings shared by every component that talks to Postgres (Flask-SQLAlchemy, history, retrievers, caches)
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30000))
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+class PoolMetrics:
+    '''
+    Checkout counters for one pool: how long callers waited for a connection, how often every connection was
+    already in use, and how often a caller gave up after POOL_TIMEOUT
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.exhausted_checkouts = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.peak_checked_out = 0
+
+    def record_checkout(self, wait_seconds, exhausted, checked_out):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+            self.exhausted_checkouts += int(exhausted)
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def record_timeout(self, wait_seconds):
+        with self.lock:
+            self.timeouts += 1
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def record_connect(self):
+        with self.lock:
+            self.connects += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "checkouts": self.checkouts,
+                "average_wait_ms": 1000 * self.wait_seconds / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": 1000 * self.max_wait_seconds,
+                "exhausted_checkouts": self.exhausted_checkouts,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "peak_checked_out": self.peak_checked_out,
+            }
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that times every checkout and counts checkouts made while the pool was exhausted
+    '''
+
+    metrics = None
+
+    def _do_get(self):
+        start_time = time.perf_counter()
+        exhausted = self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.record_timeout(time.perf_counter() - start_time)
+            raise
+
+        self.metrics.record_checkout(time.perf_counter() - start_time, exhausted, self.checkedout())
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep counting into the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+def pool_key(connection_uri, statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+    '''
+    postgresql:// and postgresql+psycopg2:// name the same database and driver, so they share one pool.
+    Engines with a different statement timeout get their own pool.
+    '''
+    url = make_url(connection_uri)
+    if url.drivername == "postgresql":
+        url = url.set(drivername="postgresql+psycopg2")
+    return (url.render_as_string(hide_password=False), statement_timeout_ms)
+
+def libpq_uri(connection_uri):
+    '''
+    A SQLAlchemy uri (e.g. postgresql+psycopg2://) as a plain postgresql:// uri psycopg2.connect accepts
+    '''
+    url = make_url(connection_uri).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
+def build_engine(connection_uri, statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+    engine = create_engine(
+        connection_uri,
+        poolclass=InstrumentedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        pool_pre_ping=True,
+        connect_args={"options": f"-c statement_timeout={statement_timeout_ms}"} if statement_timeout_ms else {},
+    )
+
+    metrics = PoolMetrics()
+    engine.pool.metrics = metrics
+
+    @event.listens_for(engine, "connect")
+    def count_connect(dbapi_connection, connection_record):
+        metrics.record_connect()
+
+    return engine
+
+def shared_engine(connection_uri=None, statement_timeout_ms=STATEMENT_TIMEOUT_MS):
+    '''
+    The process-wide engine for a database, created on first use.
+    Defaults to POSTGRES_DSN, falling back to the Flask app's POSTGRESQL_CONNECTION_STRING.
+
+    statement_timeout_ms bounds request-serving queries; schema setup and index builds pass 0 (no timeout).
+    '''
+    connection_uri = connection_uri or os.getenv("POSTGRES_DSN") or os.getenv("POSTGRESQL_CONNECTION_STRING")
+    key = pool_key(connection_uri, statement_timeout_ms)
+
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = build_engine(connection_uri, statement_timeout_ms)
+        return engine
+
+def pool_stats():
+    with _engines_lock:
+        engines = list(_engines.values())
+
+    stats = []
+    for engine in engines:
+        pool = engine.pool
+        stats.append({
+            "database": engine.url.render_as_string(hide_password=True),
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            **pool.metrics.as_dict(),
+        })
+
+    return stats
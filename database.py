@@ -1,12 +1,41 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.types import UserDefinedType
+from sqlalchemy import text
 from flask_bcrypt import Bcrypt
+import os
 import uuid
 
-db = SQLAlchemy()
+from connection_pool import STATEMENT_TIMEOUT_MS, shared_engine
+from caches.revocation_store import RevocationStore
+
+class SharedPoolSQLAlchemy(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy that uses the process-wide pool from connection_pool instead of creating its own engine.
+    SQLALCHEMY_ENGINE_OPTIONS["statement_timeout_ms"] overrides the pool's statement timeout (0 disables it).
+    '''
+
+    def _make_engine(self, bind_key, options, app):
+        return shared_engine(options["url"], statement_timeout_ms=options.get("statement_timeout_ms", STATEMENT_TIMEOUT_MS))
+
+db = SharedPoolSQLAlchemy()
 bcrypt = Bcrypt()
-revoked_tokens = set()
+
+# Revoked JWT ids, shared by every worker through the revoked_token table and dropped once the token expires.
+# Lookups run inside request handlers, where db.engine is available.
+revoked_tokens = RevocationStore(lambda: db.engine, sync_interval=float(os.getenv("REVOCATION_SYNC_INTERVAL", 2)))
+
+def get_table_version(table_name):
+    '''
+    Current write version of a table, maintained by the triggers from init_db.ensure_table_version_triggers.
+    Used to invalidate in-process caches when the underlying table changes.
+    '''
+    try:
+        return db.session.execute(
+            text("SELECT version FROM table_version WHERE table_name = :table_name"), {"table_name": table_name}
+        ).scalar()
+    finally:
+        db.session.rollback()
 
 class Vector(UserDefinedType):
     def get_col_spec(self):
@@ -19,6 +48,9 @@ class Vector(UserDefinedType):
         return col
     
 class message_store(db.Model):
+    # Every history read filters on session_id and orders by id
+    __table_args__ = (db.Index('message_store_session_id_id_idx', 'session_id', 'id'),)
+
     id = db.Column(db.Integer(), primary_key=True)
     session_id = db.Column(db.String(), nullable=False)
     message = db.Column(db.String(), nullable=False)
@@ -47,4 +79,22 @@ class Location(db.Model):
     address_link = db.Column(db.String(), nullable=True)
     website = db.Column(db.String(), nullable=False)
     resource_type = db.Column(db.String(), nullable=False)
-    embedding = db.Column(Vector(), nullable=True)
\ No newline at end of file
+    embedding = db.Column(Vector(), nullable=True)
+class RoutingDecision(db.Model):
+    id = db.Column(db.Integer(), primary_key=True)
+    query = db.Column(db.String(), nullable=False)
+    route = db.Column(db.String(), nullable=False)
+    source = db.Column(db.String(), nullable=False)
+    local_route = db.Column(db.String(), nullable=True)
+    created_at = db.Column(db.Float(), nullable=False)
+    embedding = db.Column(Vector(), nullable=True)
+
+class ConversationSummary(db.Model):
+    session_id = db.Column(db.String(), primary_key=True)
+    summary = db.Column(db.String(), nullable=False)
+    summarized_through_id = db.Column(db.Integer(), nullable=False)
+
+class RevokedToken(db.Model):
+    jti = db.Column(db.String(), primary_key=True)
+    expires_at = db.Column(db.Float(), nullable=False, index=True)
+    revoked_at = db.Column(db.Float(), nullable=False, index=True)
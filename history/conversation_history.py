@@ -0,0 +1,249 @@
+import contextvars
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
+
+from sqlalchemy import text
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, message_to_dict, messages_from_dict
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# Summaries are folded in after the response is sent, never on the request path
+summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-summary")
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and a maternal and child health assistant. "
+    "Update the existing summary with the new messages. Keep facts the user shared about themselves, their location "
+    "and their questions. Reply with the updated summary only, in at most 200 words."
+)
+
+SUMMARY_QUERY = text("SELECT summary, summarized_through_id FROM conversation_summary WHERE session_id = :session_id")
+
+WINDOW_QUERY = text("""
+SELECT id, message FROM message_store
+WHERE session_id = :session_id AND id > :summarized_through_id
+ORDER BY id DESC
+LIMIT :limit
+""")
+
+INSERT_MESSAGE_QUERY = text("INSERT INTO message_store (session_id, message) VALUES (:session_id, :message)")
+
+def count_tokens(content):
+    if _encoding is None:
+        return len(content) // 4 + 1
+    return len(_encoding.encode(content))
+
+class ConversationWindow:
+    '''
+    The part of a conversation sent to the LLMs: a rolling summary of older turns plus the most recent messages
+    that fit the token budget. overflow holds the unsummarized messages that fell out of the window.
+    '''
+
+    def __init__(self, session_id, summary, summarized_through_id, messages, message_ids, overflow, overflow_through_id):
+        self.session_id = session_id
+        self.summary = summary
+        self.summarized_through_id = summarized_through_id
+        self.messages = messages
+        self.message_ids = message_ids
+        self.overflow = overflow
+        self.overflow_through_id = overflow_through_id
+
+    def has_history(self):
+        return bool(self.summary or self.messages or self.overflow)
+
+    def as_chat_messages(self) -> List[BaseMessage]:
+        if self.summary:
+            return [SystemMessage(content=f"Summary of the earlier conversation: {self.summary}")] + self.messages
+        return list(self.messages)
+
+    def as_openai_messages(self):
+        '''
+        The window in the role/content format used by determine_search_type
+        '''
+        openai_messages = []
+        if self.summary:
+            openai_messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"})
+
+        for message in self.messages:
+            role = {"human": "user", "ai": "assistant"}.get(message.type)
+            if role:
+                openai_messages.append({"role": role, "content": message.content})
+
+        return openai_messages
+
+class ConversationHistoryStore:
+    '''
+    Reads and writes message_store through the (session_id, id) index and keeps a per-session rolling summary in
+    conversation_summary.
+
+    Each request reads the history once with load(): the summary row plus only the messages newer than the last
+    summarized id. The newest messages that fit max_turns and max_tokens form the window; older unsummarized messages
+    are folded into the summary in the background after the request, so the read stays bounded however long the
+    conversation gets.
+
+    async_engine (an AsyncEngine) enables aload() and aappend() for the async request pipeline.
+    '''
+
+    def __init__(self, engine, llm=None, max_turns=6, max_tokens=2000, async_engine=None):
+        self.engine = engine
+        self.async_engine = async_engine
+        self.llm = llm
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+
+        self.summarizing = set()
+        self.summarizing_lock = threading.Lock()
+
+    def load(self, session_id) -> ConversationWindow:
+        with self.engine.connect() as conn:
+            summary_row = conn.execute(SUMMARY_QUERY, {"session_id": session_id}).first()
+            summary, summarized_through_id = summary_row if summary_row else ("", 0)
+
+            rows = conn.execute(WINDOW_QUERY, self._window_params(session_id, summarized_through_id)).fetchall()
+
+        return self._build_window(session_id, summary, summarized_through_id, rows)
+
+    async def aload(self, session_id) -> ConversationWindow:
+        '''
+        load() over the async engine, for the async request pipeline
+        '''
+        if self.async_engine is None:
+            return self.load(session_id)
+
+        async with self.async_engine.connect() as conn:
+            summary_row = (await conn.execute(SUMMARY_QUERY, {"session_id": session_id})).first()
+            summary, summarized_through_id = summary_row if summary_row else ("", 0)
+
+            rows = (await conn.execute(WINDOW_QUERY, self._window_params(session_id, summarized_through_id))).fetchall()
+
+        return self._build_window(session_id, summary, summarized_through_id, rows)
+
+    def _window_params(self, session_id, summarized_through_id):
+        return {
+            "session_id": session_id,
+            "summarized_through_id": summarized_through_id,
+            # Without a summarizer, older rows would never be folded away, so never read past the window
+            "limit": self.max_turns * 2 if self.llm is None else self.max_turns * 8,
+        }
+
+    def _build_window(self, session_id, summary, summarized_through_id, rows):
+        # Walk back from the newest message until the turn or token budget runs out
+        window_rows = []
+        tokens = count_tokens(summary) if summary else 0
+        for row in rows:
+            message_tokens = count_tokens(row.message)
+            if len(window_rows) >= self.max_turns * 2 or (window_rows and tokens + message_tokens > self.max_tokens):
+                break
+            window_rows.append(row)
+            tokens += message_tokens
+
+        overflow_rows = rows[len(window_rows):]
+        window_rows.reverse()
+        overflow_rows.reverse()
+
+        return ConversationWindow(
+            session_id=session_id,
+            summary=summary,
+            summarized_through_id=summarized_through_id,
+            messages=messages_from_dict([json.loads(row.message) for row in window_rows]),
+            message_ids=[row.id for row in window_rows],
+            overflow=messages_from_dict([json.loads(row.message) for row in overflow_rows]),
+            overflow_through_id=overflow_rows[-1].id if overflow_rows else summarized_through_id,
+        )
+
+    def append(self, session_id, messages: Sequence[BaseMessage]):
+        with self.engine.begin() as conn:
+            conn.execute(INSERT_MESSAGE_QUERY, self._message_params(session_id, messages))
+
+    async def aappend(self, session_id, messages: Sequence[BaseMessage]):
+        if self.async_engine is None:
+            return self.append(session_id, messages)
+
+        async with self.async_engine.begin() as conn:
+            await conn.execute(INSERT_MESSAGE_QUERY, self._message_params(session_id, messages))
+
+    def _message_params(self, session_id, messages):
+        return [{"session_id": session_id, "message": json.dumps(message_to_dict(message))} for message in messages]
+
+    def schedule_summary(self, window: ConversationWindow):
+        '''
+        Fold the window's overflow into the rolling summary in the background
+        '''
+        if self.llm is None or not window.overflow:
+            return
+
+        with self.summarizing_lock:
+            if window.session_id in self.summarizing:
+                return
+            self.summarizing.add(window.session_id)
+
+        # The copied context keeps the request id on the summary's log lines
+        summary_executor.submit(contextvars.copy_context().run, self._update_summary, window)
+
+    def _update_summary(self, window: ConversationWindow):
+        try:
+            transcript = "\n".join(f"{message.type}: {message.content}" for message in window.overflow)
+            response = self.llm.invoke([
+                SystemMessage(content=SUMMARY_PROMPT),
+                SystemMessage(content=f"Existing summary: {window.summary or '[none]'}\n\nNew messages:\n{transcript}"),
+            ])
+
+            with self.engine.begin() as conn:
+                # Only advance from the state we summarized, so concurrent requests never move the summary backwards
+                updated = conn.execute(text("""
+                UPDATE conversation_summary
+                SET summary = :summary, summarized_through_id = :through_id
+                WHERE session_id = :session_id AND summarized_through_id = :previous_through_id
+                """), {
+                    "summary": response.content,
+                    "through_id": window.overflow_through_id,
+                    "session_id": window.session_id,
+                    "previous_through_id": window.summarized_through_id,
+                }).rowcount
+
+                if not updated:
+                    conn.execute(text("""
+                    INSERT INTO conversation_summary (session_id, summary, summarized_through_id)
+                    VALUES (:session_id, :summary, :through_id)
+                    ON CONFLICT (session_id) DO NOTHING
+                    """), {"session_id": window.session_id, "summary": response.content, "through_id": window.overflow_through_id})
+        except Exception as e:
+            logger.warning(f"Failed to update conversation summary for {window.session_id}: {e}")
+        finally:
+            with self.summarizing_lock:
+                self.summarizing.discard(window.session_id)
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+    '''
+    Chat history for ConversationBufferMemory backed by an already loaded ConversationWindow.
+    Reads never touch the database again; new messages are written through to message_store.
+    '''
+
+    def __init__(self, store: ConversationHistoryStore, window: ConversationWindow):
+        self.store = store
+        self.window = window
+        self.added = []
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.window.as_chat_messages() + self.added
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.append(self.window.session_id, messages)
+        self.added.extend(messages)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        await self.store.aappend(self.window.session_id, messages)
+        self.added.extend(messages)
+
+    def clear(self) -> None:
+        self.added = []
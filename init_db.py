@@ -1,10 +1,15 @@
 import os
-import subprocess
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
 from flask import Flask
 from dotenv import load_dotenv
 from sqlalchemy import text
 
 from database import db
+from vector_index import EMBEDDING_DIMENSIONS, ensure_ann_indexes
 
 load_dotenv()
 
@@ -21,6 +26,8 @@ def create_minimal_app():
     app = Flask(__name__)
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Column rewrites, index builds and ANALYZE can run far longer than the request-serving statement timeout
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"statement_timeout_ms": 0}
     db.init_app(app)
     return app
 
@@ -39,7 +46,8 @@ def ensure_langchain_tables():
     NOTE on types:
       - uuid: UUID
       - cmetadata: JSONB
-      - embedding: vector (pgvector)
+      - embedding: vector(EMBEDDING_DIMENSIONS) (pgvector); a fixed dimension is required for ANN indexes
+      - document_tsv: generated tsvector over document, GIN indexed for hybrid retrieval
 
     NOTE on embedding.id type:
       Many LangChain schemas use UUID. If your CSV's id is NOT a UUID, change
@@ -56,70 +64,232 @@ def ensure_langchain_tables():
         """))
 
         # Embedding table
-        conn.execute(text("""
+        conn.execute(text(f"""
         CREATE TABLE IF NOT EXISTS langchain_pg_embedding (
             id UUID PRIMARY KEY,
             collection_id UUID REFERENCES langchain_pg_collection(uuid) ON DELETE CASCADE,
-            embedding vector,
+            embedding vector({EMBEDDING_DIMENSIONS}),
             document TEXT,
-            cmetadata JSONB
+            cmetadata JSONB,
+            document_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', coalesce(document, ''))) STORED
         );
         """))
 
+        # Full-text column for hybrid retrieval, added to tables created before it existed
+        conn.execute(text("""
+        ALTER TABLE langchain_pg_embedding
+        ADD COLUMN IF NOT EXISTS document_tsv TSVECTOR
+        GENERATED ALWAYS AS (to_tsvector('english', coalesce(document, ''))) STORED;
+        """))
+
+
+
+def ensure_langchain_indexes():
+    """
+    Secondary indexes on langchain_pg_embedding. Created after seeding, since building an index once over loaded rows
+    is much faster than maintaining it row by row during COPY.
+    """
+    with db.engine.begin() as conn:
         # Indexes (helpful for retrieval + filtering by collection)
         conn.execute(text("""
         CREATE INDEX IF NOT EXISTS langchain_pg_embedding_collection_id_idx
         ON langchain_pg_embedding(collection_id);
         """))
 
+        conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS langchain_pg_embedding_document_tsv_idx
+        ON langchain_pg_embedding USING GIN (document_tsv);
+        """))
+
 
-def run_psql(sql: str):
+def ensure_message_store_index():
     """
-    Run a single psql -c statement against DATABASE_URL.
+    db.create_all() only adds indexes to tables it creates, so add the history index to existing deployments too.
     """
-    cmd = ["psql", DATABASE_URL, "-v", "ON_ERROR_STOP=1", "-c", sql]
-    subprocess.run(cmd, check=True)
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS message_store_session_id_id_idx
+        ON message_store(session_id, id);
+        """))
 
 
-def psql_copy(table_name: str, csv_path: str, columns: str | None = None):
+def ensure_table_version_triggers(table_names=("location",)):
     """
-    Uses psql \\copy (client-side) so the CSV only needs to exist in init container.
-    columns: optional string like "(col1, col2, ...)" to force column order.
+    Keep a per-table write counter in table_version so in-process caches (e.g. the /locations cache) can detect
+    changes with a single primary-key lookup. Statement-level triggers bump the counter once per write statement.
     """
-    if not os.path.exists(csv_path):
-        print(f"⚠️ CSV not found at {csv_path}, skipping seed for {table_name}.")
-        return
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS table_version (
+            table_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        );
+        """))
+
+        conn.execute(text("""
+        CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO table_version (table_name, version) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (table_name) DO UPDATE SET version = table_version.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """))
+
+        for table_name in table_names:
+            conn.execute(text(
+                "INSERT INTO table_version (table_name, version) VALUES (:table_name, 0) ON CONFLICT (table_name) DO NOTHING"
+            ), {"table_name": table_name})
+
+            conn.execute(text(f"""
+            DROP TRIGGER IF EXISTS {table_name}_version_trigger ON "{table_name}";
+            CREATE TRIGGER {table_name}_version_trigger
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "{table_name}"
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+            """))
+
+
+# Seed tables, their CSV columns and the tables they reference. Tables are loaded as soon as everything they
+# reference is loaded, so independent tables load concurrently.
+SEED_TABLES = [
+    # location is quoted in case it conflicts with reserved words or casing
+    {"table": '"location"', "name": "location", "csv": LOCATION_CSV_PATH, "columns": None, "depends_on": []},
+    {"table": "langchain_pg_collection", "name": "langchain_pg_collection", "csv": COLLECTION_CSV_PATH,
+     "columns": "(uuid, name, cmetadata)", "depends_on": []},
+    {"table": "langchain_pg_embedding", "name": "langchain_pg_embedding", "csv": EMBEDDING_CSV_PATH,
+     "columns": "(id, collection_id, embedding, document, cmetadata)", "depends_on": ["langchain_pg_collection"]},
+]
+
+
+def ensure_seed_checksum_table():
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS seed_checksum (
+            table_name TEXT PRIMARY KEY,
+            checksum TEXT NOT NULL,
+            row_count BIGINT NOT NULL,
+            loaded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """))
 
-    cols = f" {columns}" if columns else ""
-    sql = f"\\copy {table_name}{cols} FROM '{csv_path}' WITH (FORMAT csv, HEADER true)"
-    run_psql(sql)
-    print(f"✅ Seeded {table_name} from {csv_path}")
 
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-def reset_tables():
+
+def tables_to_reload(force=False):
+    """
+    Seed specs whose CSV changed since its last successful load, plus every table that references one of them
+    (truncating a referenced table cascades to it). Tables without a CSV are left alone.
+    """
+    with db.engine.connect() as conn:
+        loaded = dict(conn.execute(text("SELECT table_name, checksum FROM seed_checksum")).fetchall())
+
+    reload = {}
+    for spec in SEED_TABLES:
+        if not os.path.exists(spec["csv"]):
+            print(f"⚠️ CSV not found at {spec['csv']}, skipping seed for {spec['name']}.")
+            continue
+
+        checksum = file_checksum(spec["csv"])
+        referenced_reloaded = any(name in reload for name in spec["depends_on"])
+
+        if force or referenced_reloaded or loaded.get(spec["name"]) != checksum:
+            reload[spec["name"]] = {**spec, "checksum": checksum}
+        else:
+            print(f"✅ {spec['name']} is up to date with {spec['csv']}, skipping")
+
+    return reload
+
+
+def drop_secondary_indexes(conn, table_name):
+    """
+    Drop a table's indexes other than its primary key and unique constraints; they are rebuilt after the load
+    """
+    index_names = conn.execute(text("""
+    SELECT i.relname
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = CAST(:table_name AS regclass) AND NOT x.indisprimary AND NOT x.indisunique
+    """), {"table_name": table_name}).scalars().all()
+
+    for index_name in index_names:
+        conn.execute(text(f'DROP INDEX IF EXISTS "{index_name}"'))
+
+    return index_names
+
+
+def reset_tables(reload):
     print("truncating seed tables...", flush=True)
 
-    # Truncate all in one statement to satisfy FK constraints
-    run_psql('TRUNCATE TABLE langchain_pg_embedding, langchain_pg_collection, "location" RESTART IDENTITY CASCADE;')
+    with db.engine.begin() as conn:
+        for spec in reload.values():
+            dropped = drop_secondary_indexes(conn, spec["table"])
+            if dropped:
+                print(f"dropped {len(dropped)} indexes on {spec['name']} until it is loaded", flush=True)
+
+        # Truncate all in one statement to satisfy FK constraints; forget their checksums until they load again
+        conn.execute(text(f"TRUNCATE TABLE {', '.join(spec['table'] for spec in reload.values())} RESTART IDENTITY CASCADE"))
+        conn.execute(text("DELETE FROM seed_checksum WHERE table_name = ANY(:names)"), {"names": list(reload)})
 
     print("✅ Truncated tables", flush=True)
 
-def seed_location():
-    # location is quoted in case it conflicts with reserved words or casing
-    psql_copy('"location"', LOCATION_CSV_PATH)
 
-def seed_langchain_pg_collection():
-    # Expected CSV header/columns: uuid, name, cmetadata
-    psql_copy("langchain_pg_collection", COLLECTION_CSV_PATH, "(uuid, name, cmetadata)")
+def copy_table(spec):
+    """
+    Stream a seed CSV into its table with COPY FROM STDIN and record its checksum in the same transaction
+    """
+    start_time = time.perf_counter()
+
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with conn, conn.cursor() as cursor:
+            cols = f" {spec['columns']}" if spec["columns"] else ""
+            with open(spec["csv"], "r", encoding="utf-8") as csv_file:
+                cursor.copy_expert(f"COPY {spec['table']}{cols} FROM STDIN WITH (FORMAT csv, HEADER true)", csv_file)
+            row_count = cursor.rowcount
+
+            cursor.execute("""
+            INSERT INTO seed_checksum (table_name, checksum, row_count, loaded_at) VALUES (%s, %s, %s, now())
+            ON CONFLICT (table_name) DO UPDATE SET checksum = EXCLUDED.checksum, row_count = EXCLUDED.row_count, loaded_at = now()
+            """, (spec["name"], spec["checksum"], row_count))
+    finally:
+        conn.close()
 
+    elapsed = time.perf_counter() - start_time
+    print(f"✅ Seeded {spec['name']} from {spec['csv']}: {row_count} rows in {elapsed:.1f}s", flush=True)
+
+
+def seed_tables(reload, workers=4):
+    """
+    Load the tables concurrently, each one starting once the tables it references have loaded
+    """
+    futures = {}
 
-def seed_langchain_pg_embedding():
-    # Expected CSV header/columns: id, collection_id, embedding, document, cmetadata
-    psql_copy(
-        "langchain_pg_embedding",
-        EMBEDDING_CSV_PATH,
-        "(id, collection_id, embedding, document, cmetadata)"
-    )
+    def load_after_dependencies(spec):
+        for name in spec["depends_on"]:
+            if name in futures:
+                futures[name].result()
+        copy_table(spec)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # SEED_TABLES lists referenced tables first, so every dependency is submitted before its dependents
+        for spec in SEED_TABLES:
+            if spec["name"] in reload:
+                futures[spec["name"]] = executor.submit(load_after_dependencies, reload[spec["name"]])
+
+        for future in futures.values():
+            future.result()
+
+
+def analyze_tables(table_names):
+    with db.engine.begin() as conn:
+        for table_name in table_names:
+            conn.execute(text(f"ANALYZE {table_name}"))
 
 
 if __name__ == "__main__":
@@ -133,19 +303,33 @@ if __name__ == "__main__":
 
         print("==> Creating app tables (SQLAlchemy models)...")
         db.create_all()
+        ensure_message_store_index()
+        ensure_table_version_triggers()
 
         print("==> Ensuring LangChain tables exist...")
         ensure_langchain_tables()
 
-        reset_tables()
+        ensure_seed_checksum_table()
+
+        # Only tables whose seed CSV changed since their last load are truncated and reloaded
+        reload = tables_to_reload(force=os.getenv("SEED_FORCE", "false") == "true")
+
+        if reload:
+            reset_tables(reload)
+
+            print(f"==> Seeding {', '.join(reload)}...")
+            seed_tables(reload, workers=int(os.getenv("SEED_WORKERS", 4)))
 
-        print("==> Seeding location table...")
-        seed_location()
+        # Secondary indexes are (re)built once the rows are in place
+        print("==> Ensuring LangChain indexes...")
+        ensure_langchain_indexes()
 
-        print("==> Seeding langchain_pg_collection...")
-        seed_langchain_pg_collection()
+        # ANN indexes are built after the data is loaded (IVFFlat needs the rows to pick its lists)
+        print("==> Ensuring ANN indexes...")
+        ensure_ann_indexes(db.engine)
 
-        print("==> Seeding langchain_pg_embedding...")
-        seed_langchain_pg_embedding()
+        if reload:
+            print("==> Analyzing seeded tables...")
+            analyze_tables(spec["table"] for spec in reload.values())
 
     print("init_db complete")
@@ -0,0 +1,274 @@
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# Response shaping, all overridable on the command line
+LATENCY_MS = float(os.getenv("FAKE_OPENAI_LATENCY_MS", 400))
+"""Time before a completion (or the first streamed token) is sent."""
+JITTER_MS = float(os.getenv("FAKE_OPENAI_JITTER_MS", 100))
+TOKENS_PER_SECOND = float(os.getenv("FAKE_OPENAI_TOKENS_PER_SECOND", 50))
+COMPLETION_TOKENS = int(os.getenv("FAKE_OPENAI_COMPLETION_TOKENS", 120))
+EMBEDDING_LATENCY_MS = float(os.getenv("FAKE_OPENAI_EMBEDDING_LATENCY_MS", 60))
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1536))
+FOLLOW_UP_RATE = float(os.getenv("FAKE_OPENAI_FOLLOW_UP_RATE", 0.05))
+"""Fraction of classification calls answered with a follow-up question instead of a tool call."""
+SUFFICIENT_RATE = float(os.getenv("FAKE_OPENAI_SUFFICIENT_RATE", 0.7))
+"""Fraction of context sufficiency judgements that come back sufficient."""
+ERROR_RATE = float(os.getenv("FAKE_OPENAI_ERROR_RATE", 0.0))
+
+LOCATION_HINTS = (" in ", " near ", "where can i", "closest", "nearby", "county")
+
+WORDS = ("mothers", "newborns", "care", "support", "clinic", "resources", "health", "families", "visit", "services", "feeding", "sleep")
+
+class FakeOpenAIStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.errors = 0
+        self.streamed_tokens = 0
+
+    def record(self, endpoint, error=False, streamed_tokens=0):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.errors += int(error)
+            self.streamed_tokens += streamed_tokens
+
+    def as_dict(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "errors": self.errors, "streamed_tokens": self.streamed_tokens}
+
+stats = FakeOpenAIStats()
+
+def stable_fraction(value):
+    '''
+    A number in [0, 1) derived from value, so the same request always takes the same branch
+    '''
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2 ** 64
+
+def fake_embedding(value, dimensions):
+    seed = int.from_bytes(hashlib.blake2b(json.dumps(value).encode("utf-8"), digest_size=8).digest(), "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+def fake_answer(prompt, token_count):
+    rng = random.Random(prompt)
+    return [("" if i == 0 else " ") + rng.choice(WORDS) for i in range(token_count)]
+
+def last_user_message(messages):
+    for message in reversed(messages):
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            return message["content"]
+    return ""
+
+def prompt_tokens(messages):
+    # Rough count, close enough for usage accounting in the app's metrics
+    return sum(len(str(message.get("content") or "").split()) for message in messages)
+
+def sleep_ms(milliseconds):
+    time.sleep(max(milliseconds + random.uniform(-JITTER_MS, JITTER_MS), 0) / 1000)
+
+def completion_message(body):
+    '''
+    The assistant message for a chat completion request:
+    - with tools (the search type classifier): a search_location_questions or search_direct_questions call, or
+      occasionally a follow-up question
+    - the context sufficiency judge: {"sufficient": true|false}
+    - anything else: COMPLETION_TOKENS words of filler
+    '''
+    messages = body.get("messages") or []
+    query = last_user_message(messages)
+    system = " ".join(str(message.get("content") or "") for message in messages if message.get("role") == "system")
+
+    if body.get("tools"):
+        if stable_fraction(f"follow-up:{query}") < FOLLOW_UP_RATE:
+            return {"role": "assistant", "content": "Could you tell me which city you are in?"}, "stop"
+
+        name = "search_location_questions" if any(hint in query.lower() for hint in LOCATION_HINTS) else "search_direct_questions"
+        tool_call = {
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": name, "arguments": json.dumps({"id": None, "query": query})},
+        }
+        return {"role": "assistant", "content": None, "tool_calls": [tool_call]}, "tool_calls"
+
+    if "Respond ONLY with JSON" in system:
+        sufficient = stable_fraction(f"judge:{query}") < SUFFICIENT_RATE
+        return {"role": "assistant", "content": json.dumps({"sufficient": sufficient})}, "stop"
+
+    return {"role": "assistant", "content": "".join(fake_answer(query, COMPLETION_TOKENS))}, "stop"
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json({"object": "list", "data": [{"id": model, "object": "model", "owned_by": "fake"} for model in ("gpt-4o", "gpt-3.5-turbo", "text-embedding-ada-002")]})
+        elif self.path.rstrip("/") == "/stats":
+            self.send_json(stats.as_dict())
+        else:
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        endpoint = self.path.rstrip("/").rsplit("/v1", 1)[-1]
+
+        if ERROR_RATE and random.random() < ERROR_RATE:
+            stats.record(endpoint, error=True)
+            self.send_json({"error": {"message": "Injected failure", "type": "server_error"}}, status=500)
+            return
+
+        if endpoint == "/chat/completions":
+            self.chat_completion(body)
+        elif endpoint == "/embeddings":
+            self.embeddings(body)
+        else:
+            stats.record(endpoint, error=True)
+            self.send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def chat_completion(self, body):
+        model = body.get("model", "gpt-4o")
+        message, finish_reason = completion_message(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        sleep_ms(LATENCY_MS)
+
+        if not body.get("stream"):
+            completion_tokens = len(str(message.get("content") or "").split()) + len(message.get("tool_calls") or [])
+            stats.record("/chat/completions")
+            self.send_json({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens(body.get("messages") or []),
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens(body.get("messages") or []) + completion_tokens,
+                },
+            })
+            return
+
+        # Server-sent events at TOKENS_PER_SECOND, one token per chunk like the real API
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        tokens = fake_answer(last_user_message(body.get("messages") or []), COMPLETION_TOKENS) if message.get("content") else []
+
+        try:
+            if message.get("tool_calls"):
+                chunk({"role": "assistant", "content": None, "tool_calls": [{"index": 0, **message["tool_calls"][0]}]})
+            else:
+                chunk({"role": "assistant", "content": ""})
+                for token in tokens:
+                    chunk({"content": token})
+                    time.sleep(1 / TOKENS_PER_SECOND)
+
+            chunk({}, finish_reason)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            stats.record("/chat/completions", error=True)
+            return
+
+        stats.record("/chat/completions", streamed_tokens=len(tokens))
+
+    def embeddings(self, body):
+        inputs = body.get("input")
+        # A single string or a single tokenized input (list of ints) is one embedding
+        if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+
+        dimensions = int(body.get("dimensions") or EMBEDDING_DIMENSIONS)
+        sleep_ms(EMBEDDING_LATENCY_MS)
+
+        data = []
+        for i, value in enumerate(inputs or []):
+            vector = fake_embedding(value, dimensions)
+            # The openai client asks for base64 unless told otherwise
+            embedding = base64.b64encode(vector.tobytes()).decode("ascii") if body.get("encoding_format") == "base64" else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        token_count = sum(len(value) if isinstance(value, list) else len(str(value).split()) for value in inputs or [])
+        stats.record("/embeddings")
+        self.send_json({
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": token_count, "total_tokens": token_count},
+        })
+
+    def send_json(self, payload, status=200):
+        encoded = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+def serve(host, port):
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    global LATENCY_MS, JITTER_MS, TOKENS_PER_SECOND, COMPLETION_TOKENS, EMBEDDING_LATENCY_MS, FOLLOW_UP_RATE, SUFFICIENT_RATE, ERROR_RATE
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completion and embedding endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(os.getenv("FAKE_OPENAI_PORT", 8089)))
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_MS)
+    parser.add_argument("--jitter-ms", type=float, default=JITTER_MS)
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--completion-tokens", type=int, default=COMPLETION_TOKENS)
+    parser.add_argument("--embedding-latency-ms", type=float, default=EMBEDDING_LATENCY_MS)
+    parser.add_argument("--follow-up-rate", type=float, default=FOLLOW_UP_RATE)
+    parser.add_argument("--sufficient-rate", type=float, default=SUFFICIENT_RATE)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    args = parser.parse_args()
+
+    LATENCY_MS, JITTER_MS, TOKENS_PER_SECOND, COMPLETION_TOKENS = args.latency_ms, args.jitter_ms, args.tokens_per_second, args.completion_tokens
+    EMBEDDING_LATENCY_MS, FOLLOW_UP_RATE, SUFFICIENT_RATE, ERROR_RATE = args.embedding_latency_ms, args.follow_up_rate, args.sufficient_rate, args.error_rate
+
+    server = serve(args.host, args.port)
+    print(f"Fake OpenAI listening on http://{args.host}:{args.port}/v1", flush=True)
+    print(f"Point the app at it with OPENAI_BASE_URL=http://{args.host}:{args.port}/v1 OPENAI_API_BASE=http://{args.host}:{args.port}/v1", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
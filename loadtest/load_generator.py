@@ -0,0 +1,449 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import numpy as np
+import requests
+import socketio
+
+SCENARIOS = ["search", "stream", "locations"]
+
+DIRECT_QUERIES = [
+    "What are the signs of postpartum depression?",
+    "How often should a newborn eat?",
+    "Is it safe to take ibuprofen while breastfeeding?",
+    "What vaccines does my baby need at two months?",
+    "How do I set up a safe sleep space for my infant?",
+    "What should I eat during the third trimester?",
+]
+
+LOCATION_QUERIES = [
+    "Where can I get mental health support in Bryan?",
+    "Dental services in Corpus Christi",
+    "Lactation consultants near Houston",
+    "Food banks in Travis County",
+    "Where can I find a WIC office in San Antonio?",
+    "Pediatric clinics in Dallas",
+]
+
+class LoadStats:
+    '''
+    Latencies, status codes and errors per scenario, shared by every virtual user
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scenarios = {}
+
+    def scenario(self, name):
+        return self.scenarios.setdefault(name, {"latencies": [], "statuses": {}, "errors": {}, "ttft": [], "stream_seconds": [], "frames": [], "streams_missing": 0})
+
+    def record(self, name, seconds, status=None, error=None):
+        with self.lock:
+            scenario = self.scenario(name)
+            if error is not None:
+                scenario["errors"][error] = scenario["errors"].get(error, 0) + 1
+            else:
+                scenario["latencies"].append(seconds)
+            if status is not None:
+                scenario["statuses"][str(status)] = scenario["statuses"].get(str(status), 0) + 1
+
+    def record_stream(self, name, ttft, stream_seconds, frames):
+        with self.lock:
+            scenario = self.scenario(name)
+            if ttft is None:
+                scenario["streams_missing"] += 1
+                return
+            scenario["ttft"].append(ttft)
+            scenario["stream_seconds"].append(stream_seconds)
+            scenario["frames"].append(frames)
+
+def percentiles_ms(seconds):
+    if not seconds:
+        return None
+    milliseconds = 1000 * np.asarray(seconds)
+    return {
+        "p50": float(np.percentile(milliseconds, 50)),
+        "p90": float(np.percentile(milliseconds, 90)),
+        "p99": float(np.percentile(milliseconds, 99)),
+        "max": float(milliseconds.max()),
+    }
+
+def summarize(stats, elapsed):
+    summary = {}
+    for name, scenario in stats.scenarios.items():
+        failures = sum(scenario["errors"].values()) + sum(count for status, count in scenario["statuses"].items() if not status.startswith("2"))
+        total = len(scenario["latencies"]) + sum(scenario["errors"].values())
+
+        summary[name] = {
+            "requests": total,
+            "throughput_rps": total / elapsed if elapsed else 0.0,
+            "error_rate": failures / total if total else 0.0,
+            "statuses": scenario["statuses"],
+            "errors": scenario["errors"],
+            "latency_ms": percentiles_ms(scenario["latencies"]),
+        }
+
+        if name == "stream":
+            summary[name]["time_to_first_frame_ms"] = percentiles_ms(scenario["ttft"])
+            summary[name]["stream_duration_ms"] = percentiles_ms(scenario["stream_seconds"])
+            summary[name]["mean_frames"] = float(np.mean(scenario["frames"])) if scenario["frames"] else None
+            # Requests answered without streaming, e.g. answer cache hits and follow-up questions
+            summary[name]["unstreamed_responses"] = scenario["streams_missing"]
+
+    return summary
+
+class StreamListener:
+    '''
+    A Socket.IO connection for one virtual user, timing the stream_start / stream_data / stream_end frames of the
+    answer to its current request
+    '''
+
+    def __init__(self, base_url, timeout):
+        self.client = socketio.Client(reconnection=False)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.reset(None)
+
+        self.client.on("stream_start", self.on_start)
+        self.client.on("stream_data", self.on_data)
+        self.client.on("stream_end", self.on_end)
+
+        # Long-polling first, upgraded to a websocket when websocket-client is installed (as the browser client does)
+        self.client.connect(base_url, wait_timeout=min(timeout, 10))
+
+    @property
+    def sid(self):
+        return self.client.get_sid("/")
+
+    def reset(self, sent_at):
+        with self.lock:
+            self.sent_at = sent_at
+            self.first_frame_at = None
+            self.started = False
+            self.ended_at = None
+            self.frames = 0
+        self.done.clear()
+
+    def on_start(self, *args):
+        with self.lock:
+            self.started = True
+
+    def on_data(self, *args):
+        with self.lock:
+            if self.first_frame_at is None:
+                self.first_frame_at = time.perf_counter()
+            self.frames += 1
+        # Returning a value acknowledges the frame, which releases the server's backpressure window
+        return True
+
+    def on_end(self, *args):
+        with self.lock:
+            self.ended_at = time.perf_counter()
+        self.done.set()
+
+    def result(self, grace):
+        '''
+        (time to first frame, stream duration, frames) once stream_end arrives, or Nones when nothing was streamed
+        '''
+        with self.lock:
+            started = self.started
+        if started:
+            self.done.wait(grace)
+
+        with self.lock:
+            if self.first_frame_at is None:
+                return None, None, 0
+            return self.first_frame_at - self.sent_at, (self.ended_at or time.perf_counter()) - self.sent_at, self.frames
+
+    def close(self):
+        try:
+            self.client.disconnect()
+        except Exception:
+            pass
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, settings, stats, location_ids, stop_at, request_budget):
+        super().__init__(name=f"virtual-user-{index}", daemon=True)
+        self.settings = settings
+        self.stats = stats
+        self.location_ids = location_ids
+        self.stop_at = stop_at
+        self.request_budget = request_budget
+        self.rng = random.Random(settings["seed"] + index)
+        self.session = requests.Session()
+        self.listener = None
+        self.new_conversation()
+
+    def new_conversation(self):
+        self.conversation_id = str(uuid.uuid4())
+        self.turns = 0
+
+    def query(self):
+        pool = LOCATION_QUERIES if self.rng.random() < self.settings["location_query_rate"] else DIRECT_QUERIES
+        query = self.rng.choice(pool)
+        # Repeated queries can be answered from the semantic answer cache; the rest are made unique
+        if self.rng.random() >= self.settings["repeat_query_rate"]:
+            query = f"{query} ({uuid.uuid4().hex[:8]})"
+        return query
+
+    def run(self):
+        weights = [self.settings["mix"].get(name, 0) for name in SCENARIOS]
+
+        while time.monotonic() < self.stop_at and self.request_budget.take():
+            scenario = self.rng.choices(SCENARIOS, weights)[0]
+            if scenario == "locations" and not self.location_ids:
+                scenario = "search"
+
+            try:
+                getattr(self, scenario)()
+            except Exception as e:
+                self.stats.record(scenario, 0.0, error=type(e).__name__)
+
+            if self.settings["think_time"]:
+                time.sleep(self.rng.expovariate(1 / self.settings["think_time"]))
+
+        if self.listener:
+            self.listener.close()
+
+    def search_form(self):
+        self.turns += 1
+        if self.turns > self.settings["turns_per_conversation"]:
+            self.new_conversation()
+            self.turns = 1
+
+        form = {"data": self.query(), "conversationId": self.conversation_id, "allow_external": "true" if self.rng.random() < self.settings["allow_external_rate"] else "false"}
+        if self.rng.random() < self.settings["user_location_rate"]:
+            form.update(latitude="30.6280", longitude="-96.3344")
+        return form
+
+    def post_search(self, name, form):
+        start_time = time.perf_counter()
+        response = self.session.post(f"{self.settings['base_url']}/formattedresults", data=form, timeout=self.settings["timeout"])
+        self.stats.record(name, time.perf_counter() - start_time, status=response.status_code)
+
+        if response.ok and len(self.location_ids) < 5000:
+            try:
+                self.location_ids.extend(location["id"] for location in response.json().get("locations") or [] if location.get("id"))
+            except ValueError:
+                pass
+
+        return start_time
+
+    def search(self):
+        self.post_search("search", self.search_form())
+
+    def stream(self):
+        if self.listener is None:
+            self.listener = StreamListener(self.settings["base_url"], self.settings["timeout"])
+
+        form = self.search_form()
+        form["socketId"] = self.listener.sid
+
+        self.listener.reset(time.perf_counter())
+        self.post_search("stream", form)
+
+        ttft, stream_seconds, frames = self.listener.result(self.settings["stream_grace"])
+        self.stats.record_stream("stream", ttft, stream_seconds, frames)
+
+    def locations(self):
+        ids = self.rng.sample(self.location_ids, min(self.settings["locations_per_request"], len(self.location_ids)))
+
+        start_time = time.perf_counter()
+        response = self.session.post(f"{self.settings['base_url']}/locations", data={"location_ids": ids}, timeout=self.settings["timeout"])
+        self.stats.record("locations", time.perf_counter() - start_time, status=response.status_code)
+
+class RequestBudget:
+    '''
+    Caps the total number of requests across virtual users (unlimited when None)
+    '''
+
+    def __init__(self, limit):
+        self.lock = threading.Lock()
+        self.remaining = limit
+
+    def take(self):
+        if self.remaining is None:
+            return True
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+def load_location_ids(database_uri, limit=5000):
+    '''
+    Location ids to request from /locations, sampled from the database the server is using
+    '''
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(database_uri)
+    try:
+        with engine.connect() as conn:
+            return [str(row[0]) for row in conn.execute(text("SELECT id FROM location ORDER BY random() LIMIT :limit"), {"limit": limit})]
+    finally:
+        engine.dispose()
+
+def fetch_json(url):
+    try:
+        response = requests.get(url, timeout=5)
+        return response.json() if response.ok else None
+    except (requests.RequestException, ValueError):
+        return None
+
+def run_load(settings):
+    '''
+    Drive the server with settings["concurrency"] virtual users for settings["duration"] seconds (or until
+    settings["max_requests"] requests) and return the report for this run
+    '''
+    location_ids = []
+    if settings["database_uri"]:
+        try:
+            location_ids = load_location_ids(settings["database_uri"])
+        except Exception as e:
+            print(f"Could not sample location ids, harvesting them from search responses instead: {e}", flush=True)
+
+    server_stats_before = fetch_json(f"{settings['base_url']}/stats")
+    fake_openai_before = fetch_json(f"{settings['fake_openai_url']}/stats") if settings["fake_openai_url"] else None
+
+    stats = LoadStats()
+    budget = RequestBudget(settings["max_requests"])
+
+    start_time = time.perf_counter()
+    stop_at = time.monotonic() + settings["duration"]
+
+    users = []
+    for index in range(settings["concurrency"]):
+        user = VirtualUser(index, settings, stats, location_ids, stop_at, budget)
+        users.append(user)
+        user.start()
+        # Spread the ramp-up so the server is not hit by every virtual user in the same instant
+        if settings["ramp_up"]:
+            time.sleep(settings["ramp_up"] / settings["concurrency"])
+
+    for user in users:
+        user.join()
+
+    elapsed = time.perf_counter() - start_time
+
+    fake_openai_after = fetch_json(f"{settings['fake_openai_url']}/stats") if settings["fake_openai_url"] else None
+
+    return {
+        "label": settings["label"],
+        "worker_config": settings["worker_config"],
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "duration_seconds": elapsed,
+        "concurrency": settings["concurrency"],
+        "mix": settings["mix"],
+        "scenarios": summarize(stats, elapsed),
+        "server_stats_before": server_stats_before,
+        "server_stats_after": fetch_json(f"{settings['base_url']}/stats"),
+        "fake_openai": {"before": fake_openai_before, "after": fake_openai_after} if settings["fake_openai_url"] else None,
+    }
+
+def append_report(path, run):
+    '''
+    Add a run to the report at path, so runs against different worker configurations end up side by side
+    '''
+    try:
+        with open(path) as f:
+            report = json.load(f)
+    except FileNotFoundError:
+        report = {"runs": []}
+
+    report["runs"].append(run)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+def print_report(report):
+    print(f"{'run':<28}{'scenario':<11}{'reqs':>7}{'rps':>8}{'err%':>7}{'p50ms':>9}{'p99ms':>9}{'ttft p99':>10}")
+    for run in report["runs"]:
+        for name, scenario in sorted(run["scenarios"].items()):
+            latency = scenario["latency_ms"] or {}
+            ttft = scenario.get("time_to_first_frame_ms") or {}
+            print(
+                f"{run['label'][:27]:<28}{name:<11}{scenario['requests']:>7}{scenario['throughput_rps']:>8.2f}{100 * scenario['error_rate']:>7.1f}"
+                f"{latency.get('p50', float('nan')):>9.0f}{latency.get('p99', float('nan')):>9.0f}{ttft.get('p99', float('nan')):>10.0f}"
+            )
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name}, expected one of {', '.join(SCENARIOS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def add_load_arguments(parser):
+    parser.add_argument("--concurrency", type=int, default=20, help="Virtual users")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to run")
+    parser.add_argument("--max-requests", type=int, help="Stop after this many requests in total")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="Seconds over which virtual users start")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("search=5,stream=3,locations=2"), help="Scenario weights, e.g. search=5,stream=3,locations=2")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between a virtual user's requests in seconds")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--stream-grace", type=float, default=5.0, help="How long to wait for stream_end after the HTTP response")
+    parser.add_argument("--location-query-rate", type=float, default=0.5)
+    parser.add_argument("--repeat-query-rate", type=float, default=0.2, help="Fraction of queries drawn from a small fixed set (answer cache hits)")
+    parser.add_argument("--allow-external-rate", type=float, default=0.3)
+    parser.add_argument("--user-location-rate", type=float, default=0.3)
+    parser.add_argument("--turns-per-conversation", type=int, default=4)
+    parser.add_argument("--locations-per-request", type=int, default=10)
+    parser.add_argument("--database-uri", default=os.getenv("POSTGRES_DSN"), help="Database to sample /locations ids from")
+    parser.add_argument("--fake-openai-url", help="Fake OpenAI server, whose request counters are added to the report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join("loadtest", "reports", "loadtest.json"), help="Report file; runs are appended")
+
+def load_settings(args, base_url, label, worker_config=None):
+    return {
+        "base_url": base_url.rstrip("/"),
+        "label": label,
+        "worker_config": worker_config,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "max_requests": args.max_requests,
+        "ramp_up": args.ramp_up,
+        "mix": args.mix,
+        "think_time": args.think_time,
+        "timeout": args.timeout,
+        "stream_grace": args.stream_grace,
+        "location_query_rate": args.location_query_rate,
+        "repeat_query_rate": args.repeat_query_rate,
+        "allow_external_rate": args.allow_external_rate,
+        "user_location_rate": args.user_location_rate,
+        "turns_per_conversation": args.turns_per_conversation,
+        "locations_per_request": args.locations_per_request,
+        "database_uri": args.database_uri,
+        "fake_openai_url": args.fake_openai_url.rstrip("/") if args.fake_openai_url else None,
+        "seed": args.seed,
+    }
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Concurrent load against /formattedresults, /locations and the Socket.IO answer stream")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5050")
+    parser.add_argument("--label", help="Name of this run in the report, e.g. the worker configuration under test")
+    add_load_arguments(parser)
+    args = parser.parse_args()
+
+    settings = load_settings(args, args.base_url, args.label or args.base_url)
+    print(f"==> {settings['concurrency']} virtual users against {settings['base_url']} for {settings['duration']:.0f}s", flush=True)
+
+    report = append_report(args.output, run_load(settings))
+    print_report(report)
+    print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
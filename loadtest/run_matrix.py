@@ -0,0 +1,118 @@
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+from loadtest import fake_openai
+from loadtest.load_generator import add_load_arguments, append_report, load_settings, print_report, run_load
+
+def parse_worker_config(value):
+    '''
+    eventlet:1 / sync:4 / gthread:2x8 -> gunicorn worker class, process count and threads per process
+    '''
+    worker_class, _, size = value.partition(":")
+    workers, _, threads = (size or "1").partition("x")
+
+    if worker_class not in ("eventlet", "gthread", "sync"):
+        raise argparse.ArgumentTypeError(f"Unknown worker class {worker_class}, expected eventlet, gthread or sync")
+
+    return {"worker_class": worker_class, "workers": int(workers), "threads": int(threads or 1)}
+
+def gunicorn_command(config, bind):
+    command = [sys.executable, "-m", "gunicorn", "-k", config["worker_class"], "-w", str(config["workers"]), "-b", bind, "--timeout", "300"]
+    if config["worker_class"] == "gthread":
+        command += ["--threads", str(config["threads"])]
+    return command + ["main:app"]
+
+def wait_until_ready(base_url, process, timeout):
+    # Startup loads the retrievers and the location matrix, which takes a while on a full database
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode} during startup")
+        try:
+            if requests.get(f"{base_url}/stats", timeout=2).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+
+    raise RuntimeError(f"Server did not become ready within {timeout:.0f}s")
+
+def stop(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Load test the app under several gunicorn worker configurations against a local fake OpenAI")
+    parser.add_argument("configs", nargs="+", type=parse_worker_config, help="Worker configurations, e.g. eventlet:1 gthread:2x8 sync:4")
+    parser.add_argument("--port", type=int, default=5051, help="Port the app under test listens on")
+    parser.add_argument("--fake-openai-port", type=int, default=8089)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--server-log", default=os.path.join("loadtest", "reports", "server.log"))
+    add_load_arguments(parser)
+    args = parser.parse_args()
+
+    fake_openai_server = fake_openai.serve("127.0.0.1", args.fake_openai_port)
+    threading.Thread(target=fake_openai_server.serve_forever, daemon=True).start()
+    fake_openai_url = f"http://127.0.0.1:{args.fake_openai_port}"
+    args.fake_openai_url = fake_openai_url
+
+    # Both the openai client (OPENAI_BASE_URL) and the LangChain wrappers (OPENAI_API_BASE) talk to the fake server
+    environment = {
+        **os.environ,
+        "OPENAI_BASE_URL": f"{fake_openai_url}/v1",
+        "OPENAI_API_BASE": f"{fake_openai_url}/v1",
+        "OPENAI_API_KEY": "fake-openai-key",
+    }
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    os.makedirs(os.path.dirname(args.server_log) or ".", exist_ok=True)
+
+    report = None
+    for config in args.configs:
+        label = f"{config['worker_class']} w={config['workers']}" + (f" t={config['threads']}" if config["worker_class"] == "gthread" else "")
+        settings = load_settings(args, base_url, label, worker_config=config)
+
+        # Socket.IO emits only reach clients connected to the same process without a message queue, so the stream
+        # scenario is only meaningful with a single worker process
+        if config["workers"] > 1 and settings["mix"].get("stream"):
+            print(f"{label}: skipping the stream scenario, Socket.IO frames cannot cross worker processes", flush=True)
+            settings["mix"] = {name: weight for name, weight in settings["mix"].items() if name != "stream"}
+
+        print(f"==> {label}", flush=True)
+        with open(args.server_log, "a") as log:
+            log.write(f"\n==> {label}\n")
+            log.flush()
+            process = subprocess.Popen(gunicorn_command(config, f"127.0.0.1:{args.port}"), env=environment, stdout=log, stderr=subprocess.STDOUT)
+
+        try:
+            wait_until_ready(base_url, process, args.startup_timeout)
+            report = append_report(args.output, run_load(settings))
+        except Exception as e:
+            print(f"{label} failed: {e} (see {args.server_log})", flush=True)
+        finally:
+            stop(process)
+
+    fake_openai_server.shutdown()
+
+    if report:
+        print_report(report)
+        print(f"Report written to {args.output}")
+
+if __name__ == "__main__":
+    main()
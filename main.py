@@ -10,6 +10,8 @@ from datetime import timedelta
 from socketio_instance import socketio
 from database import db, bcrypt, revoked_tokens
 from routes.search_routes import search_routes_bp
+from routes.metrics_routes import metrics_routes_bp
+from observability import configure_logging, init_request_tracing
 
 load_dotenv()
 
@@ -35,6 +37,9 @@ def create_app():
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')  # Change this
 
     langchain.verbose = False
+
+    configure_logging()
+    init_request_tracing(app)
     
     CORS(app, supports_credentials=True)
     bcrypt.init_app(app)
@@ -54,6 +59,7 @@ def register_extensions(app):
 
 def register_blueprints(app):
     app.register_blueprint(search_routes_bp)
+    app.register_blueprint(metrics_routes_bp)
 
 def setup_database(app):
     with app.app_context():
@@ -0,0 +1,307 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Stages timed within a request: determine_search_type, history_load, condense, retrieval, judge_context,
+# fetch_external_context and generation, plus the smaller local_router / embed_query / answer_cache steps
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+
+STAGE_SECONDS = Histogram("ollie_stage_seconds", "Latency of one stage of a request", ["stage", "route_type"], buckets=STAGE_BUCKETS)
+REQUEST_SECONDS = Histogram("ollie_request_seconds", "End-to-end request latency", ["endpoint", "route_type", "status"], buckets=STAGE_BUCKETS)
+LLM_TOKENS = Counter("ollie_llm_tokens_total", "Tokens used by LLM calls", ["stage", "model", "kind"])
+LLM_CALLS = Counter("ollie_llm_calls_total", "LLM calls", ["stage", "model"])
+
+# Request ids accepted from the client (or a proxy) are limited to a safe alphabet and length
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# Requests slower than this log every span, not just the summary line
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 10))
+
+logger = logging.getLogger("ollie.trace")
+
+class RequestTrace:
+    '''
+    The spans and LLM calls of one request. It is shared by reference with every thread, green thread and task the
+    request fans out to, so it is only mutated under its lock.
+    '''
+
+    def __init__(self, request_id, endpoint):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.route_type = "unknown"
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.llm_calls = []
+        self.finished = False
+
+    def add_span(self, stage, seconds):
+        with self.lock:
+            self.spans.append((stage, seconds))
+
+    def add_llm_call(self, stage, model, prompt_tokens, completion_tokens, seconds):
+        with self.lock:
+            self.llm_calls.append({"stage": stage, "model": model, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "ms": round(1000 * seconds, 1)})
+
+    def finish(self, status):
+        '''
+        Export the spans under the route type the request ended up with, and log one summary line
+        '''
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            spans = list(self.spans)
+            llm_calls = list(self.llm_calls)
+
+        total_seconds = time.perf_counter() - self.start_time
+
+        for stage, seconds in spans:
+            STAGE_SECONDS.labels(stage, self.route_type).observe(seconds)
+        REQUEST_SECONDS.labels(self.endpoint, self.route_type, str(status)).observe(total_seconds)
+
+        stage_ms = {}
+        for stage, seconds in spans:
+            stage_ms[stage] = round(stage_ms.get(stage, 0.0) + 1000 * seconds, 1)
+
+        summary = {
+            "endpoint": self.endpoint,
+            "route_type": self.route_type,
+            "status": status,
+            "total_ms": round(1000 * total_seconds, 1),
+            "stages_ms": stage_ms,
+            "prompt_tokens": sum(call["prompt_tokens"] or 0 for call in llm_calls),
+            "completion_tokens": sum(call["completion_tokens"] or 0 for call in llm_calls),
+        }
+        if total_seconds >= SLOW_REQUEST_SECONDS:
+            summary["llm_calls"] = llm_calls
+
+        logger.info("request %s", json.dumps(summary))
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+def current_trace():
+    return _current_trace.get()
+
+def current_request_id():
+    trace = _current_trace.get()
+    return trace.request_id if trace else "-"
+
+def set_route_type(route_type):
+    trace = _current_trace.get()
+    if trace:
+        trace.route_type = route_type
+
+@contextlib.contextmanager
+def span(stage):
+    '''
+    Time a block as one stage of the current request. Outside a request the duration is exported directly.
+    '''
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start_time)
+
+def record_span(stage, seconds):
+    trace = _current_trace.get()
+    if trace:
+        trace.add_span(stage, seconds)
+    else:
+        STAGE_SECONDS.labels(stage, "none").observe(seconds)
+
+def record_llm_usage(stage, model, prompt_tokens, completion_tokens, seconds):
+    LLM_CALLS.labels(stage, model or "unknown").inc()
+    if prompt_tokens:
+        LLM_TOKENS.labels(stage, model or "unknown", "prompt").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(stage, model or "unknown", "completion").inc(completion_tokens)
+
+    trace = _current_trace.get()
+    if trace:
+        trace.add_llm_call(stage, model, prompt_tokens, completion_tokens, seconds)
+
+def record_completion(stage, response, seconds):
+    '''
+    Token usage of an openai chat completion response
+    '''
+    usage = getattr(response, "usage", None)
+    record_llm_usage(stage, getattr(response, "model", None), getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None), seconds)
+
+class LLMUsageCallbackHandler(BaseCallbackHandler):
+    '''
+    Times the condense and generation chains of a ConversationalRetrievalChain run and records the token usage of
+    every LLM call in them.
+
+    A chain tagged with a stage name (see ConversationalRetrievalChainFactory) starts that stage; nested runs inherit
+    the stage of their parent. Streaming completions carry no usage, so their tokens are counted with tiktoken.
+    '''
+
+    STAGES = ("condense", "generation")
+
+    def __init__(self):
+        self.run_inline = True
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.stage_starts = {}
+        self.llm_runs = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, **kwargs):
+        stage = next((tag for tag in tags or [] if tag in self.STAGES), None)
+
+        with self.lock:
+            if stage and self.stages.get(parent_run_id) != stage:
+                self.stage_starts[run_id] = time.perf_counter()
+            self.stages[run_id] = stage or self.stages.get(parent_run_id)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end_chain(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end_chain(run_id)
+
+    def _end_chain(self, run_id):
+        with self.lock:
+            stage = self.stages.pop(run_id, None)
+            start_time = self.stage_starts.pop(run_id, None)
+
+        if start_time is not None:
+            record_span(stage, time.perf_counter() - start_time)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        prompt = "\n".join(str(message.content) for batch in messages for message in batch)
+        self._start_llm(serialized, prompt, run_id, parent_run_id, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start_llm(serialized, "\n".join(prompts), run_id, parent_run_id, kwargs)
+
+    def _start_llm(self, serialized, prompt, run_id, parent_run_id, kwargs):
+        invocation = kwargs.get("invocation_params") or {}
+        model = invocation.get("model_name") or invocation.get("model") or (serialized or {}).get("kwargs", {}).get("model_name")
+
+        with self.lock:
+            self.llm_runs[run_id] = {
+                "stage": self.stages.get(parent_run_id) or "llm",
+                "model": model,
+                "prompt": prompt,
+                "streamed_tokens": 0,
+                "start_time": time.perf_counter(),
+            }
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self.lock:
+            run = self.llm_runs.get(run_id)
+            if run:
+                run["streamed_tokens"] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self.lock:
+            run = self.llm_runs.pop(run_id, None)
+        if run is None:
+            return
+
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+
+        if prompt_tokens is None:
+            prompt_tokens = count_tokens(run["prompt"], run["model"])
+        if completion_tokens is None:
+            completion_tokens = run["streamed_tokens"] or count_tokens("".join(g.text for generations in response.generations for g in generations), run["model"])
+
+        record_llm_usage(run["stage"], run["model"], prompt_tokens, completion_tokens, time.perf_counter() - run["start_time"])
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self.lock:
+            self.llm_runs.pop(run_id, None)
+
+_encodings = {}
+
+def count_tokens(text, model=None):
+    try:
+        import tiktoken
+
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model or "gpt-3.5-turbo")
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            _encodings[model] = encoding
+        return len(encoding.encode(text))
+    except Exception:
+        # Rough fallback when no encoding is available
+        return len(text) // 4
+
+class RequestIdFilter(logging.Filter):
+    '''
+    Adds the id of the request being served (or "-") to every log record as %(request_id)s
+    '''
+
+    def filter(self, record):
+        record.request_id = current_request_id()
+        return True
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+
+def configure_logging(level=None):
+    '''
+    Route logging through one stdout handler whose lines carry the request id, and tag gunicorn's own handlers too
+    '''
+    request_id_filter = RequestIdFilter()
+
+    root = logging.getLogger()
+    if not any(isinstance(f, RequestIdFilter) for handler in root.handlers for f in handler.filters):
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(request_id_filter)
+        root.addHandler(handler)
+    root.setLevel(level or os.getenv("LOG_LEVEL", "INFO"))
+
+    for name in ("gunicorn.error", "gunicorn.access"):
+        for handler in logging.getLogger(name).handlers:
+            handler.addFilter(request_id_filter)
+
+def init_request_tracing(app):
+    '''
+    Start a trace for every Flask request: the id comes from X-Request-ID when the client sends a valid one, is
+    echoed back in the response header, and the trace is exported when the request ends
+    '''
+    from flask import g, request
+
+    @app.before_request
+    def start_trace():
+        request_id = request.headers.get("X-Request-ID", "")
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+
+        g.trace = RequestTrace(request_id, request.url_rule.rule if request.url_rule else request.path)
+        g.trace_token = _current_trace.set(g.trace)
+
+    @app.after_request
+    def finish_trace(response):
+        trace = g.get("trace")
+        if trace:
+            response.headers["X-Request-ID"] = trace.request_id
+            trace.finish(response.status_code)
+        return response
+
+    @app.teardown_request
+    def reset_trace(error=None):
+        trace = g.get("trace")
+        if trace:
+            # Unhandled exceptions skip after_request
+            trace.finish(500)
+            _current_trace.reset(g.trace_token)
+
+def metrics_response():
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
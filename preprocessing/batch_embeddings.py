@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+
+def embedding_batches(texts, max_batch_size, max_batch_chars):
+    '''
+    Split texts into request-sized batches: at most max_batch_size inputs and roughly max_batch_chars characters each
+    '''
+    batch_start = 0
+    batch_chars = 0
+    for i, chunk_text in enumerate(texts):
+        if i > batch_start and (i - batch_start >= max_batch_size or batch_chars + len(chunk_text) > max_batch_chars):
+            yield batch_start, i
+            batch_start, batch_chars = i, 0
+        batch_chars += len(chunk_text)
+
+    if batch_start < len(texts):
+        yield batch_start, len(texts)
+
+def embed_concurrently(embeddings_model, texts, max_batch_size=512, max_batch_chars=400000, concurrency=4):
+    '''
+    Embed texts in provider-sized batches, with up to `concurrency` requests in flight
+    '''
+    vectors = [None] * len(texts)
+
+    def embed_batch(bounds):
+        start, end = bounds
+        vectors[start:end] = embeddings_model.embed_documents(texts[start:end])
+        return end - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        done = 0
+        for count in executor.map(embed_batch, embedding_batches(texts, max_batch_size, max_batch_chars)):
+            done += count
+            print(f"Embedded {done}/{len(texts)} chunks", flush=True)
+
+    return vectors
@@ -1,56 +1,242 @@
 import os
 import glob
-from datetime import datetime
+import hashlib
+import json
+import time
+import uuid
 
 from langchain.text_splitter import NLTKTextSplitter
 from langchain.document_loaders import TextLoader
-from langchain_postgres import PGVector
 from langchain_postgres.vectorstores import PGVector
 from langchain.embeddings import OpenAIEmbeddings
+from sqlalchemy import create_engine, text
+from caches.embedding_cache import build_cached_embeddings
+from preprocessing.batch_embeddings import embed_concurrently
+from vector_index import EMBEDDING_DIMENSIONS, ensure_collection_ann_index, ensure_fixed_dimension, resolve_collection_id
+
+# Chunk ids are derived from the collection, source file and chunk content, so unchanged chunks keep their row
+CHUNK_NAMESPACE = uuid.UUID("6f1c53e2-8a4b-4b8e-9a57-2f0c2b7d9e41")
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+def chunk_ids(collection_name, source, chunks):
+    '''
+    Content-addressed ids for a file's chunks. Identical chunks within one file are told apart by their occurrence.
+    '''
+    seen = {}
+    ids = []
+    for chunk in chunks:
+        content_hash = sha256_hex(chunk.page_content.encode("utf-8"))
+        occurrence = seen.get(content_hash, 0)
+        seen[content_hash] = occurrence + 1
+        ids.append(str(uuid.uuid5(CHUNK_NAMESPACE, f"{collection_name}\x00{source}\x00{content_hash}\x00{occurrence}")))
+    return ids
+
+def knowledge_base_source(source, documents_path):
+    '''
+    Rows written before the loader tracked files store the path the file was loaded from (./knowledge_base/videos/a.txt);
+    managed rows store it relative to the knowledge base (videos/a.txt)
+    '''
+    relative = os.path.relpath(os.path.normpath(source), os.path.normpath(documents_path))
+    return source if relative.startswith("..") else relative
+
+def load_existing_chunks(conn, collection_id, documents_path):
+    '''
+    The collection's rows by knowledge base file:
+      managed:   source -> (source_hash, chunk ids) for the rows this loader manages
+      unmanaged: source -> {content hash: row ids} for rows loaded some other way (seeded, or written by the original
+                 loader), whose ids are not content-addressed
+    '''
+    rows = conn.execute(text(f"""
+    SELECT id::text AS id, cmetadata->>'source' AS source, cmetadata->>'source_hash' AS source_hash,
+           CASE WHEN cmetadata ? 'source_hash' THEN NULL ELSE document END AS document
+    FROM langchain_pg_embedding
+    WHERE collection_id = '{collection_id}'
+    """)).fetchall()
+
+    managed, unmanaged = {}, {}
+    for row in rows:
+        if row.source_hash is not None:
+            source_hash, ids = managed.setdefault(row.source, (row.source_hash, set()))
+            ids.add(row.id)
+        elif row.source:
+            content_hash = sha256_hex((row.document or "").encode("utf-8"))
+            unmanaged.setdefault(knowledge_base_source(row.source, documents_path), {}).setdefault(content_hash, []).append(row.id)
+    return managed, unmanaged
 
 def load_docs(embeddings_model, documents_path, collection_name, database_uri):
     '''
-    Loads vectorized knowledge base embeddings into vector database (PGVector).
+    Incrementally loads the knowledge base into the live vector database collection (PGVector).
 
-    Iterates through knowledge base, calculates 1536 dimensional vector embeddings for each document and stores them in vector database.
+    Every file is hashed first and unchanged files are skipped without being split. Changed files are split and
+    each chunk gets a content-addressed id: chunks that already exist keep their row, only new chunks are embedded
+    (in batches, several requests at a time) and upserted, and chunks that no longer exist are deleted, as are the
+    chunks of files removed from the knowledge base. When anything changed, the collection's cmetadata version is
+    bumped in the same transaction as the writes, which also invalidates cached answers for the collection.
+
+    Rows of a knowledge base file that were loaded before it was managed (e.g. seeded) are taken over the first time
+    the file is seen: rows whose text matches a chunk are adopted under the chunk's id, keeping their embedding, and
+    the rest are deleted.
 
     Chunk size is currently set to 200 with an overlap of 0. This may have to be adjusted in the future.
 
-    Note: This function calls OpenAIEmbeddings() which costs money to run and can be fairly expensive so try to limit this operation.
-          Ideally, the vector database should only need to be loaded initially and whenever we have new data
+    Note: This function calls OpenAIEmbeddings() which costs money to run, so only changed chunks are ever embedded.
     '''
-    
+    start_time = time.perf_counter()
+
     text_splitter = NLTKTextSplitter()
 
     file_paths = glob.glob(os.path.join(documents_path, '**', '*.txt'), recursive=True)
 
-    vector_store = PGVector(
+    # Creates the collection on the first run, otherwise reuses the live one
+    PGVector(
         embeddings=embeddings_model,
         collection_name=collection_name,
         connection=database_uri,
+        embedding_length=EMBEDDING_DIMENSIONS,
         use_jsonb=True,
     )
 
-    # Process each file
+    engine = create_engine(database_uri)
+    collection_id = resolve_collection_id(engine, collection_name)
+
+    with engine.connect() as conn:
+        existing, unmanaged = load_existing_chunks(conn, collection_id, documents_path)
+
+    new_texts, new_metadatas, new_ids = [], [], []
+    kept_ids_by_hash = {}
+    adopted = []
+    stale_ids = set()
+    skipped_files = 0
+    changed_files = 0
+
     for file_path in file_paths:
+        source = os.path.relpath(file_path, documents_path)
+
+        # Claimed before reading, so a file that fails to read keeps its rows instead of counting as removed
+        stored_hash, stored_ids = existing.pop(source, (None, set()))
+        unmanaged_rows = unmanaged.pop(source, {})
+
         try:
+            with open(file_path, "rb") as f:
+                source_hash = sha256_hex(f.read())
+
+            if stored_hash == source_hash and not unmanaged_rows:
+                skipped_files += 1
+                continue
+
             # Load and split the document
             loader = TextLoader(file_path)
             docs = loader.load_and_split(text_splitter=text_splitter)
+            ids = chunk_ids(collection_name, source, docs)
+
+            for doc, chunk_id in zip(docs, ids):
+                if chunk_id in stored_ids:
+                    kept_ids_by_hash.setdefault(source_hash, []).append(chunk_id)
+                    continue
+
+                metadata = {**doc.metadata, "source": source, "source_hash": source_hash}
 
-            # Add documents to the vector store
-            vector_store.add_documents(docs)
+                matching_rows = unmanaged_rows.get(sha256_hex(doc.page_content.encode("utf-8")))
+                if matching_rows:
+                    adopted.append({"old_id": matching_rows.pop(), "id": chunk_id, "cmetadata": json.dumps(metadata)})
+                    continue
+
+                new_texts.append(doc.page_content)
+                new_metadatas.append(metadata)
+                new_ids.append(chunk_id)
+
+            stale_ids.update(stored_ids - set(ids))
+            for row_ids in unmanaged_rows.values():
+                stale_ids.update(row_ids)
+            changed_files += 1
 
             print(f"Processed {file_path}")
         except Exception as e:
             print(f"Error processing {file_path}: {e}")
 
+    # Whatever is left in existing belongs to files that were removed from the knowledge base. Unmanaged rows that
+    # match no file are left alone, since they may not come from the knowledge base at all.
+    for _, stored_ids in existing.values():
+        stale_ids.update(stored_ids)
+
+    if unmanaged:
+        print(f"Left {sum(len(ids) for rows in unmanaged.values() for ids in rows.values())} rows from {len(unmanaged)} sources that match no file in {documents_path} untouched")
+
+    vectors = []
+    if new_texts:
+        vectors = embed_concurrently(
+            embeddings_model,
+            new_texts,
+            max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 512)),
+            concurrency=int(os.getenv("EMBEDDING_CONCURRENCY", 4)),
+        )
+
+    # New chunks, adopted and deleted rows and the version bump commit together, so readers never see a collection
+    # whose rows changed without its version (and the answer cache keyed on it) changing
+    with engine.begin() as conn:
+        if new_ids:
+            conn.execute(text("""
+            INSERT INTO langchain_pg_embedding (id, collection_id, embedding, document, cmetadata)
+            VALUES (CAST(:id AS UUID), CAST(:collection_id AS UUID), CAST(:embedding AS vector), :document, CAST(:cmetadata AS JSONB))
+            ON CONFLICT (id) DO UPDATE SET embedding = EXCLUDED.embedding, document = EXCLUDED.document, cmetadata = EXCLUDED.cmetadata
+            """), [
+                {
+                    "id": chunk_id,
+                    "collection_id": collection_id,
+                    "embedding": "[" + ",".join(str(float(x)) for x in vector) + "]",
+                    "document": document,
+                    "cmetadata": json.dumps(metadata),
+                }
+                for chunk_id, vector, document, metadata in zip(new_ids, vectors, new_texts, new_metadatas)
+            ])
+
+        if adopted:
+            conn.execute(text("""
+            UPDATE langchain_pg_embedding
+            SET id = CAST(:id AS UUID), cmetadata = CAST(:cmetadata AS JSONB)
+            WHERE id = CAST(:old_id AS UUID)
+            """), adopted)
+
+        # Unchanged chunks of a changed file stay, but now belong to the file's new version
+        for source_hash, ids in kept_ids_by_hash.items():
+            conn.execute(text("""
+            UPDATE langchain_pg_embedding
+            SET cmetadata = jsonb_set(cmetadata, '{source_hash}', to_jsonb(CAST(:source_hash AS TEXT)))
+            WHERE id = ANY(CAST(:ids AS UUID[]))
+            """), {"source_hash": source_hash, "ids": ids})
+
+        if stale_ids:
+            conn.execute(text("DELETE FROM langchain_pg_embedding WHERE id = ANY(CAST(:ids AS UUID[]))"), {"ids": list(stale_ids)})
+
+        if new_ids or adopted or stale_ids or kept_ids_by_hash:
+            conn.execute(text("""
+            UPDATE langchain_pg_collection
+            SET cmetadata = coalesce(cmetadata, '{}'::jsonb) || jsonb_build_object(
+                'version', coalesce((cmetadata->>'version')::int, 0) + 1,
+                'updated_at', now()
+            )
+            WHERE uuid = CAST(:collection_id AS UUID)
+            """), {"collection_id": collection_id})
+
+        # Build the collection's ANN index once its rows are in place (a no-op when it already exists)
+        ensure_fixed_dimension(conn)
+        print(f"ANN index {ensure_collection_ann_index(conn, collection_id)} is in place")
+
+    print(
+        f"{collection_name}: {skipped_files} unchanged files skipped, {changed_files} changed, "
+        f"{len(new_ids)} chunks embedded, {len(adopted)} adopted, {len(stale_ids)} deleted in {time.perf_counter() - start_time:.1f}s",
+        flush=True,
+    )
+
 docs_path = "./knowledge_base/"
-collection_name = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Load into the live collection served by the app (set PGVECTOR_COLLECTION to build a separate one)
+collection_name = os.getenv("PGVECTOR_COLLECTION", '2024-11-15 12:59:57')
 database_uri = os.getenv("POSTGRESQL_CONNECTION_STRING")
 
 # Using OpenAI embeddings for now
 openai_api_key = os.getenv("OPENAI_API_KEY")
-embeddings_model = OpenAIEmbeddings(openai_api_key=openai_api_key)
+embeddings_model = build_cached_embeddings(OpenAIEmbeddings(openai_api_key=openai_api_key), database_uri)
 
-load_docs(embeddings_model=embeddings_model, documents_path=docs_path, collection_name=collection_name, database_uri=database_uri)
\ No newline at end of file
+load_docs(embeddings_model=embeddings_model, documents_path=docs_path, collection_name=collection_name, database_uri=database_uri)
@@ -1,100 +1,138 @@
 import os
+import time
 import pandas as pd
 from langchain.embeddings import OpenAIEmbeddings
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from database import Location
+from psycopg2 import connect
+from psycopg2.extras import execute_values
+from caches.embedding_cache import build_cached_embeddings
+from connection_pool import libpq_uri
+from preprocessing.batch_embeddings import embed_concurrently
 
-def load_and_store_locations(embeddings_model, csv_path, database_uri):
+LOCATION_COLUMNS = ["id", "name", "address", "city", "state", "country", "zip_code", "county", "latitude", "longitude", "description", "phone",
+                    "sunday_hours", "monday_hours", "tuesday_hours", "wednesday_hours", "thursday_hours", "friday_hours", "saturday_hours",
+                    "rating", "address_link", "website", "resource_type"]
+
+def location_embedding_text(location):
+    '''
+    The text embedded for a location. A row is only re-embedded when this text changes.
+    '''
+    return f"""name={location['name']}, description={location['description']}, address={location['address']}, city={location['city']}, state={location['state']},
+        country={location['country']}, zip_code={location['zip_code']}, county={location['county']}, phone={location['phone']}, sunday_hours={location['sunday_hours']}, monday_hours={location['monday_hours']}, tuesday_hours={location['tuesday_hours']},
+        wednesday_hours={location['wednesday_hours']}, thursday_hours={location['thursday_hours']}, friday_hours={location['friday_hours']}, saturday_hours={location['saturday_hours']}, rating={location['rating']}, resource_type={location['resource_type']}"""
+
+def read_location_chunks(csv_path, chunk_size):
+    '''
+    Stream the CSV chunk_size rows at a time as lists of dicts. Every value is read as text (missing values as '')
+    so the embedded text matches what is stored in the location table.
+    '''
+    for df in pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunk_size):
+        yield df[LOCATION_COLUMNS].to_dict("records")
+
+def existing_embedding_texts(cursor, ids):
+    '''
+    id -> embedded text for the rows that already exist with an embedding
+    '''
+    columns_str = ", ".join(LOCATION_COLUMNS)
+    cursor.execute(f'SELECT {columns_str} FROM "location" WHERE id = ANY(%s) AND embedding IS NOT NULL', (ids,))
+
+    texts = {}
+    for row in cursor.fetchall():
+        location = {column: "" if value is None else value for column, value in zip(LOCATION_COLUMNS, row)}
+        texts[location["id"]] = location_embedding_text(location)
+    return texts
+
+def upsert_locations(cursor, locations, embeddings):
+    '''
+    Insert or update a batch of locations in one statement. A None embedding keeps the row's current vector.
+    '''
+    columns_str = ", ".join(LOCATION_COLUMNS)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in LOCATION_COLUMNS if column != "id")
+
+    rows = []
+    for location, embedding in zip(locations, embeddings):
+        values = [location[column] for column in LOCATION_COLUMNS]
+        values[LOCATION_COLUMNS.index("latitude")] = float(location["latitude"])
+        values[LOCATION_COLUMNS.index("longitude")] = float(location["longitude"])
+        values[LOCATION_COLUMNS.index("rating")] = location["rating"] or None
+        values[LOCATION_COLUMNS.index("address_link")] = location["address_link"] or None
+        rows.append(values + ["[" + ",".join(str(float(x)) for x in embedding) + "]" if embedding is not None else None])
+
+    execute_values(cursor, f"""
+    INSERT INTO "location" ({columns_str}, embedding) VALUES %s
+    ON CONFLICT (id) DO UPDATE SET {updates}, embedding = COALESCE(EXCLUDED.embedding, "location".embedding)
+    """, rows, template="(" + ", ".join(["%s"] * len(LOCATION_COLUMNS)) + ", %s::vector)", page_size=1000)
+
+def load_and_store_locations(embeddings_model, csv_path, database_uri, chunk_size=2000):
     """
-    Load location data from a CSV, insert data into the 'location' table, 
-    vectorize descriptions, and store vectors in the 'embeddings' column.
+    Load location data from a CSV into the 'location' table, vectorize each location and store the vectors in the
+    'embedding' column.
 
-    Note: This function calls OpenAIEmbeddings() which costs money to run and can be fairly expensive so try to limit this operation.
-          Ideally, the vector database should only need to be loaded initially and whenever we have new data
+    The CSV is streamed in chunks. For each chunk, only rows that are new or whose embedded text changed are sent to
+    the embeddings model (in batches, several requests at a time); the whole chunk is then upserted on id in one
+    statement and committed. A chunk that fails is retried row by row so one bad row does not drop the others.
 
+    Note: This function calls OpenAIEmbeddings() which costs money to run, so unchanged rows are never re-embedded.
     """
+    start_time = time.perf_counter()
+    conn = connect(libpq_uri(database_uri))
+
+    processed = 0
+    embedded = 0
+    failed = 0
+
+    try:
+        for locations in read_location_chunks(csv_path, chunk_size):
+            texts = [location_embedding_text(location) for location in locations]
 
-    engine = create_engine(database_uri)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    df = pd.read_csv(csv_path)
-
-    for _, row in df.iterrows():
-        id=row['id'],
-        name=row['name']
-        address=row['address']
-        city=row['city']
-        state=row['state']
-        country=row['country']
-        zip_code=row['zip_code']
-        county=row['county']
-        latitude=row['latitude']
-        longitude=row['longitude']
-        description=row['description']
-        phone=row['phone']
-        sunday_hours=row['sunday_hours']
-        monday_hours=row['monday_hours']
-        tuesday_hours=row['tuesday_hours']
-        wednesday_hours=row['wednesday_hours']
-        thursday_hours=row['thursday_hours']
-        friday_hours=row['friday_hours']
-        saturday_hours=row['saturday_hours']
-        rating=row['rating']
-        address_link=row['address_link']
-        website=row['website']
-        resource_type=row['resource_type']
-
-        text_to_embed = f"""name={name}, description={description}, address={address}, city={city}, state={state},
-        country={country}, zip_code={zip_code}, county={county}, phone={phone}, sunday_hours={sunday_hours}, monday_hours={monday_hours}, tuesday_hours={tuesday_hours},
-        wednesday_hours={wednesday_hours}, thursday_hours={thursday_hours}, friday_hours={friday_hours}, saturday_hours={saturday_hours}, rating={rating}, resource_type={resource_type}"""
-        
-        try:
-            embedding = embeddings_model.embed_query(text_to_embed)
-
-            new_location = Location(
-                id=id,
-                name=name,
-                address=address,
-                city=city,
-                state=state,
-                country=country,
-                zip_code=zip_code,
-                county=county,
-                latitude=latitude,
-                longitude=longitude,
-                description=description,
-                phone=phone,
-                sunday_hours=sunday_hours,
-                monday_hours=monday_hours,
-                tuesday_hours=tuesday_hours,
-                wednesday_hours=wednesday_hours,
-                thursday_hours=thursday_hours,
-                friday_hours=friday_hours,
-                saturday_hours=saturday_hours,
-                rating=rating,
-                address_link=address_link,
-                website=website,
-                resource_type=resource_type,
-                embedding=embedding
-            )
-
-            session.add(new_location)
-
-            print(f"Added new location, {name}")
-        except Exception as e:
-            print(f"Error inserting location {row['name']}: {e}")
-
-        session.commit()
-        session.close()
+            with conn.cursor() as cursor:
+                stored_texts = existing_embedding_texts(cursor, [location["id"] for location in locations])
+            conn.commit()
+
+            changed = [i for i, location in enumerate(locations) if stored_texts.get(location["id"]) != texts[i]]
+
+            embeddings = [None] * len(locations)
+            if changed:
+                vectors = embed_concurrently(
+                    embeddings_model,
+                    [texts[i] for i in changed],
+                    max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 512)),
+                    concurrency=int(os.getenv("EMBEDDING_CONCURRENCY", 4)),
+                )
+                for i, vector in zip(changed, vectors):
+                    embeddings[i] = vector
+
+            try:
+                with conn.cursor() as cursor:
+                    upsert_locations(cursor, locations, embeddings)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Batch upsert failed ({e}), retrying row by row")
+
+                for location, embedding in zip(locations, embeddings):
+                    try:
+                        with conn.cursor() as cursor:
+                            upsert_locations(cursor, [location], [embedding])
+                        conn.commit()
+                    except Exception as e:
+                        conn.rollback()
+                        failed += 1
+                        print(f"Error inserting location {location['name']}: {e}")
+
+            processed += len(locations)
+            embedded += len(changed)
+
+            elapsed = time.perf_counter() - start_time
+            print(f"{processed} locations loaded, {embedded} embedded, {failed} failed ({processed / max(elapsed, 1e-9):.0f} rows/sec)", flush=True)
+    finally:
+        conn.close()
+
+database_uri = os.getenv("POSTGRESQL_CONNECTION_STRING")
 
 # Using OpenAI embeddings for now
 openai_api_key = os.getenv("OPENAI_API_KEY")
-embeddings_model = OpenAIEmbeddings(openai_api_key=openai_api_key)
+embeddings_model = build_cached_embeddings(OpenAIEmbeddings(openai_api_key=openai_api_key), database_uri)
 
 csv_path = "knowledge_base/locations.csv"
 
-database_uri = os.getenv("POSTGRESQL_CONNECTION_STRING")
-
-load_and_store_locations(embeddings_model=embeddings_model, csv_path="knowledge_base/locations.csv", database_uri=database_uri)
\ No newline at end of file
+load_and_store_locations(embeddings_model=embeddings_model, csv_path=csv_path, database_uri=database_uri)
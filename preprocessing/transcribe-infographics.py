@@ -1,52 +1,156 @@
-from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
 import pytesseract
+import hashlib
+import json
 import os
 
 input_folder = 'infographics'
 output_folder = 'transcribed-infographics'
 
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
+# OCR output per page, keyed by the input file's hash and the page number, so interrupted runs resume where they
+# stopped and unchanged pages are never OCRed twice
+cache_folder = os.getenv("OCR_CACHE_DIR", os.path.join(output_folder, ".page-cache"))
+
+# input filename -> hash of the input its transcription was built from
+manifest_path = os.path.join(output_folder, ".manifest.json")
+
+workers = int(os.getenv("OCR_WORKERS", os.cpu_count() or 1))
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_atomic(path, content):
+    # Write to a temporary file and rename it, so an interrupted run never leaves a truncated file behind
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
+
+def page_cache_path(input_hash, page_number):
+    return os.path.join(cache_folder, input_hash, f"{page_number}.txt")
+
+def page_count(file_path):
+    if file_path.endswith(".pdf"):
+        return pdfinfo_from_path(file_path)["Pages"]
+    return 1
+
+def transcribe_page(file_path, input_hash, page_number):
+    '''
+    OCR a single page in a worker process and store it in the page cache.
+    Only this page is rasterized, so memory stays flat however long the PDF is.
+    '''
+    if file_path.endswith(".pdf"):
+        image = convert_from_path(file_path, first_page=page_number, last_page=page_number)[0]
+    else:
+        image = Image.open(file_path)
 
-def transcribe_image(image):
     try:
         text = pytesseract.image_to_string(image)
-        return text
-    except Exception as e:
-        print(f"Error during transcription: {e}")
-        return ""
-
-def process_pdf(pdf_path):
-    images = convert_from_path(pdf_path)
-    full_transcription = ""
-
-    for i, image in enumerate(images):
-        print(f"Transcribing {os.path.basename(pdf_path)} page {i+1}...")
-        transcription = transcribe_image(image)
-        full_transcription += transcription + "\n"
-
-    # save transcription to corresponding txt
-    output_file_path = os.path.join(output_folder, f"{os.path.basename(pdf_path)}.txt")
-    with open(output_file_path, "w") as text_file:
-        text_file.write(full_transcription)
-    # print(f"Saved full transcription for {os.path.basename(pdf_path)}.\n")
-
-for filename in os.listdir(input_folder):
-    file_path = os.path.join(input_folder, filename)
-
-    if filename.endswith(".pdf"):
-        print(f"Processing PDF: {filename}")
-        process_pdf(file_path)
-
-    elif filename.endswith(".jpg") or filename.endswith(".jpeg") or filename.endswith(".png"):
-        # print(f"Processing image: {filename}")
-        with Image.open(file_path) as img:
-            transcription = transcribe_image(img)
-
-        output_file_path = os.path.join(output_folder, f"{filename}.txt")
-        with open(output_file_path, "w") as text_file:
-            text_file.write(transcription)
-        print(f"Saved transcription for {filename}.\n")
-
-print("All files processed and cleaned up.")
+    finally:
+        image.close()
+
+    write_atomic(page_cache_path(input_hash, page_number), text)
+    return file_path, page_number
+
+def write_transcription(filename, file_path, input_hash, pages):
+    # PDFs end every page with a newline; images are written as is
+    output_file_path = os.path.join(output_folder, f"{filename}.txt")
+    temporary_path = f"{output_file_path}.tmp"
+
+    with open(temporary_path, "w") as text_file:
+        for page_number in range(1, pages + 1):
+            with open(page_cache_path(input_hash, page_number)) as page_file:
+                text_file.write(page_file.read())
+            if file_path.endswith(".pdf"):
+                text_file.write("\n")
+
+    os.replace(temporary_path, output_file_path)
+
+def load_manifest():
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def main():
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = load_manifest()
+
+    pending = {}
+    skipped = 0
+
+    for filename in sorted(os.listdir(input_folder)):
+        file_path = os.path.join(input_folder, filename)
+        if not (filename.endswith(".pdf") or filename.endswith(IMAGE_EXTENSIONS)):
+            continue
+
+        input_hash = file_hash(file_path)
+        if manifest.get(filename) == input_hash and os.path.exists(os.path.join(output_folder, f"{filename}.txt")):
+            skipped += 1
+            continue
+
+        try:
+            pages = page_count(file_path)
+        except Exception as e:
+            print(f"Error reading {filename}: {e}")
+            continue
+
+        os.makedirs(os.path.join(cache_folder, input_hash), exist_ok=True)
+        missing = [page for page in range(1, pages + 1) if not os.path.exists(page_cache_path(input_hash, page))]
+        pending[file_path] = {"filename": filename, "hash": input_hash, "pages": pages, "missing": set(missing), "failed": False}
+
+    print(f"{skipped} unchanged files skipped, {len(pending)} to transcribe with {workers} workers")
+
+    def finish(file_path):
+        entry = pending[file_path]
+        write_transcription(entry["filename"], file_path, entry["hash"], entry["pages"])
+        manifest[entry["filename"]] = entry["hash"]
+        write_atomic(manifest_path, json.dumps(manifest, indent=2, sort_keys=True))
+        print(f"Saved transcription for {entry['filename']}")
+
+    # Files whose pages are all cached already (e.g. an interrupted run) only need their output written
+    for file_path, entry in pending.items():
+        if not entry["missing"]:
+            finish(file_path)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(transcribe_page, file_path, entry["hash"], page): (file_path, page)
+            for file_path, entry in pending.items()
+            for page in sorted(entry["missing"])
+        }
+
+        for future in as_completed(futures):
+            file_path, page_number = futures[future]
+            entry = pending[file_path]
+
+            try:
+                future.result()
+            except Exception as e:
+                entry["failed"] = True
+                print(f"Error transcribing {entry['filename']} page {page_number}: {e}")
+                continue
+
+            entry["missing"].discard(page_number)
+            print(f"Transcribed {entry['filename']} page {page_number}/{entry['pages']}")
+
+            if not entry["missing"] and not entry["failed"]:
+                finish(file_path)
+
+    failed = [entry["filename"] for entry in pending.values() if entry["failed"]]
+    if failed:
+        print(f"Failed pages in {len(failed)} files, rerun to retry them: {', '.join(failed)}")
+
+    print("All files processed.")
+
+if __name__ == "__main__":
+    main()
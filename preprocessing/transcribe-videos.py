@@ -1,45 +1,264 @@
 import os
-import speech_recognition as sr
-from moviepy.editor import VideoFileClip
-import tempfile
+import re
+import json
+import wave
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 input_folder = 'video-files'
 output_folder = 'transcribed-files'
 
-recognizer = sr.Recognizer()
+# Extracted audio and per-window transcripts, keyed by the video's hash, so a failed run resumes where it stopped
+checkpoint_folder = os.getenv("TRANSCRIBE_CHECKPOINT_DIR", os.path.join(output_folder, ".checkpoints"))
+
+# video filename -> hash of the video its transcription was built from
+manifest_path = os.path.join(output_folder, ".manifest.json")
+
+# "google" (speech_recognition's Google Web Speech API) or "stub" (offline, for testing the pipeline)
+backend_name = os.getenv("TRANSCRIBE_BACKEND", "google")
+
+workers = int(os.getenv("TRANSCRIBE_WORKERS", 4))
+window_seconds = float(os.getenv("TRANSCRIBE_WINDOW_SECONDS", 30))
+overlap_seconds = float(os.getenv("TRANSCRIBE_OVERLAP_SECONDS", 2))
+
+SAMPLE_RATE = 16000
+VIDEO_EXTENSIONS = ('.mp4', '.mov')
+
+class UnintelligibleAudio(Exception):
+    pass
+
+class GoogleBackend:
+    def __init__(self):
+        import speech_recognition as sr
+
+        self.sr = sr
+        self.recognizer = sr.Recognizer()
+
+    def transcribe(self, pcm, sample_rate, sample_width, start_seconds, end_seconds):
+        try:
+            return self.recognizer.recognize_google(self.sr.AudioData(pcm, sample_rate, sample_width))
+        except self.sr.UnknownValueError:
+            raise UnintelligibleAudio()
+
+class StubBackend:
+    '''
+    Offline backend: "transcribes" a window as one word per whole second it covers (t0 t1 t2 ...), so overlapping
+    windows produce overlapping text and stitching can be checked without a recognition service
+    '''
+
+    def transcribe(self, pcm, sample_rate, sample_width, start_seconds, end_seconds):
+        first_second = int(-(-start_seconds // 1))
+        return " ".join(f"t{second}" for second in range(first_second, int(end_seconds) + 1) if second < end_seconds)
+
+BACKENDS = {"google": GoogleBackend, "stub": StubBackend}
+
+_backend = None
+
+def get_backend():
+    # One backend per worker process
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[backend_name]()
+    return _backend
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_atomic(path, content):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
+
+def is_transcription_wav(path):
+    '''
+    True for a WAV that is already 16 kHz mono 16-bit, the format every window is read in
+    '''
+    try:
+        with wave.open(path, "rb") as audio:
+            return audio.getnchannels() == 1 and audio.getframerate() == SAMPLE_RATE and audio.getsampwidth() == 2
+    except (wave.Error, EOFError):
+        return False
+
+def extract_audio(video_path, audio_path):
+    '''
+    Write the video's audio track as 16 kHz mono 16-bit WAV. ffmpeg streams it to disk; it is never held in memory.
+    WAV inputs already in that format are copied; any other WAV (stereo, 44.1 kHz, float) is converted the same way.
+    '''
+    if os.path.exists(audio_path):
+        return
+
+    is_wav = video_path.lower().endswith(".wav")
+    if is_wav and is_transcription_wav(video_path):
+        shutil.copyfile(video_path, audio_path)
+        return
+
+    from moviepy.editor import AudioFileClip, VideoFileClip
+
+    temporary_path = f"{audio_path}.tmp.wav"
+    if is_wav:
+        with AudioFileClip(video_path) as audio:
+            audio.write_audiofile(temporary_path, fps=SAMPLE_RATE, nbytes=2, ffmpeg_params=["-ac", "1"], logger=None)
+    else:
+        with VideoFileClip(video_path) as video:
+            video.audio.write_audiofile(temporary_path, fps=SAMPLE_RATE, nbytes=2, ffmpeg_params=["-ac", "1"], logger=None)
+    os.replace(temporary_path, audio_path)
+
+def audio_windows(audio_path):
+    '''
+    (index, start, end) in seconds for fixed-length windows that overlap by overlap_seconds
+    '''
+    with wave.open(audio_path, "rb") as audio:
+        duration = audio.getnframes() / audio.getframerate()
+
+    step = window_seconds - overlap_seconds
+    windows = []
+    start = 0.0
+    while start < duration or not windows:
+        windows.append((len(windows), start, min(start + window_seconds, duration)))
+        if start + window_seconds >= duration:
+            break
+        start += step
+    return windows
+
+def window_checkpoint_path(video_hash, index):
+    return os.path.join(checkpoint_folder, video_hash, f"{index}.json")
+
+def transcribe_window(audio_path, video_hash, index, start_seconds, end_seconds):
+    '''
+    Read one window of the WAV in a worker process, transcribe it and checkpoint the result
+    '''
+    with wave.open(audio_path, "rb") as audio:
+        sample_rate = audio.getframerate()
+        audio.setpos(int(start_seconds * sample_rate))
+        pcm = audio.readframes(int((end_seconds - start_seconds) * sample_rate))
+        sample_width = audio.getsampwidth()
+
+    try:
+        result = {"text": get_backend().transcribe(pcm, sample_rate, sample_width, start_seconds, end_seconds), "intelligible": True}
+    except UnintelligibleAudio:
+        result = {"text": "", "intelligible": False}
+
+    write_atomic(window_checkpoint_path(video_hash, index), json.dumps(result))
+    return index
+
+def normalize_word(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+def stitch(texts, max_overlap_words=20):
+    '''
+    Join window transcripts in order, dropping the words a window repeats from the end of the previous one
+    '''
+    words = []
+    for text in texts:
+        next_words = text.split()
+
+        overlap = 0
+        for k in range(min(max_overlap_words, len(words), len(next_words)), 0, -1):
+            if [normalize_word(w) for w in words[-k:]] == [normalize_word(w) for w in next_words[:k]]:
+                overlap = k
+                break
+
+        words.extend(next_words[overlap:])
+
+    return " ".join(words)
+
+def load_manifest():
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def main():
+    # Each window starts window_seconds - overlap_seconds after the last one, so that step has to be positive
+    if window_seconds <= 0 or overlap_seconds < 0 or overlap_seconds >= window_seconds:
+        raise SystemExit(f"TRANSCRIBE_WINDOW_SECONDS ({window_seconds:g}) must be positive and greater than TRANSCRIBE_OVERLAP_SECONDS ({overlap_seconds:g}), which must not be negative")
+
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = load_manifest()
+
+    pending = {}
+
+    for file in sorted(os.listdir(input_folder)):
+        if not file.lower().endswith(VIDEO_EXTENSIONS + ('.wav',)):
+            continue
 
-for file in os.listdir(input_folder):
-    
-    if file.lower().endswith(('.mp4', '.mov')):
         video_path = os.path.join(input_folder, file)
-        
+
         try:
-            # extract audio only (as .wav)
-            video = VideoFileClip(video_path)
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=True) as temp_audio_file:
-                temp_audio_path = temp_audio_file.name
-                video.audio.write_audiofile(temp_audio_path)
-
-                # transcribe audio
-                with sr.AudioFile(temp_audio_path) as source:
-                    audio = recognizer.record(source)
-                    try:
-                        text = recognizer.recognize_google(audio)
-                    except sr.UnknownValueError:
-                        text = "Could not understand audio"
-                        # make a list of vids that wasn't able to be transcribed
-                        with open('transcribed-err.txt', 'a') as txt_err_file:
-                            txt_err_file.write(file + '\n')
-                    except sr.RequestError as e:
-                        text = f"Error with the request: {e}"
-        
-            # save transcription to corresponding txt
-            txt_filename = os.path.splitext(file)[0] + '.txt'
-            txt_path = os.path.join(output_folder, txt_filename)
-            with open(txt_path, 'w') as txt_file:
-                txt_file.write(text)
-        
-            print(f'Transcription for {file} saved as {txt_filename}')
-        
+            video_hash = file_hash(video_path)
+            txt_path = os.path.join(output_folder, os.path.splitext(file)[0] + '.txt')
+            if manifest.get(file) == video_hash and os.path.exists(txt_path):
+                continue
+
+            os.makedirs(os.path.join(checkpoint_folder, video_hash), exist_ok=True)
+            audio_path = os.path.join(checkpoint_folder, video_hash, "audio.wav")
+            extract_audio(video_path, audio_path)
+
+            windows = audio_windows(audio_path)
+            missing = [w for w in windows if not os.path.exists(window_checkpoint_path(video_hash, w[0]))]
+            pending[file] = {"hash": video_hash, "audio": audio_path, "txt": txt_path, "windows": len(windows), "missing": missing, "failed": False}
         except Exception as e:
             print(f"An error occurred while processing {file}: {e}")
+
+    def finish(file):
+        entry = pending[file]
+        results = []
+        for index in range(entry["windows"]):
+            with open(window_checkpoint_path(entry["hash"], index)) as f:
+                results.append(json.load(f))
+
+        if any(result["intelligible"] for result in results):
+            text = stitch(result["text"] for result in results)
+        else:
+            text = "Could not understand audio"
+            # make a list of vids that wasn't able to be transcribed
+            with open('transcribed-err.txt', 'a') as txt_err_file:
+                txt_err_file.write(file + '\n')
+
+        write_atomic(entry["txt"], text)
+        manifest[file] = entry["hash"]
+        write_atomic(manifest_path, json.dumps(manifest, indent=2, sort_keys=True))
+        print(f'Transcription for {file} saved as {os.path.basename(entry["txt"])}')
+
+    remaining = {file: len(entry["missing"]) for file, entry in pending.items()}
+    for file, count in remaining.items():
+        if count == 0:
+            finish(file)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(transcribe_window, entry["audio"], entry["hash"], index, start, end): (file, index)
+            for file, entry in pending.items()
+            for index, start, end in entry["missing"]
+        }
+
+        for future in as_completed(futures):
+            file, index = futures[future]
+            entry = pending[file]
+
+            try:
+                future.result()
+            except Exception as e:
+                # Not checkpointed, so the window is retried on the next run
+                entry["failed"] = True
+                print(f"Error transcribing {file} window {index}: {e}")
+            else:
+                print(f"Transcribed {file} window {index + 1}/{entry['windows']}")
+
+            remaining[file] -= 1
+            if remaining[file] == 0 and not entry["failed"]:
+                finish(file)
+
+    failed = [file for file, entry in pending.items() if entry["failed"]]
+    if failed:
+        print(f"Failed windows in {len(failed)} videos, rerun to retry them: {', '.join(failed)}")
+
+if __name__ == "__main__":
+    main()
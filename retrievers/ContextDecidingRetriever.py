@@ -1,15 +1,31 @@
+import asyncio
+import contextvars
+import logging
 import openai
 import json
 import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.documents import Document
 
-def judge_context(query, context_docs):
-    """
-    True  -> context is sufficient
-    False -> context is insufficient (should fetch extra context)
-    """
+from observability import record_completion, span
+
+logger = logging.getLogger(__name__)
+
+# Runs speculative external-context fetches alongside the sufficiency judge on the sync path
+external_context_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="external-context")
+
+_async_client = None
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = openai.AsyncOpenAI()
+    return _async_client
+
+def build_judge_messages(query, context_docs):
     combined = "\n\n---\n\n".join(
         (getattr(d, "page_content", "") or "").strip()
             for d in (context_docs or [])
@@ -23,27 +39,55 @@ def judge_context(query, context_docs):
     )
     user_msg = f"Question:\n{query}\n\nContext:\n{combined or '[empty]'}"
 
-    resp = openai.chat.completions.create(
-        model="gpt-4o",
-        temperature=0,
-        messages=[
-            {"role": "system", "content": system_msg},
-            {"role": "user", "content": user_msg},
-        ],
-    )
-
-    content = resp.choices[0].message.content or "{}"
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": user_msg},
+    ]
 
+def parse_judgement(content):
     try:
-        data = json.loads(content)
+        data = json.loads(content or "{}")
         return bool(data.get("sufficient", False))
     except Exception:
         return False
-    
-def fetch_external_context(conversation_id, query):
+
+def judge_context(query, context_docs, timeout=None):
     """
-    Return extra context snippets (NOT a final answer).
+    True  -> context is sufficient
+    False -> context is insufficient (should fetch extra context)
     """
+    start_time = time.perf_counter()
+    try:
+        with span("judge_context"):
+            resp = openai.chat.completions.create(
+                model="gpt-4o",
+                temperature=0,
+                messages=build_judge_messages(query, context_docs),
+                timeout=timeout,
+            )
+    except Exception:
+        return False
+
+    record_completion("judge_context", resp, time.perf_counter() - start_time)
+    return parse_judgement(resp.choices[0].message.content)
+
+async def ajudge_context(query, context_docs, timeout=None):
+    start_time = time.perf_counter()
+    try:
+        with span("judge_context"):
+            resp = await get_async_client().chat.completions.create(
+                model="gpt-4o",
+                temperature=0,
+                messages=build_judge_messages(query, context_docs),
+                timeout=timeout,
+            )
+    except Exception:
+        return False
+
+    record_completion("judge_context", resp, time.perf_counter() - start_time)
+    return parse_judgement(resp.choices[0].message.content)
+
+def build_external_context_messages(conversation_id, query):
     system_msg = (
         "You are an information-gathering assistant. Given a user's question, "
         "provide concise additional context or key facts from general knowledge that could help answer the question "
@@ -55,55 +99,150 @@ def fetch_external_context(conversation_id, query):
         f"Question: {query}\n\n"
     )
 
+    return [
+        {"role": "system", "content": system_msg},
+        {"role": "user", "content": user_msg},
+    ]
+
+def fetch_external_context(conversation_id, query, timeout=None):
+    """
+    Return extra context snippets (NOT a final answer).
+    """
+    start_time = time.perf_counter()
+    try:
+        with span("fetch_external_context"):
+            resp = openai.chat.completions.create(
+                model="gpt-4o",
+                temperature=0.2,
+                messages=build_external_context_messages(conversation_id, query),
+                timeout=timeout,
+            )
+        record_completion("fetch_external_context", resp, time.perf_counter() - start_time)
+        return (resp.choices[0].message.content or "").strip()
+    except Exception:
+        return ""
+
+async def afetch_external_context(conversation_id, query, timeout=None):
+    start_time = time.perf_counter()
     try:
-        resp = openai.chat.completions.create(
-            model="gpt-4o",
-            temperature=0.2,
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_msg},
-            ],
-        )
+        with span("fetch_external_context"):
+            resp = await get_async_client().chat.completions.create(
+                model="gpt-4o",
+                temperature=0.2,
+                messages=build_external_context_messages(conversation_id, query),
+                timeout=timeout,
+            )
+        record_completion("fetch_external_context", resp, time.perf_counter() - start_time)
         return (resp.choices[0].message.content or "").strip()
     except Exception:
         return ""
 
+def external_context_document(extra):
+    return Document(
+        page_content=textwrap.dedent(
+            f"[EXTERNAL CONTEXT]\n{extra}").strip(),
+        metadata={"source": "external_context"},
+    )
+
 class ContextDecidingRetriever(BaseRetriever):
     """
     Wraps a base retriever. On each call:
-      - fetch KB docs
+      - fetch KB docs (and, when external context is allowed, speculatively start the external fetch in parallel)
       - judge sufficiency
-      - if weak and external allowed, fetch extra context and append as a Document
+      - if weak and external allowed, append the external context as a Document, otherwise discard it
       - return merged docs
+
+    Each stage has its own timeout, so the worst case is max(retrieval + judge, external fetch) instead of their sum.
+    A judge that times out counts as insufficient context.
     """
 
     base_retriever: BaseRetriever
     conversation_id: str = None
     allow_external: bool = False
     socket: any = None
+    speculative_external: bool = True
+    """Start the external fetch before the judge returns. Costs a gpt-4o call even when the KB context is sufficient."""
+    judge_timeout: float = 15.0
+    external_timeout: float = 20.0
 
     def _get_relevant_documents(self, query: str, *, run_manager = None):
+        # The judge only decides whether to fetch external context, so skip it entirely when that is not allowed
+        if not self.allow_external:
+            with span("retrieval"):
+                return self.base_retriever.invoke(query)
+
+        external_future = None
+        if self.speculative_external:
+            # Run in a copy of this context so the fetch is still attributed to the current request
+            external_future = external_context_executor.submit(
+                contextvars.copy_context().run, fetch_external_context, self.conversation_id, query, self.external_timeout)
+
         # 1) KB retrieval
-        kb_docs = self.base_retriever.get_relevant_documents(query)
+        with span("retrieval"):
+            kb_docs = self.base_retriever.invoke(query)
 
         # 2) Judge sufficiency (before answer composition)
-        sufficient = judge_context(query, kb_docs)
-        if sufficient or not self.allow_external:
+        sufficient = judge_context(query, kb_docs, timeout=self.judge_timeout)
+        if sufficient:
+            if external_future:
+                external_future.cancel()
             return kb_docs
-        
-        print("fetching additional context")
 
-        extra = (fetch_external_context( self.conversation_id, query) or "").strip()
+        logger.info("fetching additional context")
+
+        if external_future:
+            try:
+                extra = external_future.result(timeout=self.external_timeout)
+            except FutureTimeoutError:
+                extra = ""
+        else:
+            extra = fetch_external_context(self.conversation_id, query, timeout=self.external_timeout)
+
+        extra = (extra or "").strip()
         if extra:
-            kb_docs.append(
-                Document(
-                    page_content=textwrap.dedent(
-                        f"[EXTERNAL CONTEXT]\n{extra}").strip(),
-                    metadata={"source": "external_context"},
-                )
-            )
+            kb_docs.append(external_context_document(extra))
         return kb_docs
 
     async def _aget_relevant_documents(self, query, *, run_manager = None):
-        # Simple async wrapper around sync behavior
-        return self._get_relevant_documents(query, run_manager=run_manager)
\ No newline at end of file
+        if not self.allow_external:
+            with span("retrieval"):
+                return await self.base_retriever.ainvoke(query)
+
+        external_task = None
+        if self.speculative_external:
+            external_task = asyncio.create_task(asyncio.wait_for(
+                afetch_external_context(self.conversation_id, query, self.external_timeout), self.external_timeout))
+
+        try:
+            with span("retrieval"):
+                kb_docs = await self.base_retriever.ainvoke(query)
+
+            try:
+                sufficient = await asyncio.wait_for(ajudge_context(query, kb_docs, self.judge_timeout), self.judge_timeout)
+            except asyncio.TimeoutError:
+                sufficient = False
+        except BaseException:
+            if external_task:
+                external_task.cancel()
+            raise
+
+        if sufficient:
+            if external_task:
+                external_task.cancel()
+            return kb_docs
+
+        logger.info("fetching additional context")
+
+        try:
+            if external_task:
+                extra = await external_task
+            else:
+                extra = await asyncio.wait_for(
+                    afetch_external_context(self.conversation_id, query, self.external_timeout), self.external_timeout)
+        except asyncio.TimeoutError:
+            extra = ""
+
+        extra = (extra or "").strip()
+        if extra:
+            kb_docs.append(external_context_document(extra))
+        return kb_docs
@@ -0,0 +1,155 @@
+import re
+from collections import defaultdict
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def place_names_for(city, county):
+    '''
+    Names a row can be referred to by. Counties are only matched with the "county" suffix, because many Texas
+    county names are also common words.
+    '''
+    names = []
+    if city and city.strip():
+        names.append(city.strip().lower())
+    if county and county.strip():
+        county = county.strip().lower()
+        names.append(county if county.endswith(" county") else f"{county} county")
+    return names
+
+class Gazetteer:
+    '''
+    City and county names from the location table, matched on word boundaries against a query
+    '''
+
+    def __init__(self, place_names):
+        names = sorted({name.strip().lower() for name in place_names if name and name.strip()}, key=len, reverse=True)
+        self.pattern = re.compile(r"\b(" + "|".join(re.escape(name) for name in names) + r")\b") if names else None
+
+    def find_places(self, query):
+        if self.pattern is None:
+            return []
+        return list(dict.fromkeys(self.pattern.findall(query.lower())))
+
+class GeoIndex:
+    '''
+    In-memory spatial index over the rows of the location embedding matrix.
+
+    Rows are bucketed into a lat/long grid of cell_degrees cells, so a radius query only measures the haversine
+    distance for rows in the few cells that overlap the search box. A city/county lookup maps place names found in a
+    query to their rows and to the centroid used as the search center.
+    '''
+
+    def __init__(self, latitudes, longitudes, place_names, cell_degrees=0.5):
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.cell_degrees = cell_degrees
+
+        valid = np.flatnonzero(np.isfinite(self.latitudes) & np.isfinite(self.longitudes))
+
+        cells = defaultdict(list)
+        for i, lat_cell, lon_cell in zip(valid, self._cell(self.latitudes[valid]), self._cell(self.longitudes[valid])):
+            cells[(lat_cell, lon_cell)].append(i)
+        self.cells = {cell: np.asarray(rows, dtype=np.intp) for cell, rows in cells.items()}
+
+        places = defaultdict(list)
+        for i, names in enumerate(place_names):
+            for name in names:
+                places[name].append(i)
+        self.places = {name: np.asarray(rows, dtype=np.intp) for name, rows in places.items()}
+
+        self.gazetteer = Gazetteer(self.places.keys())
+
+    @classmethod
+    def from_documents(cls, documents, column_names, latitude_column="latitude", longitude_column="longitude", city_column="city", county_column="county"):
+        '''
+        Build the index from the "##" delimited rows loaded by build_table_column_retriever
+        '''
+        positions = {name: i for i, name in enumerate(column_names)}
+
+        latitudes = np.full(len(documents), np.nan)
+        longitudes = np.full(len(documents), np.nan)
+        place_names = []
+
+        for i, doc in enumerate(documents):
+            values = doc.page_content.split("##")
+
+            try:
+                latitudes[i] = float(values[positions[latitude_column]])
+                longitudes[i] = float(values[positions[longitude_column]])
+            except ValueError:
+                pass
+
+            place_names.append(place_names_for(values[positions[city_column]], values[positions[county_column]]))
+
+        return cls(latitudes, longitudes, place_names)
+
+    def _cell(self, degrees):
+        return np.floor(np.asarray(degrees) / self.cell_degrees).astype(np.int64)
+
+    def within_radius(self, latitude, longitude, radius_km):
+        '''
+        Indices of every row within radius_km of (latitude, longitude)
+        '''
+        lat_span = radius_km / KM_PER_DEGREE
+        lon_span = radius_km / (KM_PER_DEGREE * max(np.cos(np.radians(latitude)), 0.01))
+
+        lat_cells = range(int(self._cell(latitude - lat_span)), int(self._cell(latitude + lat_span)) + 1)
+        lon_cells = range(int(self._cell(longitude - lon_span)), int(self._cell(longitude + lon_span)) + 1)
+
+        candidates = [self.cells[(lat_cell, lon_cell)] for lat_cell in lat_cells for lon_cell in lon_cells if (lat_cell, lon_cell) in self.cells]
+        if not candidates:
+            return np.empty(0, dtype=np.intp)
+
+        candidates = np.concatenate(candidates)
+        distances = haversine_km(latitude, longitude, self.latitudes[candidates], self.longitudes[candidates])
+
+        return candidates[distances <= radius_km]
+
+    def resolve_places(self, query):
+        '''
+        Returns [(rows, (centroid_latitude, centroid_longitude))] for every known place named in the query
+        '''
+        resolved = []
+        for name in self.gazetteer.find_places(query):
+            rows = self.places[name]
+
+            latitudes = self.latitudes[rows]
+            longitudes = self.longitudes[rows]
+            valid = np.isfinite(latitudes) & np.isfinite(longitudes)
+
+            center = (float(latitudes[valid].mean()), float(longitudes[valid].mean())) if valid.any() else None
+            resolved.append((rows, center))
+
+        return resolved
+
+    def candidates(self, query, user_location=None, radius_km=40.0):
+        '''
+        Rows near (and in) the places named in the query, or, when the query names no place, rows near the user's
+        coordinates. A named place wins over the user's position: someone in Bryan asking about Corpus Christi wants
+        Corpus Christi.
+        None means the query is not spatially constrained and every row should be scored.
+        '''
+        groups = []
+
+        for rows, center in self.resolve_places(query):
+            groups.append(rows)
+            if center is not None:
+                groups.append(self.within_radius(center[0], center[1], radius_km))
+
+        if not groups and user_location is not None:
+            groups.append(self.within_radius(user_location[0], user_location[1], radius_km))
+
+        if not groups:
+            return None
+
+        return np.unique(np.concatenate(groups))
@@ -0,0 +1,116 @@
+import re
+import time
+from typing import Any, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from pydantic import Field
+from sqlalchemy import text
+
+from connection_pool import shared_engine
+
+from retrievers.PGVectorRetriever import RerankStats, maximal_marginal_relevance
+from retrievers.TableColumnRetriever import decode_vector, normalize_rows
+from vector_index import configure_ann_search, ef_search_for, resolve_collection_id
+
+# Vector and full-text candidates are ranked separately, then fused with reciprocal rank fusion in the same statement.
+# The fused candidates come back with their vectors so they can be diversified with MMR.
+HYBRID_SEARCH_SQL = """
+WITH vector_ranked AS (
+    SELECT id, row_number() OVER (ORDER BY distance) AS rank
+    FROM (
+        SELECT id, embedding <=> CAST(:embedding AS vector) AS distance
+        FROM langchain_pg_embedding
+        WHERE collection_id = :collection_id
+        ORDER BY distance
+        LIMIT :fetch_k
+    ) nearest
+),
+lexical_ranked AS (
+    SELECT id, row_number() OVER (ORDER BY score DESC) AS rank
+    FROM (
+        SELECT id, ts_rank_cd(document_tsv, terms) AS score
+        FROM langchain_pg_embedding, websearch_to_tsquery('english', :terms) terms
+        WHERE collection_id = :collection_id AND document_tsv @@ terms
+        ORDER BY score DESC
+        LIMIT :fetch_k
+    ) matches
+),
+fused AS (
+    SELECT coalesce(v.id, l.id) AS id,
+           coalesce(1.0 / (:rrf_k + v.rank), 0) + coalesce(1.0 / (:rrf_k + l.rank), 0) AS score
+    FROM vector_ranked v
+    FULL OUTER JOIN lexical_ranked l ON v.id = l.id
+)
+SELECT e.document, e.cmetadata, f.score, vector_send(e.embedding) AS embedding
+FROM fused f
+JOIN langchain_pg_embedding e ON e.id = f.id
+ORDER BY f.score DESC
+LIMIT :fetch_k
+"""
+
+class HybridPGRetriever(BaseRetriever):
+    """
+    Retrieves knowledge base chunks from langchain_pg_embedding by fusing a pgvector similarity ranking with a
+    Postgres full-text ranking (document_tsv, created by init_db.ensure_langchain_tables).
+
+    Exact-term questions ("amniocentesis", "episiotomy") are found by the lexical side even when the embedding
+    ranking misses them. Both rankings and the fusion run in one round trip; the top fused candidates are then
+    diversified with MMR, using the fused score as their relevance.
+    """
+
+    engine: Any
+    collection_id: str
+    embeddings_model: Embeddings
+    k: int = 10
+    """Number of fused results to return."""
+    fetch_k: int = 40
+    """Candidates taken from each ranking before fusion, and fused candidates reranked by MMR."""
+    rrf_k: int = 60
+    """Reciprocal rank fusion constant; larger values flatten the weight of the top ranks."""
+    lambda_mult: float = 0.5
+    """1 ranks purely by fused score, 0 purely by diversity."""
+    stats: RerankStats = Field(default_factory=RerankStats)
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        embedding = self.embeddings_model.embed_query(query)
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(HYBRID_SEARCH_SQL), {
+                "embedding": "[" + ",".join(str(float(x)) for x in embedding) + "]",
+                # websearch_to_tsquery ANDs plain words (dropping stop words), so a lexical candidate contains every term
+                "terms": " ".join(re.findall(r"\w+", query)),
+                "collection_id": self.collection_id,
+                "fetch_k": self.fetch_k,
+                "rrf_k": self.rrf_k,
+            }).fetchall()
+
+        return self.rerank(embedding, rows)
+
+    def rerank(self, query_vector, rows):
+        start_time = time.perf_counter()
+
+        candidate_matrix = np.zeros((len(rows), len(query_vector)), dtype=np.float32)
+        for i, row in enumerate(rows):
+            decode_vector(row.embedding, candidate_matrix[i])
+        candidate_matrix = normalize_rows(candidate_matrix, copy=False) if len(rows) else candidate_matrix
+
+        # Rows are ordered by fused score, so the first one carries the maximum
+        scores = np.array([float(row.score) for row in rows], dtype=np.float32)
+        relevance = scores / scores[0] if len(rows) and scores[0] > 0 else scores
+
+        selected = maximal_marginal_relevance(query_vector, candidate_matrix, self.k, self.lambda_mult, relevance=relevance)
+
+        self.stats.record(time.perf_counter() - start_time)
+
+        return [Document(page_content=rows[i].document or "", metadata={**(rows[i].cmetadata or {}), "score": float(rows[i].score)}) for i in selected]
+
+def build_hybrid_retriever(collection_name, embeddings_model, connection_uri, k=10, fetch_k=40, lambda_mult=0.5, ef_search=None, probes=None):
+    engine = configure_ann_search(shared_engine(connection_uri), ef_search=ef_search_for(fetch_k, ef_search), probes=probes)
+
+    # Resolve the collection once so every search filters on a constant collection_id
+    collection_id = resolve_collection_id(engine, collection_name)
+
+    return HybridPGRetriever(engine=engine, collection_id=collection_id, embeddings_model=embeddings_model, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult)
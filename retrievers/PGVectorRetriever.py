@@ -1,14 +1,139 @@
-from langchain_postgres import PGVector
+import threading
+import time
+from typing import Any, List, Optional
 
-# Build native pg retriever for the langchain_pg_embedding table
-def build_pg_vector_retriever(collection_name, embeddings_model, connection_uri):
-    pg_vector_store = PGVector(
-        embeddings=embeddings_model,
-        collection_name=collection_name,
-        connection=connection_uri,
-        use_jsonb=True,
-    )
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from pydantic import Field
+from sqlalchemy import text
+
+from connection_pool import shared_engine
+
+from retrievers.TableColumnRetriever import decode_vector, normalize_rows
+from vector_index import configure_ann_search, ef_search_for, resolve_collection_id
+
+def maximal_marginal_relevance(query_vector, candidate_matrix, k, lambda_mult=0.5, relevance=None):
+    '''
+    Select k rows of a row-normalized candidate matrix by maximal marginal relevance.
+
+    The candidate-candidate similarity matrix is computed once; each selection step is then a handful of vector
+    operations over all candidates instead of a Python loop over them.
+    relevance optionally replaces the cosine similarity to the query (e.g. a fused hybrid score scaled to [0, 1]).
+    Returns the selected row indices in selection order.
+    '''
+    n = len(candidate_matrix)
+    k = min(k, n)
+    if k <= 0:
+        return []
+
+    query_similarity = candidate_matrix @ normalize_rows(query_vector)[0] if relevance is None else np.asarray(relevance, dtype=np.float32)
+    pairwise_similarity = candidate_matrix @ candidate_matrix.T
+
+    selected = [int(np.argmax(query_similarity))]
+    redundancy = pairwise_similarity[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, pairwise_similarity[best], out=redundancy)
+
+    return selected
+
+class RerankStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reranks = 0
+        self.rerank_seconds = 0.0
+        self.max_rerank_seconds = 0.0
+
+    def record(self, seconds):
+        with self.lock:
+            self.reranks += 1
+            self.rerank_seconds += seconds
+            self.max_rerank_seconds = max(self.max_rerank_seconds, seconds)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "reranks": self.reranks,
+                "average_rerank_ms": 1000 * self.rerank_seconds / self.reranks if self.reranks else 0.0,
+                "max_rerank_ms": 1000 * self.max_rerank_seconds,
+            }
 
-    pg_vector_retriever = pg_vector_store.as_retriever(search_type="mmr", search_kwargs={"k": 10})
+class PGVectorMMRRetriever(BaseRetriever):
+    """
+    Pulls the fetch_k nearest chunks of a collection (through its ANN index) together with their vectors in one
+    query, then diversifies them with a vectorized NumPy MMR.
+    """
 
-    return pg_vector_retriever
\ No newline at end of file
+    engine: Any
+    collection_id: str
+    embeddings_model: Embeddings
+    k: int = 10
+    """Number of documents to return."""
+    fetch_k: int = 50
+    """Nearest candidates pulled from Postgres before reranking."""
+    lambda_mult: float = 0.5
+    """1 ranks purely by relevance, 0 purely by diversity."""
+    score_threshold: Optional[float] = None
+    """Candidates with a cosine similarity below this are dropped before reranking."""
+    stats: RerankStats = Field(default_factory=RerankStats)
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        query_vector = self.embeddings_model.embed_query(query)
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(f"""
+            SELECT document, cmetadata, vector_send(embedding) AS embedding
+            FROM langchain_pg_embedding
+            WHERE collection_id = '{self.collection_id}'
+            ORDER BY embedding <=> CAST(:query_vector AS vector)
+            LIMIT :fetch_k
+            """), {
+                "query_vector": "[" + ",".join(str(float(x)) for x in query_vector) + "]",
+                "fetch_k": self.fetch_k,
+            }).fetchall()
+
+        return self.rerank(query_vector, rows)
+
+    def rerank(self, query_vector, rows):
+        start_time = time.perf_counter()
+
+        candidate_matrix = np.zeros((len(rows), len(query_vector)), dtype=np.float32)
+        for i, row in enumerate(rows):
+            decode_vector(row.embedding, candidate_matrix[i])
+        candidate_matrix = normalize_rows(candidate_matrix, copy=False) if len(rows) else candidate_matrix
+
+        if self.score_threshold is not None and len(rows):
+            keep = np.flatnonzero(candidate_matrix @ normalize_rows(query_vector)[0] >= self.score_threshold)
+            candidate_matrix = candidate_matrix[keep]
+            rows = [rows[i] for i in keep]
+
+        selected = maximal_marginal_relevance(query_vector, candidate_matrix, self.k, self.lambda_mult)
+
+        self.stats.record(time.perf_counter() - start_time)
+
+        return [Document(page_content=rows[i].document or "", metadata=rows[i].cmetadata or {}) for i in selected]
+
+# Build native pg retriever for the langchain_pg_embedding table
+# ef_search (HNSW) and probes (IVFFlat) set the recall/latency trade-off of the collection's ANN index
+def build_pg_vector_retriever(collection_name, embeddings_model, connection_uri, ef_search=None, probes=None, k=10, fetch_k=50, lambda_mult=0.5, score_threshold=None):
+    engine = configure_ann_search(shared_engine(connection_uri), ef_search=ef_search_for(fetch_k, ef_search), probes=probes)
+
+    return PGVectorMMRRetriever(
+        engine=engine,
+        collection_id=resolve_collection_id(engine, collection_name),
+        embeddings_model=embeddings_model,
+        k=k,
+        fetch_k=fetch_k,
+        lambda_mult=lambda_mult,
+        score_threshold=score_threshold,
+    )
@@ -1,100 +1,215 @@
-import ast
 import json
-from typing import List
+import time
+from typing import List, Optional, Tuple
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
-from psycopg2 import connect
+from langchain_core.embeddings import Embeddings
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from langchain.embeddings import OpenAIEmbeddings
 
+from retrievers.GeoIndex import GeoIndex
+from connection_pool import shared_engine
+
+def normalize_rows(vectors, copy=True):
+    '''
+    Cast vectors to a contiguous float32 matrix and scale every row to unit length.
+    Zero rows are left as zeros so they score 0 against every query.
+    With copy=False a float32 input is normalized in place, which avoids doubling memory for large matrices.
+    '''
+    matrix = np.atleast_2d(np.array(vectors, dtype=np.float32, copy=True if copy else None, order="C"))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+def top_k_indices(embedding_matrix, query_vectors, k):
+    '''
+    Return the indices of the k best rows of embedding_matrix for each query vector, best first.
+
+    embedding_matrix must already be row-normalized, so a single matrix product gives the cosine similarity.
+    argpartition selects the top-k in O(n) and only those k are sorted.
+    '''
+    queries = normalize_rows(query_vectors)
+    similarities = queries @ embedding_matrix.T
+
+    k = min(k, similarities.shape[1])
+    if k <= 0:
+        return np.empty((len(queries), 0), dtype=np.intp)
+
+    if k < similarities.shape[1]:
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(k), (len(queries), k))
+
+    candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1)
+
+    return np.take_along_axis(candidates, order, axis=1)
+
 class TableColumnRetriever(BaseRetriever):
     """A retriever that retrieves top-k documents for a given table and its columns based on OpenAI embedding similarity."""
 
     documents: List[Document]
-    embeddings: List[np.ndarray]
+    embedding_matrix: np.ndarray
+    """Row-normalized float32 matrix of shape (len(documents), dim), built once in build_table_column_retriever."""
     k: int
-    openai_embeddings: OpenAIEmbeddings
     """Number of top results to return."""
+    openai_embeddings: Embeddings
+    geo_index: Optional[GeoIndex] = None
+    """Spatial index over the same rows, used to narrow candidates for queries that name a place or carry user coordinates."""
+    user_location: Optional[Tuple[float, float]] = None
+    """(latitude, longitude) of the user, bound per request."""
+    radius_km: float = 40.0
+    max_radius_km: float = 160.0
 
     def _get_relevant_documents(
-        self, query: str
+        self, query: str, *, run_manager=None
     ) -> List[Document]:
         """Retrieve documents based on cosine similarity between embeddings."""
 
-        # Step 1: Convert the query into an embedding using OpenAI
+        # Convert the query into an embedding using OpenAI
         query_embedding = self.openai_embeddings.embed_query(query)
 
-        # Step 2: Compute cosine similarities between query and document embeddings
-        similarities = cosine_similarity([query_embedding], self.embeddings)[0]
-
-        # Step 3: Get the top-k most similar documents
-        top_k_indices = np.argsort(similarities)[-self.k:][::-1]
-
-        matching_documents = [self.documents[i] for i in top_k_indices]
-
-        documents = []
-
-        # loop through the doc_list and for each doc add a json representation in the locations array
-        for doc in matching_documents:
-            doc_id, name, address, city, state, country, zip_code, latitude, longitude, description, phone, sunday_hours, monday_hours, tuesday_hours, wednesday_hours, thursday_hours, friday_hours, saturday_hours, rating, address_link, website, resource_type, county = doc.page_content.split(
-                "##")
-
-            unified_address = f"{address}, {city}, {state} {zip_code}"
-            confidence = 1
-            hours_of_operation = [{"sunday": sunday_hours}, {"monday": monday_hours}, {"tuesday": tuesday_hours}, {
-                "wednesday": wednesday_hours}, {"thursday": thursday_hours}, {"friday": friday_hours}, {"saturday": saturday_hours}]
-            is_saved = False
-            # latitude, longitude, rating may be represented numerically
-            
-            try:
-                latitude = float(latitude.strip())
-                longitude = float(longitude.strip())
-                rating = float(rating.strip())
-            except:
-                pass
-
-            document = Document(page_content=json.dumps({
-                "address": unified_address,
-                "addressLink": address_link,
-                "confidence": confidence,
-                "description": description,
-                "hoursOfOperation": hours_of_operation,
-                "id": doc_id,
-                "isSaved": is_saved,
-                "latitude": latitude,
-                "longitude": longitude,
-                "name": name,
-                "phone": phone,
-                "rating": rating,
-                "website": website
-            }), metadata={"source": "test"})
-
-            documents.append(document)
-
-        return documents
-
-def build_table_column_retriever(connection_uri, table_name, column_names, embedding_column_name):
-    conn = connect(connection_uri)
-    cursor = conn.cursor()
-
-    # Fetch embeddings and content from the database
+        # Narrow to rows near the user or the places named in the query, then rank only those by similarity
+        candidates = self.spatial_candidates(query)
+        if candidates is not None and len(candidates):
+            top_k = top_k_indices(self.embedding_matrix[candidates], [query_embedding], self.k)[0]
+            return [format_location_document(self.documents[candidates[i]]) for i in top_k]
+
+        return self.get_relevant_documents_by_vectors([query_embedding])[0]
+
+    def spatial_candidates(self, query):
+        '''
+        Row indices within radius_km of the places named in the query (or of the user when it names none), widening the radius up to max_radius_km until at
+        least k rows are found. None when the query has no spatial constraint.
+        '''
+        if self.geo_index is None:
+            return None
+
+        radius_km = self.radius_km
+        candidates = self.geo_index.candidates(query, self.user_location, radius_km)
+
+        while candidates is not None and len(candidates) < self.k and radius_km < self.max_radius_km:
+            radius_km = min(radius_km * 2, self.max_radius_km)
+            candidates = self.geo_index.candidates(query, self.user_location, radius_km)
+
+        return candidates
+
+    def get_relevant_documents_by_vectors(self, query_vectors) -> List[List[Document]]:
+        '''
+        Score a batch of query embeddings against every row at once.
+        Returns one list of the top-k location documents per query vector, in the same order.
+        '''
+        top_k = top_k_indices(self.embedding_matrix, query_vectors, self.k)
+
+        return [[format_location_document(self.documents[i]) for i in row] for row in top_k]
+
+def format_location_document(doc):
+    '''
+    Convert a raw "##" delimited location row into the JSON document returned to the frontend
+    '''
+    doc_id, name, address, city, state, country, zip_code, latitude, longitude, description, phone, sunday_hours, monday_hours, tuesday_hours, wednesday_hours, thursday_hours, friday_hours, saturday_hours, rating, address_link, website, resource_type, county = doc.page_content.split(
+        "##")
+
+    unified_address = f"{address}, {city}, {state} {zip_code}"
+    confidence = 1
+    hours_of_operation = [{"sunday": sunday_hours}, {"monday": monday_hours}, {"tuesday": tuesday_hours}, {
+        "wednesday": wednesday_hours}, {"thursday": thursday_hours}, {"friday": friday_hours}, {"saturday": saturday_hours}]
+    is_saved = False
+    # latitude, longitude, rating may be represented numerically
+
+    try:
+        latitude = float(latitude.strip())
+        longitude = float(longitude.strip())
+        rating = float(rating.strip())
+    except:
+        pass
+
+    return Document(page_content=json.dumps({
+        "address": unified_address,
+        "addressLink": address_link,
+        "confidence": confidence,
+        "description": description,
+        "hoursOfOperation": hours_of_operation,
+        "id": doc_id,
+        "isSaved": is_saved,
+        "latitude": latitude,
+        "longitude": longitude,
+        "name": name,
+        "phone": phone,
+        "rating": rating,
+        "website": website
+    }), metadata={"source": "test"})
+
+def decode_vector(buffer, out):
+    '''
+    Decode pgvector's binary send format (int16 dim, int16 unused, dim big-endian float4s) straight into out
+    '''
+    out[:] = np.frombuffer(buffer, dtype=">f4", count=len(out), offset=4)
+
+def load_table_embeddings(conn, table_name, column_names, embedding_column_name, batch_size=2000):
+    '''
+    Stream a table's rows and pgvector column into documents and a preallocated float32 matrix.
+
+    Vectors are fetched with vector_send() so they arrive as bytes instead of text, and a server-side (named) cursor
+    pulls them batch_size rows at a time, so the full result set is never held in memory.
+    Rows with a NULL embedding are kept as zero vectors.
+    '''
+    start_time = time.perf_counter()
+
+    # Count and stream from the same snapshot so the preallocated buffer always matches the rows we receive
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT count(*), max(vector_dims({embedding_column_name})) FROM {table_name};")
+        row_count, dims = cursor.fetchone()
+
+    embedding_matrix = np.zeros((row_count, dims or 1536), dtype=np.float32)
+    documents = []
+
     columns_str = ', '.join(column_names)
-    cursor.execute(f"SELECT {columns_str}, {embedding_column_name} FROM {table_name};")
+    with conn.cursor(name=f"{table_name}_embedding_loader") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(f"SELECT {columns_str}, vector_send({embedding_column_name}) FROM {table_name};")
+
+        for i, row in enumerate(cursor):
+            documents.append(Document(page_content="##".join([str(row[j]) for j in range(len(column_names))])))
+
+            vector = row[len(column_names)]
+            if vector is not None:
+                decode_vector(vector, embedding_matrix[i])
+
+    conn.commit()
+
+    # Rows only ever arrive in the snapshot we counted, but trim defensively if fewer came back
+    embedding_matrix = embedding_matrix[:len(documents)]
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Loaded {len(documents)} rows from {table_name} in {elapsed:.2f}s ({len(documents) / max(elapsed, 1e-9):.0f} rows/sec)", flush=True)
+
+    return documents, normalize_rows(embedding_matrix, copy=False)
 
-    rows = cursor.fetchall()
+def build_table_column_retriever(connection_uri, table_name, column_names, embedding_column_name, embeddings_model=None):
+    # Borrow a psycopg2 connection from the shared pool; load_table_embeddings changes its session, so restore the
+    # defaults before it goes back
+    conn = shared_engine(connection_uri).raw_connection()
 
-    documents = [
-        Document(page_content="##".join([str(row[i]) for i in range(len(column_names))]))
-        for row in rows
-    ]
+    try:
+        documents, embedding_matrix = load_table_embeddings(conn, table_name, column_names, embedding_column_name)
+    finally:
+        conn.rollback()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        conn.close()
 
-    embeddings = [np.array(ast.literal_eval(row[len(column_names)])) for row in rows]
+    # Share the caller's (cached) embeddings model when given, otherwise initialize OpenAIEmbeddings from LangChain
+    openai_embeddings = embeddings_model or OpenAIEmbeddings()
 
-    # Initialize OpenAIEmbeddings from LangChain
-    openai_embeddings = OpenAIEmbeddings()
+    # Spatial index over the same rows, when the table has coordinates and place columns
+    geo_index = None
+    if {"latitude", "longitude", "city", "county"}.issubset(column_names):
+        geo_index = GeoIndex.from_documents(documents, column_names)
 
     # Create the retriever with OpenAI embeddings
-    retriever = TableColumnRetriever(documents=documents, embeddings=embeddings, k=5, openai_embeddings=openai_embeddings)
+    retriever = TableColumnRetriever(documents=documents, embedding_matrix=embedding_matrix, k=5, openai_embeddings=openai_embeddings, geo_index=geo_index)
 
-    return retriever
\ No newline at end of file
+    return retriever
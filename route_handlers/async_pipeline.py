@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+
+# ASYNC_PIPELINE=true serves /formattedresults from coroutines (AsyncOpenAI, async Postgres) instead of blocking calls
+ASYNC_PIPELINE_ENABLED = os.getenv("ASYNC_PIPELINE", "false") == "true"
+
+# Requests allowed in flight at once; the rest wait for a slot (counted against their deadline)
+MAX_CONCURRENCY = int(os.getenv("ASYNC_PIPELINE_CONCURRENCY", 32))
+
+# Seconds a request may take end to end, including the wait for a slot
+REQUEST_DEADLINE = float(os.getenv("ASYNC_PIPELINE_DEADLINE", 60))
+
+class PipelineTimeout(Exception):
+    pass
+
+def async_connection_uri(connection_uri):
+    '''
+    Point a postgresql:// (or postgresql+psycopg2://) uri at the async psycopg 3 driver
+    '''
+    scheme, sep, rest = connection_uri.partition("://")
+    if scheme in ("postgres", "postgresql", "postgresql+psycopg2"):
+        scheme = "postgresql+psycopg"
+    return scheme + sep + rest
+
+class AsyncPipeline:
+    '''
+    Runs request coroutines on one event loop, so a single worker keeps many LLM calls in flight at once.
+
+    Under gunicorn's eventlet worker the coroutines run on eventlet's asyncio hub (EVENTLET_HUB=asyncio) and the
+    calling green thread waits cooperatively. Otherwise (threaded servers, scripts) they run on a background loop in
+    its own thread and the calling thread blocks on the result.
+
+    A semaphore bounds concurrency and every request gets a deadline; a request that misses it is cancelled and
+    raises PipelineTimeout.
+    '''
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, deadline=REQUEST_DEADLINE):
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+
+        self.loop = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+
+    def run(self, coroutine, deadline=None):
+        # Carry the caller's context variables (the request trace) onto the loop; a new green thread starts empty
+        limited = _in_context(self._limited(coroutine, deadline or self.deadline), contextvars.copy_context())
+
+        if _eventlet_asyncio_hub():
+            from eventlet.asyncio import spawn_for_awaitable
+            return spawn_for_awaitable(limited).wait()
+
+        return asyncio.run_coroutine_threadsafe(limited, self._background_loop()).result()
+
+    async def _limited(self, coroutine, deadline):
+        # Created on first use so it binds to whichever loop runs the pipeline
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        start_time = time.perf_counter()
+        timeout = asyncio.timeout(deadline)
+
+        try:
+            async with timeout:
+                with self.lock:
+                    self.waiting += 1
+                try:
+                    await self.semaphore.acquire()
+                finally:
+                    with self.lock:
+                        self.waiting -= 1
+
+                try:
+                    with self.lock:
+                        self.in_flight += 1
+                    return await coroutine
+                finally:
+                    with self.lock:
+                        self.in_flight -= 1
+                    self.semaphore.release()
+        except TimeoutError:
+            # Only our deadline becomes PipelineTimeout; timeouts raised by the request itself propagate unchanged
+            if not timeout.expired():
+                raise
+            with self.lock:
+                self.timeouts += 1
+            raise PipelineTimeout(f"Request exceeded its {deadline:g}s deadline")
+        finally:
+            coroutine.close()
+            with self.lock:
+                self.completed += 1
+                self.total_seconds += time.perf_counter() - start_time
+
+    def _background_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="async-pipeline", daemon=True).start()
+            return self.loop
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "average_seconds": self.total_seconds / self.completed if self.completed else 0.0,
+            }
+
+async def _in_context(coroutine, context):
+    return await asyncio.create_task(coroutine, context=context)
+
+def _eventlet_asyncio_hub():
+    '''
+    True when running under eventlet monkey patching with the asyncio hub, where coroutines share eventlet's loop
+    '''
+    # Only look at eventlet when the server already loaded it; importing it from a worker thread is not harmless
+    if "eventlet.patcher" not in sys.modules:
+        return False
+
+    from eventlet import hubs, patcher
+
+    if not patcher.is_monkey_patched("thread"):
+        return False
+
+    hub = hubs.get_hub()
+    if type(hub).__module__ == "eventlet.hubs.asyncio":
+        return True
+
+    # A background loop thread would itself be a green thread on another hub, which cannot make progress
+    raise RuntimeError("ASYNC_PIPELINE under eventlet requires EVENTLET_HUB=asyncio")
+
+pipeline = AsyncPipeline()
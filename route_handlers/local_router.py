@@ -0,0 +1,280 @@
+import logging
+import random
+import re
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+from connection_pool import shared_engine
+
+from retrievers.TableColumnRetriever import decode_vector, normalize_rows
+from retrievers.GeoIndex import Gazetteer, place_names_for
+
+logger = logging.getLogger(__name__)
+
+DIRECT_ROUTE = "search_direct_questions"
+LOCATION_ROUTE = "search_location_questions"
+FOLLOW_UP_ROUTE = "follow_up"
+
+# Phrases that signal the user wants a place rather than an answer
+LOCATION_PHRASES = re.compile(r"\b(near me|nearby|closest|nearest|where can i|where do i|where to|clinics?|providers?|locations?|offices?|centers?)\b")
+
+def build_gazetteer(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(text('SELECT DISTINCT city, county FROM "location"')).fetchall()
+
+    return Gazetteer(name for city, county in rows for name in place_names_for(city, county))
+
+class LocalRouter:
+    '''
+    In-process routing stage that runs before the gpt-4o classifier in determine_search_type.
+
+    Each route is represented by the centroid of the embeddings of past queries the LLM routed there (logged in
+    routing_decision). A query is routed locally when its margin between the location and direct centroids, nudged by
+    gazetteer and location-phrase matches, clears min_margin. Anything closer to the follow-up centroid, or not confident
+    enough, returns None so the caller falls back to gpt-4o.
+    '''
+
+    def __init__(self, embeddings_model, gazetteer, engine=None, min_margin=0.04, place_boost=0.03, phrase_boost=0.02, min_examples=20, shadow_rate=0.0):
+        self.embeddings_model = embeddings_model
+        self.gazetteer = gazetteer
+        self.engine = engine
+        self.min_margin = min_margin
+        self.place_boost = place_boost
+        self.phrase_boost = phrase_boost
+        self.min_examples = min_examples
+        self.shadow_rate = shadow_rate
+
+        self.centroids = {}
+        self.lock = threading.Lock()
+
+        self.local_routed = 0
+        self.llm_routed = 0
+        self.local_seconds = 0.0
+        self.llm_seconds = 0.0
+        self.shadow_checked = 0
+        self.shadow_agreed = 0
+
+    def fit(self, vectors, routes):
+        '''
+        Build one normalized centroid per route that has at least min_examples examples
+        '''
+        vectors = normalize_rows(vectors) if len(vectors) else np.zeros((0, 1536), dtype=np.float32)
+        routes = np.asarray(routes)
+
+        centroids = {}
+        for route in (DIRECT_ROUTE, LOCATION_ROUTE, FOLLOW_UP_ROUTE):
+            members = vectors[routes == route]
+            if len(members) >= self.min_examples:
+                centroids[route] = normalize_rows(members.mean(axis=0))[0]
+
+        with self.lock:
+            self.centroids = centroids
+
+    def fit_from_log(self):
+        '''
+        Train the centroids from the decisions gpt-4o made (source = 'llm') in routing_decision
+        '''
+        _, vectors, routes = load_logged_decisions(self.engine)
+        self.fit(vectors, routes)
+        print(f"Local router trained on {len(routes)} logged decisions ({', '.join(self.centroids) or 'no routes'})", flush=True)
+
+    def route(self, query):
+        '''
+        Returns (route, shadow_route, query embedding).
+        route is None when the query should go to gpt-4o. shadow_route is set when a confident local decision was
+        held back so it can be compared against gpt-4o for accuracy reporting.
+        '''
+        start_time = time.perf_counter()
+
+        query_vector = self.embeddings_model.embed_query(query)
+
+        return self._decide(query, query_vector, start_time)
+
+    async def aroute(self, query):
+        '''
+        route() with the query embedded through the async embeddings client
+        '''
+        start_time = time.perf_counter()
+
+        query_vector = await self.embeddings_model.aembed_query(query)
+
+        return self._decide(query, query_vector, start_time)
+
+    def _decide(self, query, query_vector, start_time):
+        route = self.classify(query, query_vector)
+
+        if route and self.shadow_rate > 0 and random.random() < self.shadow_rate:
+            return None, route, query_vector
+
+        if route:
+            with self.lock:
+                self.local_routed += 1
+                self.local_seconds += time.perf_counter() - start_time
+
+        return route, None, query_vector
+
+    def classify(self, query, query_vector, centroids=None):
+        if centroids is None:
+            with self.lock:
+                centroids = self.centroids
+
+        if DIRECT_ROUTE not in centroids or LOCATION_ROUTE not in centroids:
+            return None
+
+        query_vector = normalize_rows(query_vector)[0]
+        similarities = {route: float(centroid @ query_vector) for route, centroid in centroids.items()}
+
+        if max(similarities, key=similarities.get) == FOLLOW_UP_ROUTE:
+            return None
+
+        margin = similarities[LOCATION_ROUTE] - similarities[DIRECT_ROUTE]
+        has_place = bool(self.gazetteer.find_places(query))
+
+        if has_place:
+            margin += self.place_boost
+        if LOCATION_PHRASES.search(query.lower()):
+            margin += self.phrase_boost
+
+        if margin >= self.min_margin:
+            return LOCATION_ROUTE
+
+        # A named place is a strong location signal, so never send it to direct search without asking gpt-4o
+        if margin <= -self.min_margin and not has_place:
+            return DIRECT_ROUTE
+
+        return None
+
+    def record_llm_decision(self, query, query_vector, route, elapsed_seconds, local_route=None):
+        '''
+        Log a gpt-4o decision (and, for shadowed requests, what the local router chose) so it can be used for
+        retraining and accuracy reporting.
+
+        query_vector is None for turns the router was not asked about (see formatted_db_search). Those decisions are
+        counted but not logged, since their route depends on history the router never sees.
+        '''
+        with self.lock:
+            self.llm_routed += 1
+            self.llm_seconds += elapsed_seconds
+
+            if local_route is not None:
+                self.shadow_checked += 1
+                self.shadow_agreed += int(local_route == route)
+
+        if self.engine is None or query_vector is None:
+            return
+
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("""
+                INSERT INTO routing_decision (query, route, source, local_route, created_at, embedding)
+                VALUES (:query, :route, 'llm', :local_route, :created_at, CAST(:embedding AS vector));
+                """), {
+                    "query": query,
+                    "route": route,
+                    "local_route": local_route,
+                    "created_at": time.time(),
+                    "embedding": "[" + ",".join(str(float(x)) for x in query_vector) + "]",
+                })
+        except Exception as e:
+            logger.warning(f"Failed to log routing decision: {e}")
+
+    def stats(self):
+        '''
+        Routing counts, shadow-mode accuracy against gpt-4o, and estimated latency saved by local routing
+        '''
+        with self.lock:
+            average_llm_seconds = self.llm_seconds / self.llm_routed if self.llm_routed else 0.0
+            average_local_seconds = self.local_seconds / self.local_routed if self.local_routed else 0.0
+
+            return {
+                "local_routed": self.local_routed,
+                "llm_routed": self.llm_routed,
+                "local_rate": self.local_routed / max(self.local_routed + self.llm_routed, 1),
+                "average_local_seconds": average_local_seconds,
+                "average_llm_seconds": average_llm_seconds,
+                "estimated_seconds_saved": self.local_routed * max(average_llm_seconds - average_local_seconds, 0.0),
+                "shadow_checked": self.shadow_checked,
+                "shadow_accuracy": self.shadow_agreed / self.shadow_checked if self.shadow_checked else None,
+            }
+
+def load_logged_decisions(engine):
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+        SELECT query, route, vector_send(embedding)
+        FROM routing_decision
+        WHERE source = 'llm' AND embedding IS NOT NULL
+        ORDER BY id DESC
+        LIMIT 20000;
+        """)).fetchall()
+
+    if not rows:
+        return [], np.zeros((0, 1536), dtype=np.float32), []
+
+    dims = int.from_bytes(bytes(rows[0][2][:2]), "big")
+    vectors = np.zeros((len(rows), dims), dtype=np.float32)
+    for i, (_, _, buffer) in enumerate(rows):
+        decode_vector(buffer, vectors[i])
+
+    return [query for query, _, _ in rows], vectors, [route for _, route, _ in rows]
+
+def evaluate_router(router, queries, vectors, routes):
+    '''
+    Leave-one-out accuracy of the centroid router over logged gpt-4o decisions.
+    Returns the share of queries that would be routed locally and how often those local decisions matched gpt-4o.
+    '''
+    vectors = normalize_rows(vectors)
+    routes = np.asarray(routes)
+
+    # Per-route sums let us drop one example from its centroid without refitting
+    sums = {route: vectors[routes == route].sum(axis=0) for route in set(routes.tolist())}
+    counts = {route: int((routes == route).sum()) for route in sums}
+
+    routed = 0
+    correct = 0
+    for i, route in enumerate(routes):
+        centroids = {}
+        for candidate in sums:
+            total = sums[candidate] - vectors[i] if candidate == route else sums[candidate]
+            count = counts[candidate] - int(candidate == route)
+            if count >= router.min_examples:
+                centroids[candidate] = normalize_rows(total)[0]
+
+        predicted = router.classify(queries[i], vectors[i], centroids=centroids)
+        if predicted:
+            routed += 1
+            correct += int(predicted == route)
+
+    return {
+        "examples": len(routes),
+        "coverage": routed / len(routes) if len(routes) else 0.0,
+        "accuracy": correct / routed if routed else None,
+    }
+
+def build_local_router(connection_uri, embeddings_model, gazetteer=None, min_margin=0.04, shadow_rate=0.0):
+    engine = shared_engine(connection_uri)
+
+    # Reuse the gazetteer already built over the loaded location rows when the caller has one
+    router = LocalRouter(embeddings_model, gazetteer or build_gazetteer(engine), engine=engine, min_margin=min_margin, shadow_rate=shadow_rate)
+
+    try:
+        router.fit_from_log()
+    except Exception as e:
+        print(f"Local router could not load logged decisions, routing everything through gpt-4o: {e}")
+
+    return router
+
+if __name__ == "__main__":
+    import os
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    # Report how accurately the local router reproduces the logged gpt-4o decisions
+    engine = create_engine(os.getenv("POSTGRES_DSN"))
+    router = LocalRouter(None, build_gazetteer(engine), min_margin=float(os.getenv("LOCAL_ROUTER_MIN_MARGIN", 0.04)))
+
+    queries, vectors, routes = load_logged_decisions(engine)
+    print(evaluate_router(router, queries, vectors, routes))
@@ -1,21 +1,57 @@
 import json
 import os
+import time
 import openai
 
-from chains.conversational_retrieval_chain_with_memory import build_conversational_retrieval_chain_with_memory
+from chains.conversational_retrieval_chain_with_memory import ConversationalRetrievalChainFactory
 from langchain.chat_models import ChatOpenAI
 from langchain.embeddings import OpenAIEmbeddings
+from sqlalchemy.ext.asyncio import create_async_engine
 
 from socketio_instance import socketio
+from connection_pool import shared_engine
+from caches.embedding_cache import build_cached_embeddings
+from caches.semantic_answer_cache import build_semantic_answer_cache
+from route_handlers.local_router import build_local_router
+from route_handlers.async_pipeline import ASYNC_PIPELINE_ENABLED, async_connection_uri
+from history.conversation_history import ConversationHistoryStore
 from retrievers.PGVectorRetriever import build_pg_vector_retriever
+from retrievers.HybridPGRetriever import build_hybrid_retriever
 from retrievers.TableColumnRetriever import build_table_column_retriever
+from retrievers.ContextDecidingRetriever import get_async_client
+from observability import record_completion, span
 
 llm = ChatOpenAI()
-openai_embeddings = OpenAIEmbeddings()
 connection_uri = os.getenv("POSTGRES_DSN")
 
+# pgvector collection that backs direct questions
+collection_name = os.getenv("PGVECTOR_COLLECTION", '2024-11-15 12:59:57')
+
+# One cached embeddings model shared by every retriever so repeat queries skip the OpenAI round trip
+openai_embeddings = build_cached_embeddings(OpenAIEmbeddings(), connection_uri)
+
 # Create a retriever for the default langchain_pg_embedding table (direct questions)
-pg_vector_retriever = build_pg_vector_retriever('2024-11-15 12:59:57', openai_embeddings, connection_uri)
+# "mmr" (default) is the embedding-only MMR search, "hybrid" fuses full-text and vector rankings and diversifies
+# the fused candidates with MMR
+# ANN_EF_SEARCH / ANN_PROBES tune the recall of the collection's HNSW / IVFFlat index
+ann_settings = {"ef_search": os.getenv("ANN_EF_SEARCH"), "probes": os.getenv("ANN_PROBES")}
+
+if os.getenv("KB_RETRIEVER", "mmr") == "hybrid":
+    pg_vector_retriever = build_hybrid_retriever(
+        collection_name, openai_embeddings, connection_uri, lambda_mult=float(os.getenv("MMR_LAMBDA", 0.5)), **ann_settings)
+else:
+    pg_vector_retriever = build_pg_vector_retriever(
+        collection_name,
+        openai_embeddings,
+        connection_uri,
+        fetch_k=int(os.getenv("MMR_FETCH_K", 50)),
+        lambda_mult=float(os.getenv("MMR_LAMBDA", 0.5)),
+        score_threshold=float(os.environ["MMR_SCORE_THRESHOLD"]) if os.getenv("MMR_SCORE_THRESHOLD") else None,
+        **ann_settings
+    )
+
+# Answers for semantically equivalent summarized queries, dropped whenever the active collection changes
+answer_cache = build_semantic_answer_cache(connection_uri, collection_name)
 
 # Creating a TableColumnRetriever to index all of the columns for the location table when retrieving documents (location based questions)
 table_column_retriever = build_table_column_retriever(
@@ -23,10 +59,33 @@ table_column_retriever = build_table_column_retriever(
     table_name="location",
     column_names=["id", "name", "address", "city", "state", "country", "zip_code", "latitude", "longitude", "description", "phone", "sunday_hours", "monday_hours",
                     "tuesday_hours", "wednesday_hours", "thursday_hours", "friday_hours", "saturday_hours", "rating", "address_link", "website", "resource_type", "county"],
-    embedding_column_name="embedding"
+    embedding_column_name="embedding",
+    embeddings_model=openai_embeddings
+)
+
+# Routes confidently classifiable queries in-process so they skip the gpt-4o call in determine_search_type
+local_router = build_local_router(
+    connection_uri,
+    openai_embeddings,
+    gazetteer=table_column_retriever.geo_index.gazetteer if table_column_retriever.geo_index else None,
+    min_margin=float(os.getenv("LOCAL_ROUTER_MIN_MARGIN", 0.04)),
+    shadow_rate=float(os.getenv("LOCAL_ROUTER_SHADOW_RATE", 0.05)),
+)
+
+# Windowed conversation history (recent turns plus a rolling summary), read once per request
+history_store = ConversationHistoryStore(
+    shared_engine(connection_uri),
+    llm=llm,
+    max_turns=int(os.getenv("HISTORY_MAX_TURNS", 6)),
+    max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", 2000)),
+    async_engine=create_async_engine(async_connection_uri(connection_uri)) if ASYNC_PIPELINE_ENABLED else None,
 )
 
-def search_direct_questions(conversation_id, search_query, allow_external):
+# Chains are assembled once per retriever; each request only binds its conversation, socket target and allow_external
+direct_chain_factory = ConversationalRetrievalChainFactory(llm, pg_vector_retriever, history_store, socketio)
+location_chain_factory = ConversationalRetrievalChainFactory(llm, table_column_retriever, history_store, socketio)
+
+def search_direct_questions(conversation_id, search_query, allow_external, socket_target=None, window=None):
     '''
     Direct question handler searches OliviaHealth.org knowledge base for most relevant data relating to user query
     Data is passed to LLM to generate output
@@ -37,25 +96,34 @@ def search_direct_questions(conversation_id, search_query, allow_external):
     Collects and aggregates the identifiers of referenced documents. Each ID maps directly to its corresponding document record on OliviaHealth.com.
     '''
 
-    # Build the retrieval QA chain with SQL memory
+    # Invoke RAG process with SQL memory
     # Must pass in the session_id from the message_store table
-    retrieval_qa_chain = build_conversational_retrieval_chain_with_memory(
-        llm, pg_vector_retriever, conversation_id, connection_uri, socketio, allow_external)
+    response = direct_chain_factory.invoke(conversation_id, search_query, allow_external, socket_target, window)
+
+    return direct_question_result(response)
+
+async def asearch_direct_questions(conversation_id, search_query, allow_external, socket_target=None, window=None):
+    '''
+    search_direct_questions for the async request pipeline
+    '''
+    response = await direct_chain_factory.ainvoke(conversation_id, search_query, allow_external, socket_target, window)
 
-    # Invoke RAG process
-    response = retrieval_qa_chain.invoke(search_query)
+    return direct_question_result(response)
 
+def direct_question_result(response):
     documents = []
 
     for doc in response["source_documents"]:
-        if doc.metadata['source'].get('id'):
-            documents.append(doc.metadata['source']['id'])
+        # External context documents have a plain string source and no id
+        source = doc.metadata.get('source')
+        if isinstance(source, dict) and source.get('id'):
+            documents.append(source['id'])
 
     answer = response.get('answer')
 
     return {'answer': answer, 'documents': documents}
 
-def search_location_questions(conversation_id, search_query):
+def search_location_questions(conversation_id, search_query, socket_target=None, window=None, user_location=None):
     '''
     Location question handler searches Locations table for most relevant locations relating to user query
     Data is converted to JSON array of locations
@@ -66,10 +134,32 @@ def search_location_questions(conversation_id, search_query):
     Examples of location questions: 'Dental Services in Corpus Christi', 'Where can I get mental health support in Bryan'
     '''
 
-    retrieval_qa_chain = build_conversational_retrieval_chain_with_memory(
-        llm, table_column_retriever, conversation_id, connection_uri, socketio)
-    
-    response = retrieval_qa_chain.invoke(search_query)
+    # Bind the user's coordinates to a shallow copy so the shared retriever (and its matrix) is never mutated
+    retriever = table_column_retriever.model_copy(update={"user_location": user_location}) if user_location else None
+
+    response = location_chain_factory.invoke(conversation_id, search_query, socket_target=socket_target, window=window, retriever=retriever)
+
+    return location_question_result(response)
+
+async def asearch_location_questions(conversation_id, search_query, socket_target=None, window=None, user_location=None):
+    '''
+    search_location_questions for the async request pipeline
+    '''
+    retriever = table_column_retriever.model_copy(update={"user_location": user_location}) if user_location else None
+
+    response = await location_chain_factory.ainvoke(conversation_id, search_query, socket_target=socket_target, window=window, retriever=retriever)
+
+    return location_question_result(response)
+
+def named_places(search_query):
+    '''
+    City and county names in a location question, the same ones the location retriever narrows its results to
+    '''
+    if table_column_retriever.geo_index is None:
+        return []
+    return table_column_retriever.geo_index.gazetteer.find_places(search_query)
+
+def location_question_result(response):
     answer = response.get('answer')
     source_documents = response.get('source_documents')
 
@@ -87,11 +177,14 @@ def determine_search_type(messages):
     '''
 
     # Prompt OpenAI to make determination
-    response = openai.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        tools=tools,
-    )
+    start_time = time.perf_counter()
+    with span("determine_search_type"):
+        response = openai.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            tools=tools,
+        )
+    record_completion("determine_search_type", response, time.perf_counter() - start_time)
 
     # If we have a refusal (ex: for unsafe questions), return an error
     refusal = response.choices[0].message.refusal
@@ -100,6 +193,25 @@ def determine_search_type(messages):
     
     return response
 
+async def adetermine_search_type(messages):
+    '''
+    determine_search_type through the async OpenAI client
+    '''
+    start_time = time.perf_counter()
+    with span("determine_search_type"):
+        response = await get_async_client().chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            tools=tools,
+        )
+    record_completion("determine_search_type", response, time.perf_counter() - start_time)
+
+    refusal = response.choices[0].message.refusal
+    if (refusal):
+        return "Something went wrong: OpenAi Classification Refusal", 500
+
+    return response
+
 
 # Defining list of tools to use with OpenAI function calling
 tools = [
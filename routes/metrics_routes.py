@@ -0,0 +1,32 @@
+from flask import Blueprint
+
+from connection_pool import pool_stats
+from route_handlers.query_handlers import openai_embeddings, answer_cache, local_router, direct_chain_factory, location_chain_factory
+from route_handlers.async_pipeline import pipeline
+from chains.conversational_retrieval_chain_with_memory import stream_metrics
+from routes.search_routes import location_cache
+from database import revoked_tokens
+from observability import metrics_response
+
+metrics_routes_bp = Blueprint('metrics_routes', __name__)
+
+# In-process counters of the worker that serves the request: connection pool, caches, router, chains and streaming
+@metrics_routes_bp.route("/stats", methods=['GET'])
+def get_stats():
+    return {
+        'connectionPools': pool_stats(),
+        'embeddingCache': openai_embeddings.cache.stats(),
+        'answerCache': answer_cache.stats(),
+        'locationCache': location_cache.stats(),
+        'localRouter': local_router.stats(),
+        'directChain': direct_chain_factory.stats(),
+        'locationChain': location_chain_factory.stats(),
+        'streaming': stream_metrics.stats(),
+        'asyncPipeline': pipeline.stats(),
+        'revokedTokens': revoked_tokens.stats(),
+    }
+
+# Prometheus exposition: stage and request latency histograms by route type, LLM calls and token usage
+@metrics_routes_bp.route("/metrics", methods=['GET'])
+def get_metrics():
+    return metrics_response()
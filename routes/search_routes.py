@@ -1,13 +1,25 @@
 from flask import Blueprint, render_template, request, Response
+import asyncio
+import os
 import time
 import json
 
-from route_handlers.query_handlers import search_direct_questions, search_location_questions, determine_search_type
+from langchain_core.messages import AIMessage, HumanMessage
 
-from database import message_store, Location, db
+from route_handlers.query_handlers import search_direct_questions, search_location_questions, determine_search_type, answer_cache, openai_embeddings, local_router, history_store, named_places
+from route_handlers.query_handlers import asearch_direct_questions, asearch_location_questions, adetermine_search_type
+from route_handlers.async_pipeline import ASYNC_PIPELINE_ENABLED, PipelineTimeout, pipeline
+from route_handlers.local_router import FOLLOW_UP_ROUTE
+
+from database import Location, get_table_version
+from observability import set_route_type, span
+from caches.location_cache import LocationJSONCache, serialize_location
 
 search_routes_bp = Blueprint('search_routes', __name__)
 
+# Serialized /locations payloads, cleared whenever the location table changes
+location_cache = LocationJSONCache(lambda: get_table_version("location"), check_interval=float(os.getenv("LOCATION_CACHE_CHECK_INTERVAL", 5)))
+
 # Old ichild homepage
 @search_routes_bp.route("/", methods=['POST', 'GET'])
 def msg():
@@ -18,26 +30,20 @@ def msg():
 def get_locations():
     ids = request.form.getlist("location_ids")
 
-    locations = []
-    for id in ids:
-        location = Location.query.filter_by(id=id).first()
-        locations.append({
-            'id': location.id,
-            'address': location.address + ", " + location.city + ", " + location.state + " " + str(int(location.zip_code)),
-            'addressLink': location.address_link,
-            'description': location.description,
-            'latitude': float(location.latitude),
-            'longitude': float(location.longitude),
-            'website': location.website,
-            'name': location.name,
-            'phone': location.phone,
-            'hoursOfOperation': [{"sunday": location.sunday_hours}, {"monday": location.monday_hours}, {"tuesday": location.tuesday_hours}, {"wednesday": location.wednesday_hours}, {"thursday": location.thursday_hours}, {"friday": location.friday_hours}, {"saturday": location.saturday_hours}],
-            'rating': float(location.rating) if (location.rating and location.rating.isalnum()) else None,
-            'isSaved': False
-        })
+    use_cache = location_cache.refresh()
+    serialized = location_cache.get_many(ids) if use_cache else {}
 
+    # Fetch every uncached location in a single IN query
+    missing_ids = list({id for id in ids if id not in serialized})
+    if missing_ids:
+        fetched = {location.id: serialize_location(location) for location in Location.query.filter(Location.id.in_(missing_ids)).all()}
+        if use_cache:
+            location_cache.set_many(fetched)
+        serialized.update(fetched)
+
+    # Preserve the requested order and skip ids that no longer exist
     return Response(
-        json.dumps(locations),
+        b"[" + b",".join(serialized[id] for id in ids if id in serialized) + b"]",
         mimetype='application/json'
     )
 
@@ -50,75 +56,100 @@ def formatted_db_search():
     allow_external = True if request.form.get(
         'allow_external') == "true" else False
     date_created = int(time.time() * 1000)
+    user_location = parse_user_location(request.form.get('latitude'), request.form.get('longitude'))
+    # Socket.IO sid (or room) of the requesting client; streamed tokens go only there
+    socket_target = request.form.get('socketId')
+
+    if (ASYNC_PIPELINE_ENABLED):
+        try:
+            return pipeline.run(aformatted_db_search(search_query, conversation_id, allow_external, date_created, user_location, socket_target))
+        except PipelineTimeout as e:
+            return {'error': str(e), 'conversationId': conversation_id}, 504
 
-    # Reconstruct the conversation history given the conversation_id
-    conversation_history = message_store.query.filter_by(
-        session_id=conversation_id).all()
+    # Read the conversation window (recent turns plus a rolling summary) once; it is shared by the router and the chain
+    with span("history_load"):
+        window = history_store.load(conversation_id)
 
     messages = [
         {"role": "system", "content": "You are a helpful assistant. First, summarize the conversation history. Then determine if the user's query is location-based, direct-answer, or requires more information. Provide the summary explicitly."},
     ]
-
-    for history in conversation_history:
-        history = json.loads(history.message)
-
-        history_type = history["type"]
-        content = history["data"]["content"]
-
-        role = None
-        if (history_type == "human"):
-            role = "user"
-        elif (history_type == "ai"):
-            role = "assistant"
-
-        messages.append({"role": role, "content": content})
+    messages.extend(window.as_openai_messages())
     messages.append({"role": "user", "content": search_query})
 
-    # Determine weather search_query is a direct question or location based
-    # Select which tool to invoke (search_direct_question for direct questions, search_location_question for location based question)
-    determine_search_type_response = determine_search_type(messages)
-    tool_calls = determine_search_type_response.choices[0].message.tool_calls
+    # Try the local router first; it only answers when it is confident, otherwise we fall back to gpt-4o.
+    # It only sees the new message, so later turns always go to gpt-4o, which condenses the history into the query.
+    local_route, shadow_route, local_query_embedding = None, None, None
+    if (not window.has_history()):
+        with span("local_router"):
+            local_route, shadow_route, local_query_embedding = local_router.route(search_query)
 
-    if (tool_calls):
-        function_name = tool_calls[0].function.name
+    if (local_route):
+        function_name = local_route
+        summarized_query = search_query
     else:
-        '''
-        Follow up question is needed for more information.
-        Need to manually add the user query and ai response to the db
-        '''
-
-        response = determine_search_type_response.choices[0].message.content
+        # Determine weather search_query is a direct question or location based
+        # Select which tool to invoke (search_direct_question for direct questions, search_location_question for location based question)
+        classification_start = time.perf_counter()
+        determine_search_type_response = determine_search_type(messages)
+        classification_seconds = time.perf_counter() - classification_start
 
-        new_user_message = message_store(
-            session_id=conversation_id,
-            message=f'{{"type": "human", "data": {{"content": "{search_query}"}}}}'
-        )
+        tool_calls = determine_search_type_response.choices[0].message.tool_calls
 
-        new_response_message = message_store(
-            session_id=conversation_id,
-            message=f'{{"type": "ai", "data": {{"content": "{response}"}}}}'
-        )
+        # Log the decision so the local router can learn from it
+        local_router.record_llm_decision(
+            search_query, local_query_embedding, tool_calls[0].function.name if tool_calls else FOLLOW_UP_ROUTE, classification_seconds, shadow_route)
 
-        db.session.add(new_user_message)
-        db.session.add(new_response_message)
-
-        db.session.commit()
+        if (tool_calls):
+            function_name = tool_calls[0].function.name
+        else:
+            '''
+            Follow up question is needed for more information.
+            Need to manually add the user query and ai response to the db
+            '''
+
+            response = determine_search_type_response.choices[0].message.content
+
+            set_route_type("follow_up")
+            save_turn(conversation_id, search_query, response)
+
+            return {
+                'userQuery': search_query,
+                'response': response,
+                'response_type': 'direct',
+                'locations': [],
+                'documents': [],
+                'dateCreated': date_created,
+                'conversationId': conversation_id
+            }
+
+        # determine_search_type() will also create a summary of the conversation history
+        # Extract the summarized query and pass it into the search handler
+        arguments = json.loads(tool_calls[0].function.arguments)
+        summarized_query = arguments['query']
+
+    set_route_type(route_type(function_name, local_route))
+
+    # Serve semantically equivalent questions from the answer cache, skipping retrieval and the answer LLM calls
+    with span("embed_query"):
+        query_embedding = openai_embeddings.embed_query(summarized_query)
+    cache_location, cache_places = location_cache_scope(function_name, summarized_query, user_location)
+    with span("answer_cache"):
+        cached = answer_cache.lookup(query_embedding, function_name, allow_external, cache_location, cache_places)
+
+    if (cached):
+        set_route_type(route_type(function_name, local_route, cached=True))
+        save_turn(conversation_id, search_query, cached['response'])
 
         return {
             'userQuery': search_query,
-            'response': response,
-            'response_type': 'direct',
-            'locations': [],
-            'documents': [],
+            'response': cached['response'],
+            'response_type': cached['response_type'],
+            'locations': cached['locations'],
+            'documents': cached['documents'],
             'dateCreated': date_created,
             'conversationId': conversation_id
         }
 
-    # determine_search_type() will also create a summary of the conversation history
-    # Extract the summarized query and pass it into the search handler
-    arguments = json.loads(tool_calls[0].function.arguments)
-    summarized_query = arguments['query']
-
     if (function_name == 'search_direct_questions'):
         response_type = 'direct'
 
@@ -126,14 +157,17 @@ def formatted_db_search():
 
         if (allow_external):
             response = search_direct_questions(
-                conversation_id, summarized_query, True)
+                conversation_id, summarized_query, True, socket_target=socket_target, window=window)
         else:
             response = search_direct_questions(
-                conversation_id, summarized_query, False)
+                conversation_id, summarized_query, False, socket_target=socket_target, window=window)
             
         answer = response.get('answer')
         documents = response.get('documents')
 
+        answer_cache.store(query_embedding, function_name, allow_external, {
+            'response': answer, 'response_type': response_type, 'locations': [], 'documents': documents})
+
         return {
             'userQuery': search_query,
             'response': answer,
@@ -147,11 +181,14 @@ def formatted_db_search():
     elif (function_name == 'search_location_questions'):
         response_type = 'location'
 
-        data = search_location_questions(conversation_id, summarized_query)
+        data = search_location_questions(conversation_id, summarized_query, socket_target=socket_target, window=window, user_location=user_location)
 
         response = data.get("response")
         locations = data.get("locations")
 
+        answer_cache.store(query_embedding, function_name, allow_external, {
+            'response': response, 'response_type': response_type, 'locations': locations, 'documents': []}, cache_location, cache_places)
+
         return {
             'userQuery': search_query,
             'response': response,
@@ -164,3 +201,141 @@ def formatted_db_search():
 
     else:
         return "error"
+
+async def aformatted_db_search(search_query, conversation_id, allow_external, date_created, user_location=None, socket_target=None):
+    '''
+    formatted_db_search as a coroutine for the async request pipeline: history reads and writes use the async engine
+    and every LLM call (routing, sufficiency judge, external context, answer) goes through the async OpenAI client,
+    so slow completions never hold the worker
+    '''
+    with span("history_load"):
+        window = await history_store.aload(conversation_id)
+
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant. First, summarize the conversation history. Then determine if the user's query is location-based, direct-answer, or requires more information. Provide the summary explicitly."},
+    ]
+    messages.extend(window.as_openai_messages())
+    messages.append({"role": "user", "content": search_query})
+
+    local_route, shadow_route, local_query_embedding = None, None, None
+    if (not window.has_history()):
+        with span("local_router"):
+            local_route, shadow_route, local_query_embedding = await local_router.aroute(search_query)
+
+    if (local_route):
+        function_name = local_route
+        summarized_query = search_query
+    else:
+        classification_start = time.perf_counter()
+        determine_search_type_response = await adetermine_search_type(messages)
+        classification_seconds = time.perf_counter() - classification_start
+
+        tool_calls = determine_search_type_response.choices[0].message.tool_calls
+
+        # The routing log insert is a small synchronous write, kept off the event loop
+        await asyncio.to_thread(
+            local_router.record_llm_decision,
+            search_query, local_query_embedding, tool_calls[0].function.name if tool_calls else FOLLOW_UP_ROUTE, classification_seconds, shadow_route)
+
+        if (tool_calls):
+            function_name = tool_calls[0].function.name
+        else:
+            response = determine_search_type_response.choices[0].message.content
+
+            set_route_type("follow_up")
+            await asave_turn(conversation_id, search_query, response)
+
+            return formatted_response(search_query, response, 'direct', [], [], date_created, conversation_id)
+
+        arguments = json.loads(tool_calls[0].function.arguments)
+        summarized_query = arguments['query']
+
+    set_route_type(route_type(function_name, local_route))
+
+    with span("embed_query"):
+        query_embedding = await openai_embeddings.aembed_query(summarized_query)
+    cache_location, cache_places = location_cache_scope(function_name, summarized_query, user_location)
+    with span("answer_cache"):
+        cached = answer_cache.lookup(query_embedding, function_name, allow_external, cache_location, cache_places)
+
+    if (cached):
+        set_route_type(route_type(function_name, local_route, cached=True))
+        await asave_turn(conversation_id, search_query, cached['response'])
+
+        return formatted_response(search_query, cached['response'], cached['response_type'], cached['locations'], cached['documents'], date_created, conversation_id)
+
+    if (function_name == 'search_direct_questions'):
+        response = await asearch_direct_questions(conversation_id, summarized_query, allow_external, socket_target=socket_target, window=window)
+
+        answer = response.get('answer')
+        documents = response.get('documents')
+
+        answer_cache.store(query_embedding, function_name, allow_external, {
+            'response': answer, 'response_type': 'direct', 'locations': [], 'documents': documents})
+
+        return formatted_response(search_query, answer, 'direct', [], documents, date_created, conversation_id)
+
+    elif (function_name == 'search_location_questions'):
+        data = await asearch_location_questions(conversation_id, summarized_query, socket_target=socket_target, window=window, user_location=user_location)
+
+        response = data.get("response")
+        locations = data.get("locations")
+
+        answer_cache.store(query_embedding, function_name, allow_external, {
+            'response': response, 'response_type': 'location', 'locations': locations, 'documents': []}, cache_location, cache_places)
+
+        return formatted_response(search_query, response, 'location', locations, [], date_created, conversation_id)
+
+    else:
+        return "error"
+
+def location_cache_scope(function_name, summarized_query, user_location):
+    '''
+    (coordinates, place names) a cached answer is only shared within. Location answers are narrowed to the places the
+    query names, or to the user's coordinates when it names none; direct answers are shared by everyone.
+    '''
+    if (function_name != 'search_location_questions'):
+        return None, []
+
+    places = named_places(summarized_query)
+    return (None if places else user_location), places
+
+def route_type(function_name, local_route=None, cached=False):
+    '''
+    Label the request metrics are exported under, e.g. "direct", "location_local" or "direct_cached"
+    '''
+    label = {'search_direct_questions': 'direct', 'search_location_questions': 'location'}.get(function_name, 'unknown')
+    if (local_route):
+        label += '_local'
+    if (cached):
+        label += '_cached'
+    return label
+
+def formatted_response(search_query, response, response_type, locations, documents, date_created, conversation_id):
+    return {
+        'userQuery': search_query,
+        'response': response,
+        'response_type': response_type,
+        'locations': locations,
+        'documents': documents,
+        'dateCreated': date_created,
+        'conversationId': conversation_id
+    }
+
+async def asave_turn(conversation_id, search_query, response):
+    await history_store.aappend(conversation_id, [HumanMessage(content=search_query), AIMessage(content=response)])
+
+def save_turn(conversation_id, search_query, response):
+    '''
+    Record a user query and its answer in message_store when the chain (and its memory) did not run, e.g. on a cache hit
+    '''
+    history_store.append(conversation_id, [HumanMessage(content=search_query), AIMessage(content=response)])
+
+def parse_user_location(latitude, longitude):
+    '''
+    Optional user coordinates sent by the frontend, used to narrow location results to a radius around the user
+    '''
+    try:
+        return (float(latitude), float(longitude))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,236 @@
+import argparse
+import os
+import time
+import weakref
+
+from sqlalchemy import create_engine, event, text
+
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1536))
+ANN_INDEX_METHOD = os.getenv("ANN_INDEX_METHOD", "hnsw")
+
+# pgvector's default hnsw.ef_search; an HNSW scan returns at most ef_search rows
+HNSW_DEFAULT_EF_SEARCH = 40
+
+# Search-time settings per engine, read by the single connect listener configure_ann_search registers on it
+_ann_settings = weakref.WeakKeyDictionary()
+
+
+def ensure_fixed_dimension(conn, dimensions=EMBEDDING_DIMENSIONS):
+    """
+    pgvector can only index a column with a declared dimension, so convert an untyped `vector` column to vector(N).
+    Fails loudly if any stored vector has a different length.
+    """
+    column_type = conn.execute(text("""
+    SELECT format_type(atttypid, atttypmod)
+    FROM pg_attribute
+    WHERE attrelid = 'langchain_pg_embedding'::regclass AND attname = 'embedding'
+    """)).scalar()
+
+    if column_type == "vector":
+        print(f"==> Converting langchain_pg_embedding.embedding to vector({dimensions})...", flush=True)
+        conn.execute(text(f"ALTER TABLE langchain_pg_embedding ALTER COLUMN embedding TYPE vector({dimensions}) USING embedding::vector({dimensions})"))
+
+
+def resolve_collection_id(engine, collection_name):
+    """
+    uuid of a named collection, resolved once so searches can filter on a constant (which partial indexes require)
+    """
+    with engine.connect() as conn:
+        collection_id = conn.execute(
+            text("SELECT uuid::text FROM langchain_pg_collection WHERE name = :name"), {"name": collection_name}
+        ).scalar()
+
+    if collection_id is None:
+        raise ValueError(f"Collection {collection_name} does not exist in langchain_pg_collection")
+
+    return collection_id
+
+
+def ann_index_name(collection_id, method=ANN_INDEX_METHOD):
+    return f"langchain_pg_embedding_{method}_{str(collection_id).replace('-', '')}"
+
+
+def ensure_collection_ann_index(conn, collection_id, method=ANN_INDEX_METHOD):
+    """
+    Create a partial ANN index (cosine distance) covering a single collection.
+    Queries that filter on a constant collection_id and order by `embedding <=> query` can use it.
+
+    HNSW settings come from HNSW_M / HNSW_EF_CONSTRUCTION. IVFFlat picks its list count from the collection size,
+    so it should be (re)built after the collection is loaded.
+    """
+    index_name = ann_index_name(collection_id, method)
+
+    if method == "hnsw":
+        options = f"m = {int(os.getenv('HNSW_M', 16))}, ef_construction = {int(os.getenv('HNSW_EF_CONSTRUCTION', 64))}"
+    elif method == "ivfflat":
+        row_count = conn.execute(
+            text("SELECT count(*) FROM langchain_pg_embedding WHERE collection_id = :collection_id"), {"collection_id": str(collection_id)}
+        ).scalar()
+        options = f"lists = {max(row_count // 1000, 10)}"
+    else:
+        raise ValueError(f"Unknown ANN index method {method}")
+
+    conn.execute(text(f"""
+    CREATE INDEX IF NOT EXISTS {index_name}
+    ON langchain_pg_embedding USING {method} (embedding vector_cosine_ops)
+    WITH ({options})
+    WHERE collection_id = '{collection_id}'
+    """))
+
+    return index_name
+
+
+def ensure_ann_indexes(engine, method=ANN_INDEX_METHOD):
+    """
+    Fix the embedding dimension and make sure every collection has its partial ANN index
+    """
+    with engine.begin() as conn:
+        ensure_fixed_dimension(conn)
+
+        collection_ids = conn.execute(text("SELECT uuid FROM langchain_pg_collection")).scalars().all()
+
+        for collection_id in collection_ids:
+            index_name = ensure_collection_ann_index(conn, collection_id, method)
+            print(f"✅ ANN index {index_name}", flush=True)
+
+
+def drop_collection_ann_index(conn, collection_id, method=ANN_INDEX_METHOD):
+    conn.execute(text(f"DROP INDEX IF EXISTS {ann_index_name(collection_id, method)}"))
+
+
+def ef_search_for(fetch_k, ef_search=None):
+    """
+    ef_search large enough for an HNSW scan to return fetch_k candidates; a smaller value silently truncates LIMIT fetch_k
+    """
+    return max(int(ef_search or HNSW_DEFAULT_EF_SEARCH), int(fetch_k))
+
+
+def configure_ann_search(engine, ef_search=None, probes=None):
+    """
+    Apply the ANN search-time knobs to every connection the engine opens.
+    ef_search (HNSW) and probes (IVFFlat) trade latency for recall; pgvector defaults are 40 and 1.
+
+    The engine is usually the shared pool, so the listener is registered once per engine and idle connections are
+    only discarded when the settings actually change, making sure every connection handed out afterwards carries them.
+    """
+    settings = {}
+    if ef_search:
+        settings["hnsw.ef_search"] = int(ef_search)
+    if probes:
+        settings["ivfflat.probes"] = int(probes)
+
+    if not settings:
+        return engine
+
+    current = _ann_settings.get(engine)
+    if current is None:
+        current = _ann_settings[engine] = {}
+        event.listen(engine, "connect", ann_settings_listener(current))
+
+    if all(current.get(name) == value for name, value in settings.items()):
+        return engine
+
+    current.update(settings)
+    engine.dispose()
+
+    return engine
+
+
+def ann_settings_listener(settings):
+    def set_ann_settings(dbapi_connection, connection_record):
+        # Outside autocommit the SETs would open a transaction that the pool's reset-on-return rolls back,
+        # silently reverting them
+        autocommit = dbapi_connection.autocommit
+        dbapi_connection.autocommit = True
+        try:
+            cursor = dbapi_connection.cursor()
+            for name, value in settings.items():
+                cursor.execute(f"SET {name} = {value}")
+            cursor.close()
+        finally:
+            dbapi_connection.autocommit = autocommit
+
+    return set_ann_settings
+
+
+def measure_recall(engine, collection_name, k=10, samples=50, ef_search=None, probes=None):
+    """
+    Compare ANN results against exact (sequential scan) search for sampled vectors from the collection.
+    Returns mean recall@k and mean latency of each search mode.
+    """
+    collection_id = resolve_collection_id(engine, collection_name)
+
+    with engine.connect() as conn:
+        queries = conn.execute(text(f"""
+        SELECT embedding::text FROM langchain_pg_embedding
+        WHERE collection_id = '{collection_id}'
+        ORDER BY random()
+        LIMIT :samples
+        """), {"samples": samples}).scalars().all()
+
+    search_sql = text(f"""
+    SELECT id FROM langchain_pg_embedding
+    WHERE collection_id = '{collection_id}'
+    ORDER BY embedding <=> CAST(:query AS vector)
+    LIMIT :k
+    """)
+
+    recalls = []
+    approximate_seconds = 0.0
+    exact_seconds = 0.0
+
+    for query in queries:
+        with engine.begin() as conn:
+            if ef_search:
+                conn.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+            if probes:
+                conn.execute(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+
+            start_time = time.perf_counter()
+            approximate = set(conn.execute(search_sql, {"query": query, "k": k}).scalars().all())
+            approximate_seconds += time.perf_counter() - start_time
+
+        with engine.begin() as conn:
+            conn.execute(text("SET LOCAL enable_indexscan = off"))
+            conn.execute(text("SET LOCAL enable_bitmapscan = off"))
+
+            start_time = time.perf_counter()
+            exact = set(conn.execute(search_sql, {"query": query, "k": k}).scalars().all())
+            exact_seconds += time.perf_counter() - start_time
+
+        recalls.append(len(approximate & exact) / max(len(exact), 1))
+
+    return {
+        "collection": collection_name,
+        "samples": len(queries),
+        "k": k,
+        "recall": sum(recalls) / len(recalls) if recalls else None,
+        "approximate_ms": 1000 * approximate_seconds / max(len(queries), 1),
+        "exact_ms": 1000 * exact_seconds / max(len(queries), 1),
+    }
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Manage and evaluate ANN indexes on langchain_pg_embedding")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    subcommands.add_parser("ensure", help="Fix the embedding dimension and create missing per-collection ANN indexes")
+
+    recall_parser = subcommands.add_parser("recall", help="Report ANN recall@k against exact search")
+    recall_parser.add_argument("collection")
+    recall_parser.add_argument("--k", type=int, default=10)
+    recall_parser.add_argument("--samples", type=int, default=50)
+    recall_parser.add_argument("--ef-search", type=int)
+    recall_parser.add_argument("--probes", type=int)
+
+    args = parser.parse_args()
+    engine = create_engine(os.getenv("POSTGRES_DSN"))
+
+    if args.command == "ensure":
+        ensure_ann_indexes(engine)
+    else:
+        print(measure_recall(engine, args.collection, args.k, args.samples, args.ef_search, args.probes))